@@ -0,0 +1,258 @@
+"""
+A local stand-in for the Bing ReportingService that generates zipped CSV reports of configurable size,
+with configurable generation latency and failure rates.
+
+The service speaks JSON over HTTP instead of SOAP, because the service definition of the reporting API
+is not available offline. `FakeReportClient` replaces only the SOAP calls of `BingReportClient`, so
+rate limiting, polling, downloads through the shared session and all file handling run unchanged.
+"""
+
+import csv
+import datetime
+import io
+import itertools
+import json
+import random
+import threading
+import time
+import types
+import urllib.parse
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple
+
+from suds.sudsobject import Factory
+
+from bingads_downloader import config
+from bingads_downloader.downloader import BingReportClient
+from bingads_downloader.reports import RequestTemplates
+from bingads_downloader.transport import create_session
+
+
+class Profile(NamedTuple):
+    """How the fake service behaves"""
+    min_latency: float = 0.05  # seconds until a report is generated
+    max_latency: float = 0.2
+    latency_per_day: float = 0.0  # additional seconds per requested day
+    error_rate: float = 0.0  # share of reports whose generation fails
+    empty_rate: float = 0.0  # share of reports without data
+    throttle_rate: float = 0.0  # share of downloads that are answered with HTTP 503
+    rows_per_account_day: int = 50  # rows of daily reports
+    ads_per_account: int = 1000  # rows of reports that are not aggregated daily
+
+
+class FakeReportingService:
+    """An HTTP server on localhost that generates reports for submitted requests"""
+
+    def __init__(self, profile: Profile, seed: int = 0):
+        self.profile = profile
+        self._random = random.Random(seed)
+        self._reports = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.statistics = {'submitted': 0, 'polls': 0, 'downloads': 0, 'throttled': 0, 'failed': 0,
+                           'bytes_served': 0}
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                self._send_json(service.submit(request))
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                if url.path == '/poll':
+                    self._send_json(service.poll(int(urllib.parse.parse_qs(url.query)['id'][0])))
+                elif url.path.startswith('/reports/'):
+                    status, body = service.download(int(url.path.split('/')[-1].split('.')[0]))
+                    self._send(status, body, 'application/zip')
+                else:
+                    self._send(404, b'', 'text/plain')
+
+            def _send_json(self, value):
+                self._send(200, json.dumps(value).encode(), 'application/json')
+
+            def _send(self, status: int, body: bytes, content_type: str):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-bing', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def submit(self, request: dict) -> dict:
+        days = (_parse_date(request['last_date']) - _parse_date(request['first_date'])).days + 1
+        with self._lock:
+            request_id = next(self._ids)
+            latency = self._random.uniform(self.profile.min_latency, self.profile.max_latency) \
+                      + days * self.profile.latency_per_day
+            outcome = self._random.random()
+            status = 'Error' if outcome < self.profile.error_rate \
+                else 'Empty' if outcome < self.profile.error_rate + self.profile.empty_rate else 'Success'
+            self._reports[request_id] = (request, time.monotonic() + latency, status)
+            self.statistics['submitted'] += 1
+        return {'id': request_id}
+
+    def poll(self, request_id: int) -> dict:
+        with self._lock:
+            request, ready_at, status = self._reports[request_id]
+            self.statistics['polls'] += 1
+            if time.monotonic() < ready_at:
+                return {'status': 'Pending', 'url': None}
+            if status == 'Error':
+                self.statistics['failed'] += 1
+                return {'status': 'Error', 'url': None}
+        if status == 'Empty':
+            return {'status': 'Success', 'url': None}
+        return {'status': 'Success', 'url': '{}/reports/{}.zip'.format(self.url, request_id)}
+
+    def download(self, request_id: int) -> (int, bytes):
+        with self._lock:
+            self.statistics['downloads'] += 1
+            if self._random.random() < self.profile.throttle_rate:
+                self.statistics['throttled'] += 1
+                return 503, b''
+            request = self._reports[request_id][0]
+        body = generate_report(request, self.profile)
+        with self._lock:
+            self.statistics['bytes_served'] += len(body)
+        return 200, body
+
+
+def generate_report(request: dict, profile: Profile) -> bytes:
+    """Creates a zipped report in the format of Bing with made up values for all requested columns"""
+    first_date, last_date = _parse_date(request['first_date']), _parse_date(request['last_date'])
+    daily = request['aggregation'] == 'Daily'
+    if daily:
+        periods = ['{d.month}/{d.day}/{d.year}'.format(d=first_date + datetime.timedelta(days=i))
+                   for i in range((last_date - first_date).days + 1)]
+        rows_per_period = profile.rows_per_account_day
+    else:
+        periods = [str(last_date.year)]
+        rows_per_period = profile.ads_per_account
+
+    scopes = [(account_id, None) for account_id in request['account_ids']] \
+             or [(account_id, campaign_id) for account_id, campaign_id in request['campaigns']]
+    rows_per_scope = max(1, rows_per_period // (len(request['campaigns']) or 1)) if request['campaigns'] \
+        else rows_per_period
+
+    text = io.StringIO()
+    writer = csv.writer(text, quoting=csv.QUOTE_ALL)
+    row_count = len(periods) * len(scopes) * rows_per_scope
+    for line in ['Report Name: {}'.format(request['report_name']),
+                 'Report Time: {}-{}'.format(request['first_date'], request['last_date']),
+                 'Time Zone: (GMT+01:00) Amsterdam, Berlin, Bern, Rome, Stockholm, Vienna',
+                 'Last Completed Available Day: {}'.format(request['last_date']),
+                 'Last Completed Available Hour: {}'.format(request['last_date']),
+                 'Report Aggregation: {}'.format(request['aggregation']),
+                 'Report Filter: ', 'Potential Incomplete Data: false', 'Rows: {}'.format(row_count), '']:
+        writer.writerow([line])
+    writer.writerow(request['columns'])
+    for period in periods:
+        for account_id, campaign_id in scopes:
+            for i in range(rows_per_scope):
+                writer.writerow([_value(column, period, account_id, campaign_id, i) for column in request['columns']])
+    writer.writerow([])
+    writer.writerow(['©2020 Microsoft Corporation. All rights reserved. '])
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as f:
+        f.writestr('report.csv', '﻿' + text.getvalue())
+    return archive.getvalue()
+
+
+def _value(column: str, period: str, account_id: str, campaign_id: str, i: int) -> str:
+    campaign_id = campaign_id or str(int(account_id) * 100 + i % 10)
+    if column == 'TimePeriod':
+        return period
+    if column == 'AccountId':
+        return account_id
+    if column == 'CampaignId':
+        return campaign_id
+    if column == 'AdGroupId':
+        return str(int(campaign_id) * 100 + i % 50)
+    if column in ('AdId', 'KeywordId'):
+        return str(int(campaign_id) * 100000 + i)
+    if column in ('AdLabels', 'CampaignLabels'):
+        return '["{{channel=display}}","{{campaign_type=brand_{}}}"]'.format(i % 3)
+    if column in ('Impressions', 'Clicks', 'QualityScore'):
+        return str((i * 7919 + len(period)) % 1000)
+    if column in ('Ctr', 'ConversionRate'):
+        return '{:.2f}%'.format((i % 100) / 10)
+    if column in ('Spend', 'AverageCpc', 'AveragePosition', 'Conversions', 'CostPerConversion', 'Revenue'):
+        return '{:.2f}'.format((i % 1000) / 7)
+    return '{} {}'.format(column, i % 100)
+
+
+def _parse_date(value: str) -> datetime.date:
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class FakeFactory:
+    """Creates empty suds objects of the report types of the reporting service"""
+
+    FIELDS = {'ReportTime': ['CustomDateRangeStart', 'CustomDateRangeEnd', 'PredefinedTime', 'ReportTimeZone'],
+              'Date': ['Day', 'Month', 'Year'],
+              'AccountThroughCampaignReportScope': ['AccountIds', 'Campaigns', 'AdGroups']}
+
+    def create(self, name: str):
+        suds_object = Factory.object(name)
+        if name.startswith('ArrayOf'):
+            setattr(suds_object, name[len('ArrayOf'):], [])
+        for field in self.FIELDS.get(name, []):
+            setattr(suds_object, field, None)
+        return suds_object
+
+
+class FakeReportClient(BingReportClient):
+    """A BingReportClient whose service calls go to a FakeReportingService"""
+
+    def __init__(self, service_url: str):
+        # the ServiceClient constructor is skipped, it would download the service definition
+        self.session = create_session(max_connections=int(config.max_concurrent_reports()) + 2)
+        self.token_refresher = None
+        self.request_templates = RequestTemplates(FakeFactory())
+        self.fake_service_url = service_url
+
+    def _thread_client(self) -> 'FakeReportClient':
+        return self
+
+    def SubmitGenerateReport(self, report_request) -> int:
+        response = self.session.post(self.fake_service_url + '/submit', json=_request_as_json(report_request))
+        response.raise_for_status()
+        return response.json()['id']
+
+    def PollGenerateReport(self, request_id: int) -> types.SimpleNamespace:
+        response = self.session.get(self.fake_service_url + '/poll', params={'id': request_id})
+        response.raise_for_status()
+        status = response.json()
+        return types.SimpleNamespace(Status=status['status'], ReportDownloadUrl=status['url'])
+
+
+def _request_as_json(report_request) -> dict:
+    report_type = type(report_request).__name__[:-len('Request')]
+    scope = report_request.Scope
+    return {
+        'report_name': report_request.ReportName,
+        'aggregation': report_request.Aggregation,
+        'columns': list(getattr(report_request.Columns, report_type + 'Column')[0]),
+        'first_date': '{0.Year:04d}-{0.Month:02d}-{0.Day:02d}'.format(report_request.Time.CustomDateRangeStart),
+        'last_date': '{0.Year:04d}-{0.Month:02d}-{0.Day:02d}'.format(report_request.Time.CustomDateRangeEnd),
+        'account_ids': [str(account_id) for account_id in scope.AccountIds['long']] if scope.AccountIds else [],
+        'campaigns': [(str(campaign.AccountId), str(campaign.CampaignId))
+                      for campaign in scope.Campaigns.CampaignReportScope] if scope.Campaigns else []
+    }
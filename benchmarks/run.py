@@ -0,0 +1,165 @@
+"""
+Runs download scenarios against the fake reporting service and writes the measurements as JSON.
+
+    python -m benchmarks.run [--scenario refresh_31d] [--output results.json] [--scale 0.1]
+
+Every scenario runs in a separate process, so that its peak memory is measured on its own.
+"""
+
+import datetime
+import json
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+# {name: (description, config overrides, fake service profile, what to download)}
+SCENARIOS = {
+    'refresh_31d': (
+        'The daily run: all reports of the 31 day overwrite window',
+        {'first_date': 31},
+        {'rows_per_account_day': 200},
+        'performance'),
+    'backfill_1y': (
+        'A first download of one year, with the days before the overwrite window in batches of 7 days',
+        {'first_date': 365, 'report_batch_days': 7},
+        {'rows_per_account_day': 200, 'latency_per_day': 0.01},
+        'performance'),
+    'backfill_1y_throttled': (
+        'The one year backfill while 5% of the downloads are throttled',
+        {'first_date': 365, 'report_batch_days': 7, 'throttling_pause': 1},
+        {'rows_per_account_day': 200, 'latency_per_day': 0.01, 'throttle_rate': 0.05},
+        'performance'),
+    'account_structure': (
+        'A full refresh of the account structure of a large portfolio',
+        {'first_date': 365},
+        {'ads_per_account': 100000},
+        'account_structure'),
+}
+
+# The configuration of all scenarios, which the scenarios override
+DEFAULT_CONFIG = {
+    'oauth2_account_array': ['1001', '1002', '1003', '1004'],
+    'max_concurrent_reports': 6,
+    'min_poll_interval': 50,
+    'max_poll_interval': 500,
+    'requests_per_minute': 100000,
+    'max_pending_reports': 24,
+    'total_attempts_for_single_day': 5,
+}
+
+
+def run_scenario(name: str, data_dir: Path, scale: float) -> dict:
+    """
+    Runs a scenario in the current process
+    Args:
+        name: a key of SCENARIOS
+        data_dir: an empty directory for the output files
+        scale: a factor for the number of rows of the reports
+    Returns:
+        The measurements of the scenario
+    """
+    from bingads_downloader import config
+
+    _, overrides, profile_overrides, download = SCENARIOS[name]
+    settings = dict(DEFAULT_CONFIG, **overrides)
+    first_date = datetime.date.today() - datetime.timedelta(days=settings['first_date'])
+    settings['first_date'] = '{:%Y-%m-%d}'.format(first_date)
+    settings['data_dir'] = str(data_dir)
+    for key, value in settings.items():
+        setattr(config, key, lambda value=value: value)
+
+    from benchmarks.fake_bing import FakeReportClient, FakeReportingService, Profile
+    from bingads_downloader import downloader
+    from bingads_downloader.rate_limit import rate_limiter
+
+    profile = Profile(**profile_overrides)
+    profile = profile._replace(rows_per_account_day=max(1, int(profile.rows_per_account_day * scale)),
+                               ads_per_account=max(1, int(profile.ads_per_account * scale)))
+    service = FakeReportingService(profile)
+    api_client = FakeReportClient(service.url)
+
+    start_time = time.perf_counter()
+    error = None
+    try:
+        if download == 'account_structure':
+            downloader.download_account_structure_data(api_client)
+        else:
+            downloader.download_performance_data(api_client)
+    except Exception as e:
+        error = repr(e)
+    wall_seconds = time.perf_counter() - start_time
+    service.stop()
+
+    files = [path for path in data_dir.rglob('*') if path.is_file() and 'sqlite3' not in path.name
+             and path.suffix != '.jsonl']
+    return {
+        'description': SCENARIOS[name][0],
+        'error': error,
+        'wall_seconds': round(wall_seconds, 3),
+        'reports': service.statistics['submitted'],
+        'seconds_per_report': round(wall_seconds / max(1, service.statistics['submitted']), 4),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'files_written': len(files),
+        'bytes_written': sum(path.stat().st_size for path in files),
+        'service': service.statistics,
+        'rate_limit': rate_limiter().statistics(),
+        'profile': profile._asdict(),
+        'config': settings,
+    }
+
+
+@click.command()
+@click.option('--scenario', 'scenarios', multiple=True, type=click.Choice(list(SCENARIOS)),
+              help='The scenarios to run, all when not set')
+@click.option('--output', type=click.Path(), help='The JSON file to write, benchmarks/results/<time>.json when not set')
+@click.option('--scale', type=float, default=1.0, help='A factor for the number of rows of all reports')
+@click.option('--child', hidden=True)
+def main(scenarios, output, scale, child):
+    """Runs benchmark scenarios against the fake reporting service"""
+    if child:
+        with tempfile.TemporaryDirectory() as data_dir:
+            print(json.dumps(run_scenario(child, Path(data_dir), scale)))
+        return
+
+    results = {
+        'started_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'scale': scale,
+        'scenarios': {}
+    }
+    for name in scenarios or SCENARIOS:
+        print('Running {}'.format(name), file=sys.stderr)
+        process = subprocess.run([sys.executable, '-m', 'benchmarks.run', '--child', name, '--scale', str(scale)],
+                                 stdout=subprocess.PIPE, cwd=str(Path(__file__).parent.parent),
+                                 universal_newlines=True)
+        if process.returncode != 0:
+            results['scenarios'][name] = {'error': 'exit code {}'.format(process.returncode)}
+            continue
+        results['scenarios'][name] = result = json.loads(process.stdout.strip().splitlines()[-1])
+        print('  {wall_seconds:.1f} s, {reports} reports, {peak_rss_mb:.0f} MB peak RSS, {bytes_written} bytes written'
+              .format(**result), file=sys.stderr)
+
+    output = Path(output or Path(__file__).parent / 'results'
+                  / '{:%Y%m%d-%H%M%S}.json'.format(datetime.datetime.now()))
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print('Results written to {}'.format(output), file=sys.stderr)
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(Path(__file__).parent),
+                                       universal_newlines=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    main()
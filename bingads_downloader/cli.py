@@ -5,7 +5,7 @@ from functools import partial
 
 import click
 
-from bingads_downloader import config
+from bingads_downloader import config, profiling
 
 
 def config_option(config_function):
@@ -53,14 +53,49 @@ def refresh_oauth2_token(**kwargs):
 @config_option(config.oauth2_client_id)
 @config_option(config.oauth2_client_secret)
 @config_option(config.oauth2_refresh_token)
+@config_option(config.oauth2_token_cache)
+@config_option(config.oauth2_token_refresh_margin)
 @config_option(config.data_dir)
 @config_option(config.output_file_version)
 @config_option(config.first_date)
 @config_option(config.environment)
 @config_option(config.timeout)
+@config_option(config.service_timeout)
 @config_option(config.total_attempts_for_single_day)
 @config_option(config.retry_timeout_interval)
-def download_data(**kwargs):
+@config_option(config.max_retry_interval)
+@config_option(config.circuit_breaker_failures)
+@config_option(config.circuit_breaker_pause)
+@config_option(config.max_concurrent_reports)
+@config_option(config.min_poll_interval)
+@config_option(config.max_poll_interval)
+@config_option(config.report_batch_days)
+@config_option(config.min_overwrite_days)
+@config_option(config.stable_runs)
+@config_option(config.account_structure_refresh_days)
+@config_option(config.account_structure_full_refresh_interval)
+@config_option(config.campaign_report_source)
+@config_option(config.campaign_report_sample)
+@config_option(config.output_format)
+@config_option(config.csv_layout)
+@config_option(config.label_columns)
+@config_option(config.accounts_per_shard)
+@config_option(config.compression)
+@config_option(config.compression_workers)
+@config_option(config.lease_timeout)
+@config_option(config.requests_per_minute)
+@config_option(config.max_pending_reports)
+@config_option(config.throttling_pause)
+@config_option(config.wsdl_cache_dir)
+@config_option(config.wsdl_cache_days)
+@config_option(config.index_suffix)
+@config_option(config.metrics_file)
+@config_option(config.prometheus_textfile)
+@click.option('--worker', is_flag=True,
+              help='Take jobs from a work queue in the data directory that is shared with other workers')
+@click.option('--startup_profile', is_flag=True,
+              help='Print how long imports, the construction of the service client and authentication took')
+def download_data(worker, startup_profile, **kwargs):
     """
     Downloads data.
     When options are not specified, then the defaults from config.py are used.
@@ -68,5 +103,59 @@ def download_data(**kwargs):
     apply_options(kwargs)
     show_version()
 
-    from bingads_downloader import downloader  # load api client only when needed
-    downloader.download_data()
+    profile = profiling.startup_profile()
+    profile.enabled = startup_profile
+    with profile.phase('import requests & suds'):
+        import requests
+        import suds
+    with profile.phase('import bingads'):  # parses the campaign management service definition of the SDK
+        import bingads
+    with profile.phase('import downloader'):
+        from bingads_downloader import downloader  # load api client only when needed
+    downloader.download_data(worker=worker)
+
+
+@click.command()
+@config_option(config.data_dir)
+@config_option(config.output_file_version)
+@config_option(config.compression)
+@config_option(config.index_suffix)
+@click.option('--from', 'first_date', type=click.DateTime(['%Y-%m-%d']), required=True, help='The first day')
+@click.option('--to', 'last_date', type=click.DateTime(['%Y-%m-%d']), required=True, help='The last day')
+@click.option('--report', type=click.Choice(['ad', 'keyword', 'campaign']), required=True,
+              help='The performance report to read')
+@click.option('--account', 'account_ids', multiple=True, help='Only rows of this account, can be repeated')
+@click.option('--campaign', 'campaign_ids', multiple=True, help='Only rows of this campaign, can be repeated')
+def query_data(first_date, last_date, report, account_ids, campaign_ids, **kwargs):
+    """
+    Writes the rows of the downloaded performance files of a report for a range of days to stdout as CSV,
+    with ISO dates and numbers without '%'.
+    """
+    apply_options(kwargs)
+
+    import csv
+    from bingads_downloader.query import query
+
+    writer = None
+    for row in query(first_date.date(), last_date.date(), report, account_ids, campaign_ids):
+        if writer is None:
+            writer = csv.DictWriter(sys.stdout, fieldnames=list(row))
+            writer.writeheader()
+        writer.writerow(row)
+
+
+@click.command()
+@config_option(config.data_dir)
+@config_option(config.output_file_version)
+@config_option(config.compression)
+@config_option(config.compaction_period)
+def compact_data(**kwargs):
+    """
+    Merges the per-day performance files of the days before the overwrite window into monthly or yearly files.
+    Must not run while data is downloaded into the same data directory.
+    """
+    apply_options(kwargs)
+    show_version()
+
+    from bingads_downloader.compaction import compact_performance_files
+    compact_performance_files()
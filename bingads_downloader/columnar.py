@@ -0,0 +1,182 @@
+"""
+Typed, columnar Parquet output next to or instead of the compressed CSV files.
+
+Requires pyarrow, which is installed with `pip install bingads-performance-downloader[parquet]`
+"""
+
+import csv
+import io
+import os
+from pathlib import Path
+from typing import Iterable
+
+from bingads_downloader import config
+from bingads_downloader.compression import open_decompressed
+from bingads_downloader.labels import label_columns
+from bingads_downloader.report_file import NULL_VALUES, ReportReader, open_report_file, parse_report_date
+
+# The types of the columns of each output file. Columns that are not listed are strings.
+SCHEMAS = {
+    'ad': {
+        'TimePeriod': 'date',
+        'AccountId': 'int64',
+        'CampaignId': 'int64',
+        'AdGroupId': 'int64',
+        'AdId': 'int64',
+        'Impressions': 'int64',
+        'Clicks': 'int64',
+        'Ctr': 'percent',
+        'Spend': 'float64',
+        'AveragePosition': 'float64',
+        'Conversions': 'float64',
+        'ConversionRate': 'percent',
+        'CostPerConversion': 'float64'
+    },
+    'keyword': {
+        'TimePeriod': 'date',
+        'AccountId': 'int64',
+        'CampaignId': 'int64',
+        'AdGroupId': 'int64',
+        'AdId': 'int64',
+        'KeywordId': 'int64',
+        'Clicks': 'int64',
+        'Impressions': 'int64',
+        'Ctr': 'percent',
+        'AverageCpc': 'float64',
+        'Spend': 'float64',
+        'QualityScore': 'int64',
+        'Conversions': 'float64',
+        'Revenue': 'float64'
+    },
+    'campaign': {
+        'TimePeriod': 'date',
+        'AccountId': 'int64',
+        'CampaignId': 'int64',
+        'Spend': 'float64'
+    },
+    'account_structure': {
+        'AdId': 'int64',
+        'AdGroupId': 'int64',
+        'CampaignId': 'int64',
+        'AccountId': 'int64'
+    }
+}
+
+
+def output_formats() -> [str]:
+    """Returns the configured output formats, e.g. ['csv', 'parquet']"""
+    formats = [output_format.strip() for output_format in config.output_format().split(',')]
+    for output_format in formats:
+        if output_format not in ('csv', 'parquet'):
+            raise ValueError('Unknown output format "{}"'.format(output_format))
+    if 'parquet' in formats:
+        _import_pyarrow()
+    return formats
+
+
+def normalization_schema(report: str) -> {str: str}:
+    """Returns the column types for writing normalized CSV files of a report, or None for the layout of Bing"""
+    if config.csv_layout() == 'bing':
+        return None
+    if config.csv_layout() != 'normalized':
+        raise ValueError('Unknown CSV layout "{}"'.format(config.csv_layout()))
+    return report_schema(report)
+
+
+def report_schema(report: str) -> {str: str}:
+    """Returns the column types of the output files of a report, including the configured label columns"""
+    return {**SCHEMAS[report], **{column.name: column.type for column in label_columns()}}
+
+
+def parquet_file_path(file_path: Path) -> Path:
+    """The Parquet file that belongs to a compressed CSV file"""
+    return file_path.with_name(file_path.name.partition('.csv')[0] + '.parquet')
+
+
+def outputs_exist(file_path: Path) -> bool:
+    """Whether all configured outputs of a compressed CSV file exist, e.g. only its Parquet file"""
+    return all((file_path if output_format == 'csv' else parquet_file_path(file_path)).exists()
+               for output_format in output_formats())
+
+
+def write_columnar_outputs(report: str, file_path: Path):
+    """
+    Writes the Parquet version of an output file if configured and removes the CSV file if it is not wanted
+    Args:
+        report: the report type of the file, a key of SCHEMAS
+        file_path: the compressed CSV file
+    """
+    formats = output_formats()
+    if 'parquet' not in formats or not file_path.exists():
+        return
+    if report == 'account_structure':
+        with io.TextIOWrapper(open_decompressed(file_path), encoding='utf-8', newline='') as f:
+            reader = csv.reader(f, delimiter='\t')
+            write_parquet(parquet_file_path(file_path), report_schema(report), next(reader), reader)
+    else:
+        with open_report_file(file_path) as f:
+            reader = ReportReader(f, allow_normalized=True)
+            write_parquet(parquet_file_path(file_path), report_schema(report), reader.header, reader)
+    if 'csv' not in formats:
+        file_path.unlink()
+
+
+def write_parquet(file_path: Path, schema: {str: str}, header: [str], rows: Iterable[list],
+                  batch_size: int = 100000):
+    """
+    Writes rows of strings into a typed Parquet file, one row group per `batch_size` rows
+    Args:
+        file_path: the Parquet file to write
+        schema: the types of the columns, of the form {column: type}
+        header: the column names
+        rows: the rows as lists of strings
+        batch_size: the number of rows that are converted at once
+    """
+    pa, pq = _import_pyarrow()
+    arrow_types = {'string': pa.string(), 'int64': pa.int64(), 'float64': pa.float64(),
+                   'percent': pa.float64(), 'date': pa.date32()}
+    types = [schema.get(column, 'string') for column in header]
+    converters = [CONVERTERS[type] for type in types]
+    arrow_schema = pa.schema([(column, arrow_types[type]) for column, type in zip(header, types)])
+
+    def to_table(columns: [list]):
+        return pa.Table.from_arrays([pa.array(values, type=field.type)
+                                     for values, field in zip(columns, arrow_schema)], schema=arrow_schema)
+
+    tmp_file_path = file_path.with_name(file_path.name + '.tmp')
+    with pq.ParquetWriter(str(tmp_file_path), arrow_schema) as writer:
+        columns = [[] for _ in header]
+        for row in rows:
+            for values, convert, value in zip(columns, converters, row):
+                values.append(None if value in NULL_VALUES else convert(value))
+            if len(columns[0]) >= batch_size:
+                writer.write_table(to_table(columns))
+                columns = [[] for _ in header]
+        writer.write_table(to_table(columns))
+    os.replace(str(tmp_file_path), str(file_path))
+
+
+def _to_int(value: str) -> int:
+    return int(value.replace(',', ''))
+
+
+def _to_float(value: str) -> float:
+    return float(value.replace(',', ''))
+
+
+def _percent_to_float(value: str) -> float:
+    return float(value.rstrip('%').replace(',', ''))
+
+
+CONVERTERS = {'string': str, 'int64': _to_int, 'float64': _to_float, 'percent': _percent_to_float,
+              'date': parse_report_date}
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Parquet output requires pyarrow. '
+                          'Install it with "pip install bingads-performance-downloader[parquet]"')
+    return pyarrow, pyarrow.parquet
@@ -0,0 +1,273 @@
+"""
+Compaction of the per-day performance files of final days into one file per report and month (or year).
+
+A compacted file, e.g. '2020/03/bing/ad_performance_v3.csv.gz', is a single report: the preamble and header of
+its first day, the rows of all days and the footer, as consecutive gzip members (or zstd / lz4 frames).
+The rows of every day are compressed on their own, so the index next to the file, '.days.json', maps each day
+to the bytes that hold its rows, which can be decompressed without the rest of the file.
+
+Days of the overwrite window keep the per-day layout.
+"""
+
+import csv
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from typing import Iterator
+
+from bingads_downloader import config
+from bingads_downloader.compression import csv_file_name, open_compressed, open_decompressed_bytes
+from bingads_downloader.manifest import download_manifest
+from bingads_downloader.report_file import ReportReader, open_report_file, write_report
+from bingads_downloader.reports import REPORTS, daily_reports
+
+# The version of the day index format, files with indexes of other versions are not read
+INDEX_VERSION = 1
+
+INDEX_SUFFIX = '.days.json'
+
+# The number of most recent days that are downloaded again in every run and therefore never compacted
+OVERWRITE_WINDOW_DAYS = 31
+
+PERIOD_FORMATS = {'month': '{:%Y/%m}/bing', 'year': '{:%Y}/bing'}
+
+
+def report_file_name(report: str) -> str:
+    """The name of the per-day and compacted files of a report, e.g. 'ad_performance_v3.csv.gz'"""
+    return csv_file_name('{}_{}'.format(REPORTS[report].file_name, config.output_file_version()))
+
+
+def daily_file_path(day: datetime.date, report: str) -> Path:
+    """The absolute path of the per-day file of a report"""
+    return Path(config.data_dir(), '{:%Y/%m/%d}/bing'.format(day), report_file_name(report)).expanduser()
+
+
+def compacted_file_path(day: datetime.date, report: str, period: str) -> Path:
+    """The absolute path of the compacted file of a report that contains a day"""
+    return Path(config.data_dir(), PERIOD_FORMATS[period].format(day), report_file_name(report)).expanduser()
+
+
+def compacted_day(day: datetime.date, report: str) -> (Path, dict):
+    """
+    Looks up a day in the compacted files of a report
+    Returns:
+        A tuple of the form (compacted file, day entry of its index), or None when the day is not compacted
+    """
+    for period in PERIOD_FORMATS:
+        file_path = compacted_file_path(day, report, period)
+        index = load_day_index(file_path)
+        if index and day.isoformat() in index['days']:
+            return file_path, index['days'][day.isoformat()]
+    return None
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def load_day_index(file_path: Path) -> dict:
+    """Returns the day index of a compacted file, or None when the file does not exist or has no valid index"""
+    try:
+        stat = file_path.stat()
+    except OSError:
+        return None
+    key = (str(file_path), stat.st_size, stat.st_mtime_ns)
+    with _indexes_lock:
+        if key not in _indexes:
+            try:
+                index = json.loads(Path(str(file_path) + INDEX_SUFFIX).read_text())
+            except (OSError, ValueError):
+                index = None
+            if not index or index.get('version') != INDEX_VERSION \
+                    or [index['size'], index['mtime_ns']] != [stat.st_size, stat.st_mtime_ns]:
+                return None
+            _indexes[key] = index
+        return _indexes[key]
+
+
+def read_compacted_day(file_path: Path, entry: dict, header: bool = True) -> Iterator[list]:
+    """
+    Reads the rows of a day from a compacted file
+    Args:
+        file_path: the compacted file
+        entry: the entry of the day in the index of the file
+        header: whether to return the column header of the file first
+    """
+    if header:
+        yield load_day_index(file_path)['header']
+    with open(str(file_path), 'rb') as f:
+        f.seek(entry['offset'])
+        data = f.read(entry['size'])
+    with io.TextIOWrapper(open_decompressed_bytes(data), encoding='utf-8', newline='') as rows:
+        yield from csv.reader(rows)
+
+
+def compact_performance_files(period: str = None):
+    """
+    Merges the per-day files of all days before the overwrite window into one file per report and period,
+    together with days that were compacted before, e.g. into monthly files when compacting into years.
+    Must not run at the same time as a download.
+    Args:
+        period: 'month' or 'year', config.compaction_period() when not set
+    """
+    period = period or config.compaction_period()
+    if period not in PERIOD_FORMATS:
+        raise ValueError('Unknown compaction period "{}", use one of {}'.format(period, ', '.join(PERIOD_FORMATS)))
+    last_final_day = datetime.date.today() - datetime.timedelta(days=OVERWRITE_WINDOW_DAYS + 1)
+    states = download_manifest().states()
+
+    for report in daily_reports():
+        periods = {}
+        for file_path in Path(config.data_dir()).expanduser().glob('*/*/*/bing/' + report_file_name(report)):
+            try:
+                day = datetime.datetime.strptime('/'.join(file_path.parts[-5:-2]), '%Y/%m/%d').date()
+            except ValueError:
+                continue
+            if states.get((day, report), 'complete') == 'complete':  # not being downloaded
+                periods.setdefault(compacted_file_path(day, report, period), (day, set()))[1].add(day)
+        if period == 'year':
+            for file_path in Path(config.data_dir()).expanduser().glob('*/*/bing/' + report_file_name(report)):
+                index = load_day_index(file_path)
+                if index and index['period'] == 'month':
+                    day = datetime.datetime.strptime(min(index['days']), '%Y-%m-%d').date()
+                    periods.setdefault(compacted_file_path(day, report, period), (day, set()))
+
+        for target_file, (day, daily_days) in sorted(periods.items()):
+            period_days = _period_days(day, period)
+            if period_days[-1] > last_final_day:
+                continue
+            print('Compacting {} per-day files of the {} report into {}'.format(len(daily_days), report, target_file))
+            compact_period(report, period, period_days, daily_days, target_file)
+
+
+def compact_period(report: str, period: str, period_days: [datetime.date], daily_days: {datetime.date},
+                   target_file: Path):
+    """
+    Writes the compacted file of a period from the per-day files and the previously compacted files of its days,
+    then removes them
+    Args:
+        report: the report type
+        period: 'month' or 'year'
+        period_days: all days of the period
+        daily_days: the days of which the per-day file is compacted, other days are taken from compacted files
+        target_file: the compacted file
+    """
+    sources = {}  # {day: per-day file or (compacted file, day entry)}
+    for day in period_days:
+        if day in daily_days:
+            sources[day] = daily_file_path(day, report)
+        else:
+            sources[day] = compacted_day(day, report)
+    sources = {day: source for day, source in sources.items() if source}
+    if not sources:
+        return
+
+    with tempfile.TemporaryDirectory(dir=str(target_file.parent.parent)) as tmp_dir:
+        preamble, header, footer, index_days = None, None, [], {}
+        day_files = []
+        for day, source in sorted(sources.items()):
+            if isinstance(source, Path):
+                with open_report_file(source) as f:
+                    reader = ReportReader(f, allow_normalized=True)
+                    if header is None:
+                        preamble, header = reader.preamble, reader.header
+                    _check_layout(source, reader.header, reader.preamble, header, preamble)
+                    day_file, entry = _write_day(Path(tmp_dir), day, reader, header, bool(preamble))
+                    footer = footer or reader.footer
+            else:
+                file_path, old_entry = source
+                old_index = load_day_index(file_path)
+                if header is None:
+                    preamble, header, footer = old_index['preamble'], old_index['header'], old_index['footer']
+                _check_layout(file_path, old_index['header'], old_index['preamble'], header, preamble)
+                day_file, entry = _write_day(Path(tmp_dir), day, read_compacted_day(file_path, old_entry, False),
+                                             header, bool(preamble))
+            day_files.append(day_file)
+            index_days[day.isoformat()] = entry
+
+        tmp_target_file = Path(tmp_dir, target_file.name)
+        with open(str(tmp_target_file), 'wb') as output:
+            head_file, foot_file = Path(tmp_dir, 'head'), Path(tmp_dir, 'foot')
+            with open_compressed(head_file, 'wt') as head:
+                rows = sum(entry['rows'] for entry in index_days.values())
+                write_report(head, [['Rows: {}'.format(rows)] if line and line[0].startswith('Rows:') else line
+                                    for line in preamble] if preamble else [], header, [], [])
+            with open_compressed(foot_file, 'wt') as foot:
+                csv.writer(foot, quoting=csv.QUOTE_ALL).writerows(footer)
+            for part, entry in [(head_file, None)] + list(zip(day_files, index_days.values())) + [(foot_file, None)]:
+                if entry is not None:
+                    entry['offset'] = output.tell()
+                with open(str(part), 'rb') as f:
+                    shutil.copyfileobj(f, output)
+                if entry is not None:
+                    entry['size'] = output.tell() - entry['offset']
+
+        # the index is written first, moving the file keeps its size and modification time
+        stat = tmp_target_file.stat()
+        target_file.parent.mkdir(parents=True, exist_ok=True)
+        _write_json(Path(str(target_file) + INDEX_SUFFIX),
+                    {'version': INDEX_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                     'period': period, 'preamble': preamble, 'header': header, 'footer': footer, 'days': index_days})
+        os.replace(str(tmp_target_file), str(target_file))
+
+    _remove_sources(sources, target_file)
+
+
+def _check_layout(source: Path, header: [str], preamble: [[str]], first_header: [str], first_preamble: [[str]]):
+    """Makes sure that all days of a compacted file have the same columns and layout"""
+    if header != first_header or bool(preamble) != bool(first_preamble):
+        raise ValueError('The columns or the layout of {} differ from those of the other days'.format(source))
+
+
+def _write_day(tmp_dir: Path, day: datetime.date, rows: Iterator[list], header: [str],
+               quote_all: bool) -> (Path, dict):
+    """Compresses the rows of a day on their own and returns the file and the index entry of the day"""
+    account, campaign = (header.index(column) if column in header else None for column in ('AccountId', 'CampaignId'))
+    accounts, campaigns, count = set(), set(), 0
+    day_file = Path(tmp_dir, '{:%Y-%m-%d}'.format(day))
+    with open_compressed(day_file, 'wt') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL if quote_all else csv.QUOTE_MINIMAL)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+            if account is not None:
+                accounts.add(row[account])
+            if campaign is not None:
+                campaigns.add(row[campaign])
+    return day_file, {'rows': count, 'accounts': sorted(accounts), 'campaigns': sorted(campaigns)}
+
+
+def _remove_sources(sources: dict, target_file: Path):
+    """Removes the per-day files and their sidecars and compacted files of a shorter period that were merged"""
+    for day, source in sources.items():
+        if isinstance(source, Path):
+            for file_path in source.parent.glob(source.name + '*'):
+                file_path.unlink()
+            for directory in (source.parent, source.parent.parent):
+                try:
+                    directory.rmdir()
+                except OSError:  # not empty
+                    pass
+        elif source[0] != target_file:
+            for file_path in (source[0], Path(str(source[0]) + INDEX_SUFFIX)):
+                if file_path.exists():
+                    file_path.unlink()
+
+
+def _period_days(day: datetime.date, period: str) -> [datetime.date]:
+    """All days of the month or year of a day"""
+    first_day = day.replace(day=1) if period == 'month' else day.replace(month=1, day=1)
+    next_first_day = (first_day + datetime.timedelta(days=32)).replace(day=1) if period == 'month' \
+        else first_day.replace(year=first_day.year + 1)
+    return [first_day + datetime.timedelta(days=i) for i in range((next_first_day - first_day).days)]
+
+
+def _write_json(file_path: Path, value: dict):
+    tmp_file_path = file_path.with_name(file_path.name + '.tmp')
+    tmp_file_path.write_text(json.dumps(value, separators=(',', ':')))
+    os.replace(str(tmp_file_path), str(file_path))
@@ -0,0 +1,184 @@
+"""
+Compression of output files with a configurable codec on a worker pool.
+
+Files are cut into blocks that are compressed in parallel and written as consecutive gzip members
+(or zstd / lz4 frames), which all standard tools decompress as a single stream.
+zstd and lz4 require the `zstandard` and `lz4` packages.
+"""
+
+import collections
+import gzip
+import importlib
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO
+
+from bingads_downloader import config
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst', 'lz4': '.lz4'}
+
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3, 'lz4': 0}
+
+MAGIC_NUMBERS = {b'\x1f\x8b': 'gzip', b'\x28\xb5\x2f\xfd': 'zstd', b'\x04\x22\x4d\x18': 'lz4'}
+
+
+def codec() -> (str, int):
+    """
+    Parses config.compression()
+    Returns:
+        A tuple of the form (codec, level)
+    """
+    name, _, level = config.compression().partition(':')
+    if name not in EXTENSIONS:
+        raise ValueError('Unknown compression "{}", use one of {}'.format(name, ', '.join(EXTENSIONS)))
+    return name, int(level) if level else DEFAULT_LEVELS[name]
+
+
+def csv_file_name(name: str) -> str:
+    """Appends the extensions of a compressed CSV file to a file name, e.g. 'ad_performance_v3.csv.gz'"""
+    return name + '.csv' + EXTENSIONS[codec()[0]]
+
+
+def block_compressor(name: str, level: int):
+    """Returns a function that compresses a single block into a self-contained gzip member or frame"""
+    if name == 'gzip':
+        return lambda block: gzip.compress(block, compresslevel=level)
+    if name == 'zstd':
+        zstandard = _import_optional('zstandard', 'zstd')
+        return lambda block: zstandard.ZstdCompressor(level=level).compress(block)
+    lz4_frame = _import_optional('lz4.frame', 'lz4')
+    return lambda block: lz4_frame.compress(block, compression_level=level)
+
+
+class CompressedWriter(io.RawIOBase):
+    """
+    A binary file that compresses its content block-wise on the compression pool.
+    At most twice as many blocks as there are workers are held in memory.
+    """
+
+    def __init__(self, file_path: Path, member_offsets: list = None):
+        """
+        Args:
+            file_path: the file to write
+            member_offsets: a list to which the compressed offset of every gzip member or frame is added
+        """
+        super().__init__()
+        self._compress = block_compressor(*codec())
+        self._file = open(str(file_path), 'wb')
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._max_pending = 2 * int(config.compression_workers())
+        self._blocks_written = 0
+        self._member_offsets = member_offsets
+        self._size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:BLOCK_SIZE]))
+            del self._buffer[:BLOCK_SIZE]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        self._pending.append(compression_pool().submit(self._compress, block))
+        self._blocks_written += 1
+        while len(self._pending) > self._max_pending:
+            self._write_member(self._pending.popleft().result())
+
+    def _write_member(self, member: bytes):
+        if self._member_offsets is not None:
+            self._member_offsets.append(self._size)
+        self._file.write(member)
+        self._size += len(member)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer or not self._blocks_written:
+                self._submit(bytes(self._buffer))
+            while self._pending:
+                self._write_member(self._pending.popleft().result())
+        finally:
+            self._file.close()
+            super().close()
+
+
+def open_compressed(file_path: Path, mode: str = 'wb', member_offsets: list = None):
+    """
+    Opens a file for writing with the configured codec
+    Args:
+        file_path: the file to write
+        mode: 'wb' for a binary or 'wt' for a UTF-8 text file
+        member_offsets: a list to which the compressed offset of every gzip member or frame is added, each of
+                        which holds BLOCK_SIZE bytes of the uncompressed content except for the last one
+    """
+    writer = io.BufferedWriter(CompressedWriter(file_path, member_offsets), buffer_size=BLOCK_SIZE)
+    if mode == 'wt':
+        return io.TextIOWrapper(writer, encoding='utf-8', newline='')
+    return writer
+
+
+def compress_file(source: BinaryIO, file_path: Path):
+    """Writes the content of a binary stream into a file that is compressed with the configured codec"""
+    with open_compressed(file_path) as target:
+        for block in iter(lambda: source.read(BLOCK_SIZE), b''):
+            target.write(block)
+
+
+def open_decompressed(file_path: Path) -> BinaryIO:
+    """Opens a file that was written with any of the codecs (or is not compressed) for binary reading"""
+    with open(str(file_path), 'rb') as f:
+        magic = f.read(4)
+    name = MAGIC_NUMBERS.get(magic[:2]) or MAGIC_NUMBERS.get(magic)
+    if name == 'gzip':
+        return gzip.open(str(file_path), 'rb')
+    if name == 'zstd':
+        zstandard = _import_optional('zstandard', 'zstd')
+        return zstandard.ZstdDecompressor().stream_reader(open(str(file_path), 'rb'), read_across_frames=True,
+                                                          closefd=True)
+    if name == 'lz4':
+        return _import_optional('lz4.frame', 'lz4').open(str(file_path), 'rb')
+    return open(str(file_path), 'rb')
+
+
+def open_decompressed_bytes(data: bytes) -> BinaryIO:
+    """Opens compressed content in memory, e.g. the part of a day in a compacted file, for binary reading"""
+    name = MAGIC_NUMBERS.get(data[:2]) or MAGIC_NUMBERS.get(data[:4])
+    if name == 'gzip':
+        return gzip.GzipFile(fileobj=io.BytesIO(data), mode='rb')
+    if name == 'zstd':
+        zstandard = _import_optional('zstandard', 'zstd')
+        return zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True)
+    if name == 'lz4':
+        return _import_optional('lz4.frame', 'lz4').open(io.BytesIO(data), 'rb')
+    return io.BytesIO(data)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def compression_pool() -> ThreadPoolExecutor:
+    """Returns the thread pool for compression, which is separate from the download threads"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=int(config.compression_workers()),
+                                       thread_name_prefix='compression')
+        return _pool
+
+
+def _import_optional(module: str, extra: str):
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        raise ImportError('The {} compression requires the {} package. Install it with '
+                          '"pip install bingads-performance-downloader[{}]"'.format(extra, module.split('.')[0], extra))
@@ -37,6 +37,17 @@ def oauth2_refresh_token() -> str:
     """The Oauth refresh token returned from the adwords-downloader-refresh-oauth2-token script"""
     return 'ABCDefgh!1234567890ABCDefgh!1234567890ABCDefgh!1234567890ABCDefgh!1234567890ABCDefgh!1234567890ABCDefgh!1234567890ABCDefgh!1234567890'
 
+
+def oauth2_token_cache() -> str:
+    """The file in which the OAuth access token is cached, relative to the data directory. Empty to disable"""
+    return 'bing-oauth-token.json'
+
+
+def oauth2_token_refresh_margin() -> int:
+    """The seconds before its expiry at which the OAuth access token is renewed"""
+    return 600
+
+
 def oauth2_customer_id() -> str:
     """The customer ID for the person"""
     return "438958943"
@@ -54,16 +65,166 @@ def timeout() -> int:
     return 3600000
 
 
+def service_timeout() -> int:
+    """The seconds to wait for the answer to a single call of the reporting service"""
+    return 90
+
+
 def total_attempts_for_single_day() -> int:
-    """The attempts to download a single day (ad and keyword performance) in case of HTTP errors or timeouts"""
+    """The retries of a report job after transient errors, and the pauses of all jobs before the run gives up"""
     return 5
 
 
 def retry_timeout_interval() -> int:
-    """number of seconds to wait before trying again to download a single day"""
+    """The seconds to wait before retrying a report job, doubled for every further retry and shortened randomly"""
     return 10
 
 
+def max_retry_interval() -> int:
+    """The maximum seconds to wait before retrying a report job"""
+    return 300
+
+
+def circuit_breaker_failures() -> int:
+    """The failed attempts of any report jobs in a row after which all jobs are paused, 0 to never pause"""
+    return 10
+
+
+def circuit_breaker_pause() -> int:
+    """The seconds all jobs are paused when Bing fails across the board, doubled while the failures continue"""
+    return 120
+
+
 def output_file_version() -> str:
     """A suffix that is added to output files, denoting a version of the data format"""
     return 'v3'
+
+
+def max_concurrent_reports() -> int:
+    """The maximum number of (day, report) downloads that run at the same time"""
+    return 3
+
+
+def min_poll_interval() -> int:
+    """The time (in milliseconds) before the status of a submitted report is checked for the first time"""
+    return 1000
+
+
+def max_poll_interval() -> int:
+    """The maximum time (in milliseconds) between two status checks of a report that is still being generated"""
+    return 30000
+
+
+def report_batch_days() -> int:
+    """The number of consecutive days that are requested in one report for days before the overwrite window"""
+    return 1
+
+
+def min_overwrite_days() -> int:
+    """The number of most recent days that are downloaded on every run, no matter whether they changed"""
+    return 7
+
+
+def stable_runs() -> int:
+    """The number of unchanged downloads after which a day of the 31 day window is skipped, 0 downloads all days"""
+    return 0
+
+
+def account_structure_refresh_days() -> int:
+    """The number of recent days that are requested to update the account structure, 0 requests all days"""
+    return 31
+
+
+def account_structure_full_refresh_interval() -> int:
+    """The number of days after which the account structure is requested for all days again"""
+    return 7
+
+
+def campaign_report_source() -> str:
+    """Where campaign performance comes from, "api" or "ad_report" to sum up the spend of the ad report by campaign"""
+    return 'api'
+
+
+def campaign_report_sample() -> float:
+    """The share of days with a campaign report from the ad report that is compared with the one of Bing"""
+    return 0.05
+
+
+def output_format() -> str:
+    """The formats of the output files, "csv", "parquet" or "csv,parquet" (parquet requires pyarrow)"""
+    return 'csv'
+
+
+def accounts_per_shard() -> int:
+    """The number of accounts that are requested in one report, 0 requests all accounts in one report"""
+    return 0
+
+
+def csv_layout() -> str:
+    """The layout of performance files, "bing" as sent by Bing or "normalized" with a header, ISO dates and numbers"""
+    return 'bing'
+
+
+def label_columns() -> str:
+    """Labels written as extra columns, e.g. "channel,brand,priority:int64" (types: string, int64, float64)"""
+    return ''
+
+
+def compression() -> str:
+    """The codec of the output files, "gzip", "zstd" or "lz4" with an optional level, e.g. "gzip:9" or "zstd:10\""""
+    return 'gzip'
+
+
+def compression_workers() -> int:
+    """The number of threads that compress output files, separate from the download threads"""
+    return 4
+
+
+def lease_timeout() -> int:
+    """The seconds after which a job of a worker that stopped sending heartbeats is given to another worker"""
+    return 300
+
+
+def requests_per_minute() -> int:
+    """The maximum number of report submissions, status polls and downloads per minute"""
+    return 120
+
+
+def max_pending_reports() -> int:
+    """The maximum number of reports that are generated or downloaded at the same time, 0 for no limit"""
+    return 10
+
+
+def throttling_pause() -> int:
+    """The seconds all calls are paused when Bing reports that too many calls were made"""
+    return 60
+
+
+def wsdl_cache_dir() -> str:
+    """The directory in which the parsed service definitions of the Bing API are cached between runs"""
+    return '~/.cache/bingads-performance-downloader'
+
+
+def wsdl_cache_days() -> int:
+    """The number of days after which the cached service definitions are downloaded again"""
+    return 30
+
+
+def index_suffix() -> str:
+    """The suffix of the sidecar index of every performance file, with which queries skip blocks, empty for none"""
+    return '.index.json'
+
+
+def compaction_period() -> str:
+    """The files into which `compact` merges the days before the overwrite window, "month" or "year" files"""
+    return 'month'
+
+
+def metrics_file() -> str:
+    """The JSON lines file in the data directory to which the phase timings of every report are appended"""
+    return 'bing-metrics.jsonl'
+
+
+def prometheus_textfile() -> str:
+    """A file to which the metrics of a run are written in the Prometheus text format, e.g. for the node exporter"""
+    return ''
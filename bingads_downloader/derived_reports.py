@@ -0,0 +1,106 @@
+"""
+Reports that are built from another downloaded report instead of being requested from Bing,
+e.g. the campaign performance report, which is the ad performance report summed up by campaign.
+"""
+
+import datetime
+import decimal
+from pathlib import Path
+
+from bingads_downloader import config
+from bingads_downloader.report_file import NULL_VALUES, ReportReader, open_report_file, parse_report_date, write_report
+from bingads_downloader.reports import REPORTS
+
+# The reports that can be derived, of the form {report: report from which it is derived}
+DERIVABLE_REPORTS = {'campaign': 'ad'}
+
+
+def derived_reports() -> {str: str}:
+    """
+    Returns the reports that are derived instead of requested according to config.campaign_report_source()
+    Returns:
+        A dictionary of the form {report: report from which it is derived}
+    """
+    if config.campaign_report_source() == 'api':
+        return {}
+    if config.campaign_report_source() != 'ad_report':
+        raise ValueError('Unknown campaign report source "{}"'.format(config.campaign_report_source()))
+    return DERIVABLE_REPORTS
+
+
+def derive_campaign_report(ad_report_paths: [Path], target_file_path: Path,
+                           campaign_labels: {str: str}) -> {(datetime.date, str): decimal.Decimal}:
+    """
+    Sums up the spend of ad performance reports by day and campaign into a campaign performance report in the
+    layout of Bing, with the preamble and footer of the first ad report. The reports are validated while they are
+    read, the rows are aggregated in memory (one per day and campaign).
+    Args:
+        ad_report_paths: ad performance reports, e.g. the zip archives of all shards of a job
+        target_file_path: the campaign performance report to write as plain CSV
+        campaign_labels: the label strings of the account structure snapshot, of the form {campaign_id: labels}
+    Returns:
+        The spend of every campaign, of the form {(day, campaign_id): spend}
+    """
+    ad_columns = REPORTS['ad'].columns
+    time_period, account_id, account_name, campaign_id, campaign_name, spend = (
+        ad_columns.index(column)
+        for column in ('TimePeriod', 'AccountId', 'AccountName', 'CampaignId', 'CampaignName', 'Spend'))
+
+    campaigns = {}  # {(time period, account id, campaign id): [account name, campaign name, spend]}
+    preamble, footer = None, None
+    for ad_report_path in ad_report_paths:
+        with open_report_file(ad_report_path) as f:
+            reader = ReportReader(f, ad_columns)
+            for row in reader:
+                campaign = campaigns.setdefault((row[time_period], row[account_id], row[campaign_id]),
+                                                [row[account_name], row[campaign_name], decimal.Decimal(0)])
+                campaign[2] += _to_decimal(row[spend])
+            preamble, footer = preamble or reader.preamble, footer or reader.footer
+
+    report = REPORTS['campaign']
+
+    def campaign_row(key: tuple, values: list) -> [str]:
+        day, account, campaign = key
+        row = {'TimePeriod': day, 'AccountId': account, 'AccountName': values[0], 'CampaignId': campaign,
+               'CampaignName': values[1], 'CampaignLabels': campaign_labels.get(campaign, ''), 'Spend': str(values[2])}
+        return [row[column] for column in report.columns]
+
+    rows = [campaign_row(key, values) for key, values in campaigns.items()]
+    preamble = [['Report Name: {}'.format(report.report_name)] if i == 0
+                else ['Rows: {}'.format(len(rows))] if line and line[0].startswith('Rows:') else line
+                for i, line in enumerate(preamble)]
+    with open(str(target_file_path), 'w', encoding='utf-8', newline='') as output:
+        write_report(output, preamble, list(report.columns), rows, footer)
+
+    return {(parse_report_date(day), campaign): total for (day, _, campaign), (_, _, total) in campaigns.items()}
+
+
+def campaign_spend(campaign_report_paths: [Path]) -> {(datetime.date, str): decimal.Decimal}:
+    """Returns the spend of campaign performance reports as {(day, campaign_id): spend}"""
+    columns = REPORTS['campaign'].columns
+    time_period, campaign_id, spend = (columns.index(column) for column in ('TimePeriod', 'CampaignId', 'Spend'))
+    totals = {}
+    for campaign_report_path in campaign_report_paths:
+        with open_report_file(campaign_report_path) as f:
+            for row in ReportReader(f, columns):
+                key = (parse_report_date(row[time_period]), row[campaign_id])
+                totals[key] = totals.get(key, decimal.Decimal(0)) + _to_decimal(row[spend])
+    return totals
+
+
+def spend_differences(derived: {tuple: decimal.Decimal}, requested: {tuple: decimal.Decimal}) -> {tuple: tuple}:
+    """
+    Compares derived and requested spend per day and campaign, allowing for rounding of 0.1% or at least a cent
+    Returns:
+        The differing totals, of the form {(day, campaign_id): (derived spend, requested spend)}
+    """
+    differences = {}
+    for key in set(derived) | set(requested):
+        derived_total, requested_total = derived.get(key, decimal.Decimal(0)), requested.get(key, decimal.Decimal(0))
+        if abs(derived_total - requested_total) > max(decimal.Decimal('0.01'), abs(requested_total) / 1000):
+            differences[key] = (derived_total, requested_total)
+    return differences
+
+
+def _to_decimal(value: str) -> decimal.Decimal:
+    return decimal.Decimal(0) if value in NULL_VALUES else decimal.Decimal(value.replace(',', ''))
@@ -1,29 +1,55 @@
 import csv
 import datetime
 import errno
-import gzip
-import json
 import os
-import re
+import random
 import shutil
 import sys
 import tempfile
-import urllib
-import webbrowser
+import threading
+import time
+import zipfile
+import zlib
+from functools import partial
 from pathlib import Path
+from typing import Iterator, NamedTuple
 
 from bingads import (AuthorizationData, OAuthAuthorization, OAuthDesktopMobileAuthCodeGrant,
                      OAuthTokenRequestException)
+from bingads.exceptions import TimeoutException
 from bingads.service_client import ServiceClient
-from bingads.v13.reporting.reporting_service_manager import ReportingServiceManager, time
+from bingads.v13.reporting.reporting_operation_status import ReportingOperationStatus
 from suds import WebFault
 
 from bingads_downloader import config
+from bingads_downloader.columnar import normalization_schema, output_formats, outputs_exist, write_columnar_outputs
+from bingads_downloader.compaction import compacted_day
+from bingads_downloader.compression import compress_file, csv_file_name, open_compressed
+from bingads_downloader.derived_reports import (campaign_spend, derive_campaign_report, derived_reports,
+                                                spend_differences)
+from bingads_downloader.file_index import FileIndexBuilder, write_file_index
+from bingads_downloader.labels import LabelExpansion, label_columns, label_values, labels_json, merged_attributes
+from bingads_downloader.manifest import download_manifest
+from bingads_downloader.metrics import metrics, timed, write_run_metrics
+from bingads_downloader.polling import report_poller
+from bingads_downloader.profiling import startup_profile
+from bingads_downloader.rate_limit import rate_limiter
+from bingads_downloader.report_file import (ReportReader, ReportValidationError, TruncatedReportError, merge_reports,
+                                            open_report_file, split_report_by_day)
+from bingads_downloader.reports import REPORTS, RequestTemplates, daily_reports
+from bingads_downloader.retries import (AUTH, PERMANENT, THROTTLED, TRANSIENT, BingUnavailableError, backoff_seconds,
+                                         circuit_breaker, classify_error)
+from bingads_downloader.scheduler import run_jobs
+from bingads_downloader.token_cache import TokenRefresher, cached_authentication, token_cache
+from bingads_downloader.transport import RequestsTransport, connection_statistics, create_session, wsdl_cache
+from bingads_downloader.work_queue import Heartbeat, leased_jobs, work_queue
 
 
 class BingReportClient(ServiceClient):
     """
-    A client for downloading data from the Bing Ads API
+    A client for downloading data from the Bing Ads API.
+    All service calls and report downloads of a run share one keep-alive HTTP session. As suds clients keep
+    the state of a call, every download thread makes its service calls with a service client of its own.
     """
 
     def __init__(self):
@@ -36,21 +62,127 @@ class BingReportClient(ServiceClient):
                                              ),
         )
 
+        self.session = create_session(max_connections=int(config.max_concurrent_reports()) + 2)
+        self.token_refresher = None
+        self._thread_clients = threading.local()
         self.client = super(BingReportClient, self).__init__(service='ReportingService',
                                                              authorization_data=authorization_data,
-                                                             environment='production', version='v13')
-
-
-def download_data():
+                                                             environment='production', version='v13',
+                                                             transport=self._transport(),
+                                                             cache=wsdl_cache())
+        self.request_templates = RequestTemplates(self.factory)
+
+    def submit_report(self, report_request) -> 'ReportOperation':
+        """Submits a report request and returns the operation for tracking its status"""
+        request_id = rate_limiter().call('submit', partial(self._call_service, 'SubmitGenerateReport', report_request))
+        return ReportOperation(self, request_id)
+
+    def poll_report(self, request_id: str):
+        """Returns the ReportRequestStatus of a submitted report"""
+        return rate_limiter().call('poll', partial(self._call_service, 'PollGenerateReport', request_id))
+
+    def _call_service(self, operation: str, *args):
+        return getattr(self._thread_client(), operation)(*args)
+
+    def _thread_client(self) -> ServiceClient:
+        """Returns the service client of the current thread, which shares the session and authorization data"""
+        client = getattr(self._thread_clients, 'client', None)
+        if client is None:
+            client = ServiceClient(service='ReportingService', authorization_data=self.authorization_data,
+                                   environment='production', version='v13', transport=self._transport(),
+                                   cache=wsdl_cache())
+            self._thread_clients.client = client
+        return client
+
+    def _transport(self) -> RequestsTransport:
+        return RequestsTransport(self.session, timeout=float(config.service_timeout()))
+
+    def download_report(self, url: str, file_path: Path, keep_archive: bool) -> Path:
+        """
+        Downloads a generated report and extracts the CSV file from the zip archive sent by Bing
+        Args:
+            url: the download url of the report
+            file_path: where to store the report
+            keep_archive: whether to store the zip archive instead of compressing the CSV file with the configured
+                          codec, for reports that are read only once
+        Returns:
+            The path of the downloaded file
+        """
+        zip_file_path = file_path if keep_archive else file_path.with_name(file_path.name + '.zip')
+        response = rate_limiter().call('download', partial(self._get, url))
+        try:
+            with open(str(zip_file_path), 'wb') as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+            if not keep_archive:
+                with zipfile.ZipFile(str(zip_file_path)) as archive, \
+                        archive.open(archive.namelist()[0]) as csv_file:
+                    compress_file(csv_file, file_path)
+        except (zipfile.BadZipFile, EOFError, zlib.error) as error:
+            raise TruncatedReportError('The report archive from {} is incomplete: {}'.format(url, error))
+        finally:
+            if not keep_archive and zip_file_path.exists():
+                os.remove(str(zip_file_path))
+        return file_path
+
+    def _get(self, url: str):
+        response = self.session.get(url, stream=True, timeout=int(config.timeout()) / 1000.0)
+        response.raise_for_status()
+        return response
+
+
+class ReportOperation:
+    """A report that has been submitted for generation"""
+
+    def __init__(self, api_client: BingReportClient, request_id: str):
+        self.api_client = api_client
+        self.request_id = request_id
+        self.final_status = None
+
+    def get_status(self) -> ReportingOperationStatus:
+        """Polls the generation status of the report, once it succeeded or failed the final status is kept"""
+        if self.final_status is not None:
+            return self.final_status
+        response = self.api_client.poll_report(self.request_id)
+        status = ReportingOperationStatus(status=response.Status, report_download_url=response.ReportDownloadUrl)
+        if status.status in ('Success', 'Error'):
+            self.final_status = status
+        return status
+
+
+def download_data(worker: bool = False):
     """
     Creates an BingApiClient and downloads the data
+    Args:
+        worker: whether to take jobs from the work queue of the data directory together with other workers
     """
+    success, api_client = False, None
     try:
-        api_client = BingReportClient()
-        download_data_sets(api_client)
+        with startup_profile().phase('create service client'):
+            api_client = BingReportClient()
+        startup_profile().note('create service client', '{} WSDL cache hits, {} misses'
+                               .format(wsdl_cache().hits, wsdl_cache().misses))
+        if worker:
+            print('Output formats: {}'.format(', '.join(output_formats())))
+            with startup_profile().phase('authenticate'):
+                authenticate_with_oauth(api_client)
+            download_data_as_worker(api_client)
+        else:
+            download_data_sets(api_client)
+        print('HTTP connections: {} opened, {} reused'.format(*connection_statistics(api_client.session)))
+        print('Rate limit: {}'.format(rate_limiter().statistics()))
+        if circuit_breaker().paused_seconds:
+            print('Jobs waited {:.0f} seconds for the circuit breaker'.format(circuit_breaker().paused_seconds))
+        if startup_profile().enabled:
+            print('Startup profile:\n{}'.format(startup_profile().report()))
+        success = True
     except WebFault as e:
         print(e.fault)
         raise
+    finally:
+        if api_client is not None and api_client.token_refresher is not None:
+            api_client.token_refresher.stop()
+        write_run_metrics(success)
 
 
 def download_data_sets(api_client: BingReportClient):
@@ -60,455 +192,610 @@ def download_data_sets(api_client: BingReportClient):
             api_client: BingAdsApiClient
     """
 
-    authenticate_with_oauth(api_client)
+    print('Output formats: {}'.format(', '.join(output_formats())))
+    with startup_profile().phase('authenticate'):
+        authenticate_with_oauth(api_client)
     download_account_structure_data(api_client)
     download_performance_data(api_client)
 
 
 def download_account_structure_data(api_client: BingReportClient):
     """
-    Downloads the marketing structure for all accounts
+    Downloads the marketing structure for all accounts.
+    Ads and campaign labels are merged into the account structure snapshot of the download manifest,
+    from which the structure file is rewritten. Between full refreshes, only ads and campaigns with
+    activity in the last config.account_structure_refresh_days() are requested.
         Args:
          api_client: BingAdsApiClient
     """
 
-    filename = Path('bing-account-structure_{}.csv.gz'.format(config.output_file_version()))
+    filename = Path(csv_file_name('bing-account-structure_{}'.format(config.output_file_version())))
     filepath = ensure_data_directory(filename)
-    print('Start downloading account structure in {}'.format(str(filename)))
+    manifest = download_manifest()
+
+    full_refresh = account_structure_full_refresh_due(manifest, filepath)
+    if full_refresh:
+        start_date = None
+        print('Start downloading account structure in {}'.format(str(filename)))
+    else:
+        start_date = datetime.datetime.now() - datetime.timedelta(days=int(config.account_structure_refresh_days()))
+        print('Start updating account structure in {} with ads since {:%Y-%m-%d}'.format(str(filename), start_date))
+
     with tempfile.TemporaryDirectory() as tmp_dir:
+        campaign_labels = get_campaign_labels(api_client, tmp_dir, start_date)
+        manifest.update_structure(get_ad_data(api_client, tmp_dir, start_date), campaign_labels,
+                                  replace=full_refresh)
+        if full_refresh:
+            manifest.set_state('account_structure_full_refresh', datetime.datetime.now().isoformat())
+
         tmp_filepath = Path(tmp_dir, filename)
-        with gzip.open(str(tmp_filepath), 'wt') as tmp_campaign_structure_file:
+        with open_compressed(tmp_filepath, 'wt') as tmp_campaign_structure_file:
+            columns = label_columns()
             header = ['AdId', 'AdTitle', 'AdGroupId', 'AdGroupName', 'CampaignId',
-                      'CampaignName', 'AccountId', 'AccountName', 'Attributes']
+                      'CampaignName', 'AccountId', 'AccountName', 'Attributes'] + [column.name for column in columns]
             writer = csv.writer(tmp_campaign_structure_file, delimiter="\t")
-            ad_data = get_ad_data(api_client, tmp_dir)
-            campaign_attributes = get_campaign_attributes(api_client, tmp_dir)
             writer.writerow(header)
-            for ad_id, ad_data_dict in ad_data.items():
-                campaign_id = ad_data_dict['CampaignId']
-                ad_group_id = ad_data_dict['AdGroupId']
-                attributes = {**campaign_attributes.get(campaign_id, {}),
-                              **ad_data_dict['attributes']}
-                ad = [str(ad_id),
-                      ad_data_dict['AdTitle'],
-                      str(ad_group_id),
-                      ad_data_dict['AdGroupName'],
-                      str(campaign_id),
-                      ad_data_dict['CampaignName'],
-                      ad_data_dict['AccountId'],
-                      ad_data_dict['AccountName'],
-                      json.dumps(attributes)
-                      ]
-
-                writer.writerow(ad)
+            for ad, campaign_attributes, ad_attributes in manifest.structure():
+                attributes, attributes_json = merged_attributes(campaign_attributes, ad_attributes)
+                writer.writerow(ad + [attributes_json] + label_values(attributes, columns))
 
         shutil.move(str(tmp_filepath), str(filepath))
+    write_columnar_outputs('account_structure', filepath)
 
 
-def get_ad_data(api_client: BingReportClient, tmp_dir: Path) -> {}:
-    """Downloads the ad data from the Bing AdWords API
+def account_structure_full_refresh_due(manifest, filepath: Path) -> bool:
+    """
+    Decides whether the account structure needs to be requested for all days since config.first_date()
+    Args:
+        manifest: the download manifest
+        filepath: the account structure file, which is only kept next to its Parquet file for CSV output
+    Returns:
+        False when the structure can be updated with only the recent days
+    """
+    if int(config.account_structure_refresh_days()) <= 0 or not outputs_exist(filepath):
+        return True
+    last_full_refresh = manifest.get_state('account_structure_full_refresh')
+    if last_full_refresh is None:
+        return True
+    age = datetime.datetime.now() - datetime.datetime.fromisoformat(last_full_refresh)
+    return age.days >= int(config.account_structure_full_refresh_interval())
+
+
+def get_ad_data(api_client: BingReportClient, tmp_dir: Path, start_date: datetime = None) -> Iterator[dict]:
+    """Downloads the ad data from the Bing AdWords API, then returns a reader of the downloaded report, so that
+    the report is generated and downloaded before the rows are merged into the account structure snapshot
     Args:
         api_client: BingAdsApiClient
         tmp_dir: path to write the temp file in
+        start_date: the first day for which ads are requested, config.first_date() when not set
     Returns:
-        A dictionary of the form {ad_id: {key: value}}
+        A generator of dictionaries of the form {key: value}, one for each row of the report, with the labels
+        as JSON in 'attributes'. As the report is aggregated by year and device type, an ad can appear several times.
     """
-    ad_data = {}
-    fields = ["TimePeriod",
-              "DeviceType",
-
-              "AccountId",
-              "AccountName",
-              "AccountNumber",
-              "AccountStatus",
-
-              "CampaignId",
-              "CampaignName",
-              "CampaignStatus",
-
-              "AdGroupId",
-              "AdGroupName",
-              "AdGroupStatus",
-
-              "AdId",
-              "AdTitle",
-              "AdDescription",
-              "AdType",
-              "AdLabels",
-
-              "Impressions"]  # need to include impressions, otherwise API call fails??
-    report_request_ad = build_ad_performance_request(api_client, current_date=None, fields=fields, all_time=True)
+    report_request_ad = api_client.request_templates.build('ad_account_structure', first_date=start_date)
 
     report_file_location = submit_and_download(report_request_ad, api_client, str(tmp_dir),
-                                               'ad_account_structure_{}.csv'.format(config.output_file_version()),
-                                               overwrite_if_exists=True, decompress=True)
+                                               '{}.zip'.format(REPORTS['ad_account_structure'].file_name),
+                                               overwrite_if_exists=True, keep_archive=True,
+                                               report='ad_account_structure')
+    if report_file_location is None:
+        return iter([])
+    return read_ad_data(Path(report_file_location))
 
-    with open(report_file_location, 'r') as f:
-        for i in range(11):  # skip header lines
-            next(f)
-        reader = csv.reader(f)
-        report_data = list(reader)
 
+def read_ad_data(report_file_location: Path) -> Iterator[dict]:
+    """Reads the downloaded ad data row by row, see get_ad_data"""
+    fields = REPORTS['ad_account_structure'].columns
     relevant_columns = ['AdId', 'AdTitle', 'AdGroupId', 'AdGroupName', 'CampaignId', 'CampaignName', 'AccountId',
                         'AccountName']
     positions = [fields.index(name) for name in relevant_columns]
+    labels_position = fields.index('AdLabels')
 
-    relevant_columns.extend(['attributes'])
-    for row in report_data[:-2]:
-        attributes = parse_labels(row[fields.index("AdLabels")])
-        new_row = [row[i] for i in positions]
-        new_row.extend([attributes])
-        ad_data[row[fields.index("AdId")]] = {key: value for key, value in zip(relevant_columns, new_row)}
+    with open_report_file(report_file_location) as f:
+        for row in ReportReader(f, fields):
+            ad_data_dict = {key: row[i] for key, i in zip(relevant_columns, positions)}
+            ad_data_dict['attributes'] = labels_json(row[labels_position])
+            yield ad_data_dict
 
-    return ad_data
 
-
-def get_campaign_attributes(api_client: BingReportClient, tmp_dir: Path) -> {}:
-    """Downloads the campaign attributes from the Bing AdWords API
+def get_campaign_labels(api_client: BingReportClient, tmp_dir: Path, start_date: datetime = None) -> {}:
+    """Downloads the campaign labels from the Bing AdWords API
     Args:
         api_client: BingAdsApiClient
         tmp_dir: path to write the temp file in
+        start_date: the first day for which campaigns are requested, config.first_date() when not set
     Returns:
-        A dictionary of the form {campaign_id: {key: value}}
+        A dictionary of the form {campaign_id: labels} with the label strings as sent by Bing, see labels.parse_labels
     """
     campaign_labels = {}
-    fields = ["TimePeriod",
+    fields = REPORTS['campaign_labels'].columns
+    report_request_campaign = api_client.request_templates.build('campaign_labels', first_date=start_date)
 
-              "AccountId",
-              "AccountName",
-              "CampaignId",
-              "CampaignName",
-              "CampaignLabels",
+    report_file_location = submit_and_download(report_request_campaign, api_client, str(tmp_dir),
+                                               '{}.zip'.format(REPORTS['campaign_labels'].file_name),
+                                               overwrite_if_exists=True, keep_archive=True, report='campaign_labels')
+    if report_file_location is None:
+        return campaign_labels
 
-              "Spend"]  # fails without adding spend
-    report_request_campaign = build_campaign_performance_request(api_client, current_date=None,
-                                                                 fields=fields, all_time=True)
+    with open_report_file(Path(report_file_location)) as f:
+        for row in ReportReader(f, fields):
+            campaign_labels[row[fields.index("CampaignId")]] = row[fields.index("CampaignLabels")]
 
-    report_file_location = submit_and_download(report_request_campaign, api_client, str(tmp_dir),
-                                               'campaign_labels_{}.csv'.format(config.output_file_version()),
-                                               overwrite_if_exists=True, decompress=True)
+    return campaign_labels
 
-    with open(report_file_location, 'r') as f:
-        for i in range(11):  # skip header lines
-            next(f)
-        reader = csv.reader(f)
-        report_data = list(reader)
 
-    for row in report_data[:-2]:
-        attributes = parse_labels(row[fields.index("CampaignLabels")])
-        campaign_labels[row[fields.index("CampaignId")]] = attributes
+class ReportJob(NamedTuple):
+    """A single performance report for a single day or a range of days"""
+    first_date: datetime.datetime
+    last_date: datetime.datetime
+    report: str
+
+    def days(self) -> [datetime.datetime]:
+        """All days covered by the job"""
+        return [self.first_date + datetime.timedelta(days=i)
+                for i in range((self.last_date - self.first_date).days + 1)]
+
+    def __str__(self):
+        if self.first_date == self.last_date:
+            return '{} data for {:%Y-%m-%d}'.format(self.report, self.first_date)
+        return '{} data for {:%Y-%m-%d} - {:%Y-%m-%d}'.format(self.report, self.first_date, self.last_date)
+
+
+class ReportShard(NamedTuple):
+    """A part of the accounts (or of the campaigns of a single account) that is requested in one report"""
+    number: tuple
+    account_ids: tuple
+    campaign_ids: tuple = ()
+
+    def split(self) -> ['ReportShard']:
+        """
+        Splits the shard into two halves, first by accounts and then by the campaigns of the account snapshot
+        Returns:
+            The two smaller shards, or an empty list when the shard can not be split further
+        """
+        if len(self.account_ids) > 1:
+            parts = [ReportShard(self.number, account_ids, ()) for account_ids in _halves(self.account_ids)]
+        else:
+            campaign_ids = self.campaign_ids or tuple(download_manifest().campaign_ids(self.account_ids[0]))
+            if len(campaign_ids) < 2:
+                return []
+            parts = [ReportShard(self.number, self.account_ids, part) for part in _halves(campaign_ids)]
+        return [shard._replace(number=self.number + (i,)) for i, shard in enumerate(parts)]
+
+    def __str__(self):
+        if self.campaign_ids:
+            return '{} campaigns of account {}'.format(len(self.campaign_ids), self.account_ids[0])
+        return 'account{} {}'.format('s' if len(self.account_ids) > 1 else '', ', '.join(self.account_ids))
+
+
+def _halves(values: tuple) -> [tuple]:
+    return [values[:len(values) // 2], values[len(values) // 2:]]
 
-    return campaign_labels
+
+def report_shards() -> [ReportShard]:
+    """Splits the distinct accounts of config.oauth2_account_array() into shards of config.accounts_per_shard()"""
+    account_ids = tuple(dict.fromkeys(str(account_id) for account_id in config.oauth2_account_array()))
+    size = int(config.accounts_per_shard()) or len(account_ids)
+    return [ReportShard((i,), account_ids[start:start + size])
+            for i, start in enumerate(range(0, len(account_ids), size))]
+
+
+def performance_reports() -> {str: str}:
+    """
+    Returns the performance reports that are downloaded for every day
+    Returns:
+        A dictionary of the form {report name: output file name}
+    """
+    return {report: csv_file_name('{}_{}'.format(REPORTS[report].file_name, config.output_file_version()))
+            for report in daily_reports()}
+
+
+def performance_file_path(date: datetime, report: str) -> Path:
+    """The path of the file that contains a performance report for a single day, relative to the data directory"""
+    return Path('{date:%Y/%m/%d}/bing/'.format(date=date), performance_reports()[report])
 
 
 def download_performance_data(api_client: BingReportClient):
     """
     Downloads BingAds Ads performance reports by creating report objects
-    for every day since config.first_date() till today
+    for every day since config.first_date() till today.
+    Up to config.max_concurrent_reports() jobs are downloaded at the same time.
         Args:
          api_client: BingAdsApiClient
     """
-    first_date = datetime.datetime.strptime(config.first_date(), '%Y-%m-%d')
-    last_date = datetime.datetime.now() - datetime.timedelta(days=1)
+    first_date, last_date = performance_date_range()
+    run_jobs(partial(download_performance_job, api_client, last_date),
+             performance_jobs(first_date, last_date), int(config.max_concurrent_reports()))
+
+
+def performance_date_range() -> (datetime.datetime, datetime.datetime):
+    """Returns the first and the last day of the performance reports"""
+    return (datetime.datetime.strptime(config.first_date(), '%Y-%m-%d'),
+            datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=1), datetime.time()))
+
+
+def performance_jobs(first_date: datetime, last_date: datetime) -> Iterator[ReportJob]:
+    """
+    Plans the jobs of all days that need to be downloaded, starting with the most recent day.
+    Days of the 31 day overwrite window are downloaded unless they are older than config.min_overwrite_days()
+    and did not change in the last config.stable_runs() downloads. Missing days before the window are requested
+    in batches of config.report_batch_days() consecutive days. Derived reports get no jobs of their own, the
+    days of the report they are derived from are downloaded until the files of both are complete and stable.
+    Args:
+        first_date: the first day to download
+        last_date: the most recent day to download
+    Returns:
+        A generator of report jobs
+    """
+    batch_days = max(1, int(config.report_batch_days()))
+    min_overwrite_days = int(config.min_overwrite_days())
+    min_stable_runs = int(config.stable_runs())
+
+    manifest = download_manifest()
+    states = manifest.states()
+    stable_runs = manifest.stable_runs()
+    print('{} performance files are complete according to the download manifest'
+          .format(sum(1 for status in states.values() if status == 'complete')))
+
+    derived = derived_reports()
+
+    def with_derived(report: str) -> [str]:
+        return [report] + [derived_report for derived_report, source in derived.items() if source == report]
+
+    def is_stable(date: datetime, report: str) -> bool:
+        return min_stable_runs > 0 and (last_date - date).days >= min_overwrite_days \
+               and all(stable_runs.get((date.date(), output), 0) >= min_stable_runs
+                       and outputs_exist(Path(config.data_dir(), performance_file_path(date, output)))
+                       for output in with_derived(report))
+
+    def is_complete(date: datetime, report: str) -> bool:
+        return all(is_file_complete(date, output) for output in with_derived(report))
+
+    def is_file_complete(date: datetime, report: str) -> bool:
+        status = states.get((date.date(), report))
+        if status is None:
+            file_path = Path(config.data_dir(), performance_file_path(date, report))
+            if file_path.exists():  # written by a run before the manifest existed
+                manifest.adopt(date, report, file_path)
+                return True
+            return compacted_day(date.date(), report) is not None
+        return status == 'complete'
+
+    batches = {report: [] for report in performance_reports() if report not in derived}
     current_date = last_date
-    remaining_attempts = config.total_attempts_for_single_day
     while current_date >= first_date:
-        print(current_date)
-        relative_filepath = Path('{date:%Y/%m/%d}/bing/'.format(
-            date=current_date))
-        filepath = ensure_data_directory(relative_filepath)
-
-        overwrite_if_exists = (last_date - current_date).days < 31
-        if overwrite_if_exists:
-            print('The data for {date:%Y-%m-%d} will be downloaded. Already present files will be overwritten'.format(
-                date=current_date))
-        report_request_ad = build_ad_performance_request(api_client, current_date)
-        report_request_keyword = build_keyword_performance_request(api_client, current_date)
-        report_request_campaign = build_campaign_performance_request(api_client, current_date)
-
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            tmp_filepath = Path(tmp_dir, relative_filepath)
-            tmp_filepath.parent.mkdir(exist_ok=True, parents=True)
+        for report, batch in batches.items():
+            if (last_date - current_date).days < 31:
+                if not is_stable(current_date, report):
+                    yield ReportJob(current_date, current_date, report)
+            elif is_complete(current_date, report):
+                if batch:
+                    yield ReportJob(batch[-1], batch[0], report)
+                    batch.clear()
+            else:
+                batch.append(current_date)
+                if len(batch) == batch_days:
+                    yield ReportJob(batch[-1], batch[0], report)
+                    batch.clear()
+        current_date -= datetime.timedelta(days=1)
+    for report, batch in batches.items():
+        if batch:
+            yield ReportJob(batch[-1], batch[0], report)
+
+
+def download_data_as_worker(api_client: BingReportClient):
+    """
+    Downloads performance reports as one of several workers that share the data directory.
+    The first worker of a day plans the jobs into the work queue and updates the account structure, while the
+    other workers wait for it, then all workers take jobs from the queue until none are left.
+        Args:
+         api_client: BingAdsApiClient
+    """
+    first_date, last_date = performance_date_range()
+    queue = work_queue()
+    plan = '{:%Y-%m-%d}_{}'.format(last_date, config.output_file_version())
+    if queue.plan(plan, lambda: performance_jobs(first_date, last_date)):
+        print('Worker {} planned {} jobs'.format(queue.worker, sum(queue.counts(plan).values())))
+
+    def download_leased_job(leased_job: tuple):
+        job_id, job_first_date, job_last_date, report = leased_job
+        job = ReportJob(datetime.datetime.strptime(job_first_date, '%Y-%m-%d'),
+                        datetime.datetime.strptime(job_last_date, '%Y-%m-%d'), report)
+        try:
+            download_performance_job(api_client, last_date, job)
+        except BaseException as error:
+            queue.finish(job_id, error)
+            if not isinstance(error, Exception) or isinstance(error, BingUnavailableError):
+                raise
+            # only this job failed, it is handed back to the queue and the worker goes on with the next one
+            print('Worker {} failed to download the {} report of {:%Y-%m-%d} - {:%Y-%m-%d}: {!r}'
+                  .format(queue.worker, report, job.first_date, job.last_date, error), file=sys.stderr)
+            return
+        queue.finish(job_id)
+
+    with Heartbeat(queue):
+        queue.prepare(plan, partial(download_account_structure_data, api_client))
+        run_jobs(download_leased_job, leased_jobs(queue, plan), int(config.max_concurrent_reports()))
+    counts = queue.counts(plan)
+    print('Worker {} finished, jobs of the queue: {}'
+          .format(queue.worker, ', '.join('{} {}'.format(count, status) for status, count in sorted(counts.items()))))
+    if counts.get('failed'):
+        raise RuntimeError('{} jobs of the work queue failed'.format(counts['failed']))
+
+
+def download_performance_job(api_client: BingReportClient, last_date: datetime, job: ReportJob):
+    """
+    Downloads a single performance report, retrying after transient errors and throttling (see retries) with
+    exponential backoff, only the shards that failed are requested again.
+    Reports that are derived from it, e.g. the campaign report from the ad report, are written together with it.
+    The files of the job are marked as started in the download manifest before the download
+    and as complete afterwards.
+        Args:
+         api_client: BingAdsApiClient
+         last_date: the most recent day that is downloaded
+         job: the days and report to download
+    """
+    if (last_date - job.last_date).days < 31:
+        print('The {job} will be downloaded. Already present files will be replaced if they changed'.format(job=job))
+
+    jobs = [job] + [job._replace(report=report) for report, source in derived_reports().items()
+                    if source == job.report]
+    manifest = download_manifest()
+    for output_job in jobs:
+        for day in output_job.days():
+            manifest.start(day, output_job.report)
+
+    job_start_time = time.time()
+    timings = {}
+    retries = 0
+    remaining_attempts = int(config.total_attempts_for_single_day())
+    renewed_token = False
+    file_indexes = {}  # {file path: index collected while the file was written}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        downloaded_shards = {}  # kept across attempts, so that only the shards that failed are requested again
+        while True:
             try:
+                circuit_breaker().wait()
                 start_time = time.time()
-                print('About to download ad data for {date:%Y-%m-%d}'
-                      .format(date=current_date))
-                submit_and_download(report_request_ad, api_client, str(filepath),
-                                    'ad_performance_{}.csv.gz'.format(config.output_file_version()),
-                                    overwrite_if_exists)
-                print('Successfully downloaded ad data for {date:%Y-%m-%d} in {elapsed:.1f} seconds'
-                      .format(date=current_date, elapsed=time.time() - start_time))
-                start_time = time.time()
-                print('About to download keyword data for {date:%Y-%m-%d}'
-                      .format(date=current_date))
-                submit_and_download(report_request_keyword, api_client, str(filepath),
-                                    'keyword_performance_{}.csv.gz'.format(config.output_file_version()),
-                                    overwrite_if_exists)
-                print('Successfully downloaded keyword data for {date:%Y-%m-%d} in {elapsed:.1f} seconds'
-                      .format(date=current_date, elapsed=time.time() - start_time))
-                print('About to download campaign data for {date:%Y-%m-%d}'
-                      .format(date=current_date))
-                submit_and_download(report_request_campaign, api_client, str(filepath),
-                                    'campaign_performance_{}.csv.gz'.format(config.output_file_version()),
-                                    overwrite_if_exists)
-                print('Successfully downloaded campaign data for {date:%Y-%m-%d} in {elapsed:.1f} seconds'
-                      .format(date=current_date, elapsed=time.time() - start_time))
-                # date is decreased only if the download above does not fail
-                current_date -= datetime.timedelta(days=1)
-                remaining_attempts = config.total_attempts_for_single_day
-            except urllib.error.URLError as url_error:
-                if remaining_attempts == 0:
-                    print('Too many failed attempts while downloading this day, quitting', file=sys.stderr)
+                print('About to download {job}'.format(job=job))
+                source_file_locations = download_performance_report(api_client, job, Path(tmp_dir),
+                                                                    downloaded_shards)
+                try:
+                    outputs = {}  # {job: ({day: content hash}, unchanged)}
+                    for output_job in jobs:
+                        report_file_locations = source_file_locations if output_job == job \
+                            else derive_performance_report(api_client, output_job, source_file_locations,
+                                                           Path(tmp_dir))
+                        with timed(timings, 'transform'):
+                            outputs[output_job] = write_performance_files(output_job, report_file_locations,
+                                                                          Path(tmp_dir), file_indexes)
+                except ReportValidationError:
+                    downloaded_shards.clear()  # the broken report may be any of the shards
                     raise
-                print('ERROR WHILE DOWNLOADING REPORT, RETRYING in {} seconds, attempt {}#...'
-                      .format(config.retry_timeout_interval, remaining_attempts), file=sys.stderr)
-                print(url_error, file=sys.stderr)
-                time.sleep(config.retry_timeout_interval)
-                remaining_attempts -= 1
-
-
-def set_report_time(api_client: BingReportClient,
-                    current_date: datetime = None, all_time: bool = False):
+                circuit_breaker().succeeded()
+                print('Successfully downloaded {job} in {elapsed:.1f} seconds'
+                      .format(job=job, elapsed=time.time() - start_time))
+                break
+            except Exception as error:
+                error_class = classify_error(error)
+                if error_class in (TRANSIENT, THROTTLED):
+                    counted = circuit_breaker().failed()
+                else:
+                    counted = True
+                    circuit_breaker().released()
+                if error_class == PERMANENT or (error_class == AUTH and renewed_token) \
+                        or circuit_breaker().exhausted or (counted and remaining_attempts == 0):
+                    print('Too many failed attempts while downloading {job}, quitting'.format(job=job)
+                          if error_class in (TRANSIENT, THROTTLED) else
+                          'A {error_class} error occurred while downloading {job}, quitting'
+                          .format(error_class=error_class, job=job), file=sys.stderr)
+                    metrics().increment('jobs', report=job.report, status='failed')
+                    metrics().record('job', report=job.report, first_date='{:%Y-%m-%d}'.format(job.first_date),
+                                     last_date='{:%Y-%m-%d}'.format(job.last_date), status='failed',
+                                     retries=retries, seconds=time.time() - job_start_time, error=repr(error),
+                                     error_class=error_class)
+                    raise
+                retries += 1
+                metrics().increment('retries', report=job.report, error_class=error_class)
+                if error_class == AUTH:
+                    print('Bing rejected the credentials while downloading {job}, renewing the access token'
+                          .format(job=job), file=sys.stderr)
+                    renew_oauth_token(api_client)
+                    renewed_token = True
+                    seconds = 0
+                elif counted:
+                    seconds = backoff_seconds(int(config.total_attempts_for_single_day()) - remaining_attempts + 1,
+                                              error_class)
+                    remaining_attempts -= 1
+                else:  # the circuit breaker pauses all jobs
+                    seconds = 0
+                print('ERROR WHILE DOWNLOADING {job}, RETRYING in {seconds:.0f} seconds, {attempts} attempts left...'
+                      .format(job=job, seconds=seconds, attempts=remaining_attempts), file=sys.stderr)
+                print(error, file=sys.stderr)
+                time.sleep(seconds)
+
+    with timed(timings, 'write'):
+        for output_job, (content_hashes, unchanged) in outputs.items():
+            for day in output_job.days():
+                file_path = Path(config.data_dir(), performance_file_path(day, output_job.report))
+                if unchanged:
+                    manifest.unchanged(day, output_job.report)
+                else:
+                    manifest.complete(day, output_job.report, file_path, content_hashes.get(day.date()))
+                    if 'csv' in output_formats():
+                        write_file_index(file_path, file_indexes.get(file_path))
+                    write_columnar_outputs(output_job.report, file_path)
+
+    unchanged = outputs[job][1]
+    metrics().observe(job.report, 'all', timings)
+    metrics().increment('jobs', report=job.report, status='unchanged' if unchanged else 'success')
+    metrics().record('job', report=job.report, first_date='{:%Y-%m-%d}'.format(job.first_date),
+                     last_date='{:%Y-%m-%d}'.format(job.last_date), status='success', unchanged=unchanged,
+                     retries=retries, seconds=time.time() - job_start_time, **timings)
+
+
+def write_performance_files(job: ReportJob, report_file_locations: [Path], tmp_dir: Path,
+                            file_indexes: {Path: FileIndexBuilder} = None) -> ({}, bool):
     """
-    Sets the report time for the BingAds API Client
+    Merges, validates, normalizes, hashes and compresses the downloaded reports of a job into its per-day files
     Args:
-        api_client: BingApiClient object
-        current_date: date for which the report object will be created
-        all_time: include all days from the import start date
+        job: the days and report of the reports
+        report_file_locations: the reports of all shards of the job
+        tmp_dir: a directory for temporary files
+        file_indexes: a dictionary to which the indexes of the written files that are collected while writing
+                      them are added, of the form {file path: index}, when the files are indexed
     Returns:
-        A report time object with a specific date
+        A tuple of a dictionary of the form {day: content hash of the rows of the per-day file} and whether
+        the file of a single day job was kept because its rows did not change
     """
-
-    report_time = api_client.factory.create('ReportTime')
-
-    custom_date_range_end = api_client.factory.create('Date')
-
-    if current_date is None:
-        current_date = datetime.datetime.now()  # for example for downloading current campaign structure
-    custom_date_range_end.Day = current_date.day
-    custom_date_range_end.Month = current_date.month
-    custom_date_range_end.Year = current_date.year
-
-    report_time.CustomDateRangeEnd = custom_date_range_end
-    if not all_time:
-        report_time.CustomDateRangeStart = custom_date_range_end
-    else:
-        first_date = datetime.datetime.strptime(config.first_date(), '%Y-%m-%d')
-        custom_date_range_start = api_client.factory.create('Date')
-        custom_date_range_start.Day = first_date.day
-        custom_date_range_start.Month = first_date.month
-        custom_date_range_start.Year = first_date.year
-        report_time.CustomDateRangeStart = custom_date_range_start
-    report_time.PredefinedTime = None
-    report_time.ReportTimeZone = None
-
-    return report_time
-
-
-def build_ad_performance_request(api_client: BingReportClient,
-                                 current_date: datetime = None,
-                                 fields: [str] = None, all_time=False):
+    columns = REPORTS[job.report].columns
+    schema = normalization_schema(job.report)
+    labels = LabelExpansion(label_columns(), REPORTS[job.report].labels, download_manifest().campaign_labels()) \
+        if label_columns() else None
+    if not report_file_locations:
+        print('No {job} available'.format(job=job))
+        return {}, False
+    indexed = file_indexes is not None and bool(config.index_suffix()) and 'csv' in output_formats()
+    if job.first_date == job.last_date:
+        filepath = ensure_data_directory(performance_file_path(job.last_date, job.report))
+        tmp_filepath = Path(tmp_dir, filepath.name)
+        file_index = FileIndexBuilder() if indexed else None
+        content_hashes = {job.last_date.date(): merge_reports(
+            report_file_locations, tmp_filepath, columns, compress=True, schema=schema, labels=labels,
+            file_index=file_index)}
+        unchanged = report_unchanged(filepath, job.last_date, job.report,
+                                     content_hashes[job.last_date.date()].hexdigest())
+        if unchanged:
+            print('The {job} did not change, keeping {file}'.format(job=job, file=filepath))
+        else:
+            shutil.move(str(tmp_filepath), str(filepath))
+            if file_index:
+                file_indexes[filepath] = file_index
+        return content_hashes, unchanged
+    target_files = {day.date(): ensure_data_directory(performance_file_path(day, job.report)) for day in job.days()}
+    day_indexes = {day: FileIndexBuilder() for day in target_files} if indexed else {}
+    content_hashes = split_report_by_day(report_file_locations, target_files, columns, schema, labels, day_indexes)
+    if indexed:
+        file_indexes.update((target_files[day], file_index) for day, file_index in day_indexes.items())
+    return content_hashes, False
+
+
+def derive_performance_report(api_client: BingReportClient, job: ReportJob, source_file_locations: [Path],
+                              tmp_dir: Path) -> [Path]:
     """
-    Creates an Ad report request object with hard coded parameters for a give date.
+    Builds the campaign report of a job from the downloaded ad reports of the same days. For a share of
+    config.campaign_report_sample() jobs, the campaign report is also requested from Bing and used instead when
+    the spend of any campaign differs.
     Args:
-        api_client: BingApiClient object
-        current_date: date for which the report object will be created
-        fields: a list of columns to download from AdPerformanceReport
-        all_time: include all days from the import start date
+        api_client: BingAdsApiClient
+        job: the days and the derived report
+        source_file_locations: the reports of all shards of the job of the source report
+        tmp_dir: a directory for temporary files
     Returns:
-        A report request object with our specific hard coded settings for a given date
-    """
-    report_request = api_client.factory.create('AdPerformanceReportRequest')
-    report_request.Format = 'Csv'
-    report_request.ReportName = 'My Ad Performance Report'
-    report_request.ReturnOnlyCompleteData = False
-    scope = api_client.factory.create('AccountThroughCampaignReportScope')
-    scope.AccountIds={'long': config.oauth2_account_array()}
-    scope.Campaigns=None
-    report_request.Scope=scope
-    if all_time:
-        report_request.Aggregation = 'Yearly'
-    else:
-        report_request.Aggregation = 'Daily'
-    #report_request.Language = 'English'
-    report_request.Time = set_report_time(api_client, current_date, all_time)
-
-    report_columns = api_client.factory.create('ArrayOfAdPerformanceReportColumn')
-    if fields is None:
-        report_columns.AdPerformanceReportColumn.append([
-            "TimePeriod",
-            "DeviceType",
-
-            "AccountId",
-            "AccountName",
-            "AccountNumber",
-            "AccountStatus",
-
-            "CampaignId",
-            "CampaignName",
-            "CampaignStatus",
-
-            "AdGroupId",
-            "AdGroupName",
-            "AdGroupStatus",
-
-            "AdId",
-            "AdTitle",
-            "AdDescription",
-            "AdType",
-            "AdLabels",
-
-            "Impressions",
-            "Clicks",
-            "Ctr",
-            "Spend",
-            "AveragePosition",
-            "Conversions",
-            "ConversionRate",
-            "CostPerConversion"
-        ])
-    else:
-        report_columns.AdPerformanceReportColumn.append(fields)
-    report_request.Columns = report_columns
-
-    return report_request
-
-
-def build_keyword_performance_request(api_client: BingReportClient,
-                                      current_date: datetime = None,
-                                      fields: [str] = None, all_time=False):
+        The paths of the reports to write the files of the job from
+    """
+    if not source_file_locations:
+        return []
+    file_path = Path(tmp_dir, '{}_derived.csv'.format(job.report))
+    derived_spend = derive_campaign_report(source_file_locations, file_path,
+                                           download_manifest().campaign_label_strings())
+    if random.random() >= float(config.campaign_report_sample()):
+        return [file_path]
+
+    requested_file_locations = download_performance_report(api_client, job, tmp_dir)
+    differences = spend_differences(derived_spend, campaign_spend(requested_file_locations))
+    metrics().increment('derived_report_checks', report=job.report, status='mismatch' if differences else 'match')
+    if not differences:
+        print('The derived {job} matches the one of Bing'.format(job=job))
+        return [file_path]
+    metrics().record('derived_report_mismatch', report=job.report, first_date='{:%Y-%m-%d}'.format(job.first_date),
+                     last_date='{:%Y-%m-%d}'.format(job.last_date), campaigns=len(differences))
+    for (day, campaign_id), (derived, requested) in sorted(differences.items())[:10]:
+        print('The spend of campaign {} on {:%Y-%m-%d} is {} in the derived {} report but {} in Bing'
+              .format(campaign_id, day, derived, job.report, requested), file=sys.stderr)
+    print('Using the {job} of Bing, the derived one differs for {count} campaigns'
+          .format(job=job, count=len(differences)), file=sys.stderr)
+    return requested_file_locations
+
+
+def report_unchanged(file_path: Path, day: datetime, report: str, content_hash: str) -> bool:
     """
-    Creates a Keyword report request object with hard coded parameters for a give date.
+    Compares the data rows of a downloaded report with those of the file that was last written for its day
     Args:
-        api_client: BingApiClient object
-        current_date: date for which the report object will be created
-        fields: a list of columns to download from AdPerformanceReport
-        all_time: include all days from the import start date
+        file_path: the output file of the day, of which the content hash is recorded in the download manifest
+        day: the day of the report
+        report: the report type
+        content_hash: the content hash of the downloaded report
     Returns:
-        A report request object with our specific hard coded settings for a given date
-    """
-    report_request = api_client.factory.create('KeywordPerformanceReportRequest')
-    report_request.Format = 'Csv'
-    report_request.ReportName = 'My Keyword Performance Report'
-    report_request.ReturnOnlyCompleteData = False
-    scope = api_client.factory.create('AccountThroughCampaignReportScope')
-    scope.AccountIds={'long': config.oauth2_account_array()}
-    scope.Campaigns=None
-    report_request.Scope=scope
-
-    if all_time:
-        report_request.Aggregation = 'Yearly'
-    else:
-        report_request.Aggregation = 'Daily'
-    #report_request.Language = 'English'
-
-    report_request.Time = set_report_time(api_client, current_date, all_time)
-
-    report_columns = api_client.factory.create('ArrayOfKeywordPerformanceReportColumn')
-    if fields is None:
-        report_columns.KeywordPerformanceReportColumn.append([
-            "TimePeriod",
-            "Network",
-            "DeviceType",
-            "BidMatchType",
-
-            "AccountId",
-            "AccountName",
-            "CampaignId",
-            "CampaignName",
-            "AdGroupId",
-            "AdGroupName",
-            "AdId",
-            "KeywordId",
-            "Keyword",
-
-            "Clicks",
-            "Impressions",
-            "Ctr",
-            "AverageCpc",
-            "Spend",
-            "QualityScore",
-            "Conversions",
-            "Revenue",
-        ])
-    else:
-        report_columns.KeywordPerformanceReportColumn.append(fields)
-    report_request.Columns = report_columns
-
-    report_sorts = api_client.factory.create('ArrayOfKeywordPerformanceReportSort')
-    report_sort = api_client.factory.create('KeywordPerformanceReportSort')
-    report_sort.SortColumn = 'Clicks'
-    report_sort.SortOrder = 'Ascending'
-    report_sorts.KeywordPerformanceReportSort.append(report_sort)
-    report_request.Sort = report_sorts
-
-    return report_request
+        True when all outputs of the day exist and contain the same rows as the downloaded report
+    """
+    if not outputs_exist(file_path):
+        return False
+    return content_hash == download_manifest().content_hash(day, report)
 
 
-def build_campaign_performance_request(api_client: BingReportClient,
-                                       current_date: datetime = None,
-                                       fields: [str] = None, all_time=False):
+def download_performance_report(api_client: BingReportClient, job: ReportJob, tmp_dir: Path,
+                                downloaded_shards: {tuple: [tuple]} = None) -> [Path]:
     """
-    Creates a Campaign report request object with hard coded parameters for a give date.
+    Downloads the report of a job in shards of accounts that are requested one after another, so that every job
+    has at most one report in flight and config.max_concurrent_reports() bounds the reports of the run.
+    Shards that time out are split into smaller shards.
     Args:
         api_client: BingApiClient object
-        current_date: date for which the report object will be created
-        fields: a list of columns to download from AdPerformanceReport
-
+        job: the days and report to download
+        tmp_dir: the directory for the downloaded shards
+        downloaded_shards: the shards of previous attempts, which are not requested again, of the form
+                           {shard number: [(number of the shard or of its parts, path)]}. Shards that are
+                           downloaded completely are added.
     Returns:
-        A report request object with our specific hard coded settings for a given date
-    """
-    report_request = api_client.factory.create('CampaignPerformanceReportRequest')
-    report_request.Format = 'Csv'
-    report_request.ReportName = 'My Campaign Performance Report'
-    report_request.ReturnOnlyCompleteData = False
-    scope = api_client.factory.create('AccountThroughCampaignReportScope')
-    scope.AccountIds={'long': config.oauth2_account_array()}
-    scope.Campaigns=None
-    report_request.Scope=scope
-    #report_request.Language = 'English'
-    if all_time:
-        report_request.Aggregation = 'Yearly'
-    else:
-        report_request.Aggregation = 'Daily'
-    report_request.Time = set_report_time(api_client, current_date, all_time)
-
-    report_columns = api_client.factory.create('ArrayOfCampaignPerformanceReportColumn')
-    if fields is None:
-        report_columns.CampaignPerformanceReportColumn.append([
-            "TimePeriod",
-
-            "AccountId",
-            "AccountName",
-            "CampaignId",
-            "CampaignName",
-            "CampaignLabels",
-
-            "Spend"
-        ])
-    else:
-        report_columns.CampaignPerformanceReportColumn.append(fields)
-
-    report_request.Columns = report_columns
-    return report_request
-
-
-def parse_labels(labels: str) -> {str: str}:
-    """Extracts labels from a string
+        The paths of the zip archives of all shards with data, in the order of the shards
+    """
+    downloaded_shards = {} if downloaded_shards is None else downloaded_shards
+    for shard in report_shards():
+        if shard.number not in downloaded_shards:
+            shard_files = []
+            download_performance_shard(api_client, job, tmp_dir, shard_files, shard)
+            downloaded_shards[shard.number] = shard_files
+    return [file_path for _, file_path in sorted(shard_file for shard_files in downloaded_shards.values()
+                                                 for shard_file in shard_files)]
+
+
+def download_performance_shard(api_client: BingReportClient, job: ReportJob, tmp_dir: Path,
+                               shard_files: [tuple], shard: ReportShard):
+    """
+    Downloads the report of a job for a single shard, splitting the shard when the report times out
     Args:
-        labels: Labels as an json encoded array of strings '["{key_1=value_1}","{key_2=value_2}]", ..]'
-    Returns:
-            A dictionary of labels with {key_1 : value_1, ...} format
+        api_client: BingApiClient object
+        job: the days and report to download
+        tmp_dir: the directory for the downloaded shards
+        shard_files: a list to which the downloaded files are added as tuples of the form (shard number, path)
+        shard: the accounts or campaigns to request
     """
-    matches = re.findall("{([^=]+)=([^=]+)}", labels)
-    labels = {x[0].strip().lower().title(): x[1].strip() for x in matches}
-    return labels
+    report_request = api_client.request_templates.build(job.report, job.last_date, job.first_date, shard)
+    try:
+        report_file_location = submit_and_download(
+            report_request, api_client, str(tmp_dir),
+            '{}_{}.zip'.format(job.report, '_'.join(str(i) for i in shard.number)),
+            overwrite_if_exists=True, keep_archive=True, report=job.report, account=','.join(shard.account_ids))
+    except TimeoutException:
+        shards = shard.split()
+        if not shards:
+            raise
+        metrics().increment('shard_splits', report=job.report, account=','.join(shard.account_ids))
+        print('The {job} of {shard} timed out, splitting it into {shards}'
+              .format(job=job, shard=shard, shards=' and '.join(str(shard) for shard in shards)), file=sys.stderr)
+        for part in shards:
+            download_performance_shard(api_client, job, tmp_dir, shard_files, part)
+        return
+    if report_file_location is not None:
+        shard_files.append((shard.number, Path(report_file_location)))
 
 
-def submit_and_download(report_request, api_client, data_dir, data_file, overwrite_if_exists, decompress: bool = False):
+def submit_and_download(report_request, api_client, data_dir, data_file, overwrite_if_exists,
+                        keep_archive: bool = False, report: str = None, account: str = 'all'):
     """
-    Submit the download request and then use the ReportingDownloadOperation result to
-    track status until the report is complete.
+    Submit the download request, wait for the shared report poller to see the report
+    completed and then download it through the session of the api client.
     Id the file already exists, do nothing
     Args:
         report_request: report_request object e.g. created by get_ad_performance
@@ -516,7 +803,9 @@ def submit_and_download(report_request, api_client, data_dir, data_file, overwri
         data_dir: target directory of the files containing the reports
         data_file: the name of the file containing the data
         overwrite_if_exists: if True, overwrite the file
-        decompress: whether to decompress zip files
+        keep_archive: whether to keep the zip archive sent by Bing instead of recompressing the CSV file
+        report: the report type in the metrics, `data_file` when not set
+        account: the account ids of the request in the metrics
     Returns:
         result_file_path: the location of the result file
     """
@@ -525,65 +814,63 @@ def submit_and_download(report_request, api_client, data_dir, data_file, overwri
         print('The file {} already exists, skipping it'.format(target_file))
         return
 
-    current_reporting_service_manager = \
-        ReportingServiceManager(
-            authorization_data=api_client.authorization_data,
-            poll_interval_in_milliseconds=5000,
-            environment='production',
-            working_directory=config.data_dir(),
-        )
-    reporting_download_operation = current_reporting_service_manager.submit_download(report_request)
-
-    # You may optionally cancel the track() operation after a specified time interval.
-    current_reporting_operation_status = reporting_download_operation.track(
-        timeout_in_milliseconds=config.timeout())
-
-    # You can use ReportingDownloadOperation.track() to poll until complete as shown above,
-    # or use custom polling logic with get_status() as shown below.
-    for i in range(10):
-        time.sleep(current_reporting_service_manager.poll_interval_in_milliseconds / 1000.0)
-
-        download_status = reporting_download_operation.get_status()
-
-        if download_status.status == 'Success':
-            break
-
-    print("Awaiting Download Results . . .")
+    report = report or data_file
+    timings = {}
+    status, result_file_path = 'error', None
+    try:
+        with rate_limiter().report_slot():
+            with timed(timings, 'submit'):
+                reporting_download_operation = api_client.submit_report(report_request)
+            submitted_at = time.time()
 
-    result_file_path = reporting_download_operation.download_result_file(
-        result_file_directory=data_dir,
-        result_file_name=data_file,
-        decompress=decompress,
-        overwrite=True,  # Set this value true if you want to overwrite the same file.
-        timeout_in_milliseconds=config.timeout()
-    )
+            try:
+                ready_seconds = report_poller().wait_until_ready(reporting_download_operation,
+                                                                 timeout_in_seconds=int(config.timeout()) / 1000.0,
+                                                                 submitted_at=submitted_at)
+            except TimeoutException:
+                status = 'timeout'
+                raise
+            timings['generation'] = ready_seconds
+            print('Report for {} was ready after {:.1f} seconds'.format(data_file, ready_seconds))
+
+            url = reporting_download_operation.final_status.report_download_url
+            if not url:
+                print('The report for {} contains no data'.format(data_file))
+                status = 'empty'
+                return None
+
+            with timed(timings, 'download'):
+                result_file_path = api_client.download_report(url, Path(data_dir, data_file), keep_archive)
+            status = 'success'
+    finally:
+        metrics().observe(report, account, timings)
+        metrics().increment('reports', report=report, account=account, status=status)
+        metrics().record('report', report=report, account=account, file=data_file, status=status,
+                         bytes=result_file_path.stat().st_size if result_file_path else None, **timings)
 
     print("Download result file: {}".format(result_file_path))
-    print("Status: {}\n".format(current_reporting_operation_status.status))
 
-    return result_file_path
+    return str(result_file_path)
 
 
 def authenticate_with_oauth(api_client):
     """
     Sets the authentication with OAuthDesktopMobileAuthCodeGrant.
+    A still valid access token of the token cache is reused, and the token is renewed in the background before
+    it expires.
     Args:
         param api_client: The BingApiClient.
     """
 
-    authentication = OAuthDesktopMobileAuthCodeGrant(
-        client_id=config.oauth2_client_id()
-    )
-
-    api_client.authorization_data.authentication = authentication
-
     # load refresh token from config
     refresh_token = config.oauth2_refresh_token()
     try:
         # If we have a refresh token let's refresh it
         if refresh_token is not None:
-            api_client.authorization_data.authentication.request_oauth_tokens_by_refresh_token(
-                refresh_token)
+            cache = token_cache()
+            authentication, expires_at = cached_authentication(refresh_token, cache)
+            api_client.authorization_data.authentication = authentication
+            api_client.token_refresher = TokenRefresher(api_client, refresh_token, expires_at, cache)
         else:
             print('No refresh token found. Please run refresh refresh-bingads-api-oauth2-token')
             sys.exit(1)
@@ -597,6 +884,12 @@ def authenticate_with_oauth(api_client):
         sys.exit(1)
 
 
+def renew_oauth_token(api_client):
+    """Requests a new access token right away, e.g. after Bing rejected the current one"""
+    if api_client.token_refresher is not None:
+        api_client.token_refresher.renew()
+
+
 def refresh_oauth_token():
     """Retrieve and display the access and refresh token."""
     """
@@ -606,13 +899,11 @@ def refresh_oauth_token():
     Returns:
         List of accounts that the user can manage.
     """
-    api_client = BingReportClient()
+    import webbrowser  # only needed for creating a token
+
     authentication = OAuthDesktopMobileAuthCodeGrant(client_id=config.oauth2_client_id())
-    api_client.authorization_data.authentication = authentication
-    print(
-        'Authorization Endpoint: {}'.format(api_client.authorization_data.authentication.get_authorization_endpoint()))
-    webbrowser.open(api_client.authorization_data.authentication.get_authorization_endpoint(),
-                    new=1)
+    print('Authorization Endpoint: {}'.format(authentication.get_authorization_endpoint()))
+    webbrowser.open(authentication.get_authorization_endpoint(), new=1)
     response_uri = input(
         "You need to provide consent for the application to access your Bing Ads accounts. "
         "After you have granted consent in the web browser for the application to access your Bing Ads accounts, "
@@ -620,8 +911,7 @@ def refresh_oauth_token():
     )
 
     # Request access and refresh tokens using the URI that you provided manually during program execution.
-    oauth_tokens = api_client.authorization_data.authentication.request_oauth_tokens_by_response_uri(
-        response_uri=response_uri)
+    oauth_tokens = authentication.request_oauth_tokens_by_response_uri(response_uri=response_uri)
     print('Below is your oauth refresh token:')
     print(str(oauth_tokens.refresh_token).replace('!', '\!'))  # this is important for bash
 
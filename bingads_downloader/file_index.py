@@ -0,0 +1,246 @@
+"""
+Sidecar indexes of the performance files, which let queries skip files and blocks that can not match.
+
+The index of a file records its row count, the account and campaign ids in it and, for gzip files, the
+compressed offset of every gzip member (as written by compression.CompressedWriter) with the position of the
+first data row that starts in the member and the account and campaign ids of the rows that start in it.
+A query can then decompress a file from any member on, instead of from its beginning.
+The index is collected while a file is written (see FileIndexBuilder), files of earlier versions are read once.
+"""
+
+import collections
+import csv
+import json
+import os
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Iterator, TextIO
+
+from bingads_downloader import config
+from bingads_downloader.compression import BLOCK_SIZE, codec, open_decompressed
+from bingads_downloader.report_file import FOOTER_LINES, PREAMBLE_LINES, TruncatedReportError, parse_report_date
+
+# The version of the index format, indexes of other versions are ignored
+INDEX_VERSION = 1
+
+_READ_SIZE = 1024 * 1024
+
+
+def index_file_path(file_path: Path) -> Path:
+    """The sidecar index of an output file, e.g. 'ad_performance_v3.csv.gz.index.json'"""
+    return file_path.with_name(file_path.name + config.index_suffix())
+
+
+def write_file_index(file_path: Path, file_index: 'FileIndexBuilder' = None):
+    """
+    Writes the sidecar index of a performance file, if config.index_suffix() is set
+    Args:
+        file_path: the performance file
+        file_index: the index that was collected while the file was written, the file is read when not set
+    """
+    if not config.index_suffix() or not file_path.exists():
+        return
+    if file_index is None:
+        index = build_file_index(file_path)
+    else:
+        stat = file_path.stat()
+        index = dict(file_index.index(), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    index_path = index_file_path(file_path)
+    tmp_index_path = index_path.with_name(index_path.name + '.tmp')
+    tmp_index_path.write_text(json.dumps(index, separators=(',', ':')))
+    os.replace(str(tmp_index_path), str(index_path))
+
+
+def load_file_index(file_path: Path) -> dict:
+    """Returns the sidecar index of a file, or None when there is none or the file was changed after indexing"""
+    if not config.index_suffix():
+        return None
+    try:
+        index = json.loads(index_file_path(file_path).read_text())
+        stat = file_path.stat()
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != INDEX_VERSION or [index['size'], index['mtime_ns']] != [stat.st_size,
+                                                                                      stat.st_mtime_ns]:
+        return None
+    return index
+
+
+def build_file_index(file_path: Path) -> dict:
+    """
+    Reads a performance file once and collects its index
+    Args:
+        file_path: a compressed report file in the layout of Bing or normalized
+    Returns:
+        A dictionary with the keys 'version', 'size', 'mtime_ns', 'header', 'rows', 'accounts', 'campaigns',
+        'first_date', 'last_date' and 'blocks', a list of dictionaries with the keys 'offset' (of the gzip member),
+        'row_offset' (of the first data row in the uncompressed member), 'rows', 'accounts' and 'campaigns'.
+        Blocks are only listed for gzip files.
+    """
+    stat = file_path.stat()
+    with open(str(file_path), 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+        f.seek(0)
+        members = _gzip_members(f) if gzipped else _decompressed_blocks(file_path)
+
+        file_index = FileIndexBuilder(gzipped)
+        lookahead = collections.deque()
+        preamble_rows = None
+        for row_number, (block_number, position, row) in enumerate(_rows(members)):
+            if file_index.header is None:
+                if preamble_rows is None:
+                    preamble_rows = PREAMBLE_LINES if row and row[0].startswith('Report Name:') else 0
+                if row_number == preamble_rows:
+                    file_index.start(row)
+                continue
+            lookahead.append((block_number, position, row))
+            if len(lookahead) > (FOOTER_LINES if preamble_rows else 0):
+                file_index.add_row(*lookahead.popleft())
+
+    if gzipped:
+        file_index.member_offsets.extend(members.offsets)
+    return dict(file_index.index(), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+class FileIndexBuilder:
+    """
+    Collects the index of a file (see build_file_index) while it is written: the file is opened with
+    compression.open_compressed(..., member_offsets=file_index.member_offsets), the text stream is wrapped with
+    track(), and every data row is passed to add() right before it is written.
+    """
+
+    def __init__(self, gzipped: bool = None):
+        """
+        Args:
+            gzipped: whether the file is gzip compressed, whether the configured codec is gzip when not set
+        """
+        self.gzipped = codec()[0] == 'gzip' if gzipped is None else gzipped
+        self.member_offsets = []  # the compressed offset of every gzip member
+        self.header = None
+        self._columns = (None, None, None)
+        self._blocks = {}
+        self._dates = set()
+        self._stream = None
+
+    def track(self, stream: TextIO) -> TextIO:
+        """Returns a text stream that writes to `stream` and counts the uncompressed bytes written so far"""
+        self._stream = _CountingStream(stream)
+        return self._stream
+
+    def start(self, header: [str]):
+        """Records the header of the file"""
+        self.header = header
+        self._columns = tuple(header.index(column) if column in header else None
+                              for column in ('AccountId', 'CampaignId', 'TimePeriod'))
+
+    def add(self, row: list):
+        """Records a data row that is written next to the tracked stream"""
+        self.add_row(self._stream.position // BLOCK_SIZE, self._stream.position % BLOCK_SIZE, row)
+
+    def add_row(self, block_number: int, row_offset: int, row: list):
+        """Records a data row that starts at `row_offset` of the uncompressed content of a gzip member"""
+        account, campaign, time_period = self._columns
+        block = self._blocks.setdefault(block_number, {'row_offset': row_offset, 'rows': 0,
+                                                       'accounts': set(), 'campaigns': set()})
+        block['rows'] += 1
+        if account is not None:
+            block['accounts'].add(row[account])
+        if campaign is not None:
+            block['campaigns'].add(row[campaign])
+        if time_period is not None:
+            self._dates.add(row[time_period])
+
+    def index(self) -> dict:
+        """Returns the index without the size and modification time of the file"""
+        block_list = [{'offset': self.member_offsets[number] if self.gzipped else None,
+                       'row_offset': block['row_offset'], 'rows': block['rows'],
+                       'accounts': sorted(block['accounts']), 'campaigns': sorted(block['campaigns'])}
+                      for number, block in sorted(self._blocks.items())]
+        days = sorted(parse_report_date(date) for date in self._dates)
+        return {'version': INDEX_VERSION, 'header': self.header,
+                'rows': sum(block['rows'] for block in block_list),
+                'accounts': sorted(set().union(*(block['accounts'] for block in block_list))),
+                'campaigns': sorted(set().union(*(block['campaigns'] for block in block_list))),
+                'first_date': days[0].isoformat() if days else None,
+                'last_date': days[-1].isoformat() if days else None,
+                'blocks': block_list if self.gzipped else []}
+
+
+class _CountingStream:
+    """A text stream that counts the UTF-8 encoded bytes that are written to another text stream"""
+
+    def __init__(self, stream: TextIO):
+        self._stream = stream
+        self.position = 0
+
+    def write(self, text: str) -> int:
+        self.position += len(text) if text.isascii() else len(text.encode('utf-8'))
+        return self._stream.write(text)
+
+
+class _gzip_members:
+    """Iterates over the uncompressed content of the gzip members of a file and records their offsets"""
+
+    def __init__(self, file: BinaryIO):
+        self._file = file
+        self.offsets = []  # the compressed offset of every member
+
+    def __iter__(self) -> Iterator[bytes]:
+        offset, data, consumed = 0, b'', 0
+        decompressor, output = zlib.decompressobj(31), []
+        while True:
+            if not data:
+                data = self._file.read(_READ_SIZE)
+                if not data:
+                    break
+            output.append(decompressor.decompress(data))
+            if decompressor.eof:
+                consumed += len(data) - len(decompressor.unused_data)
+                self.offsets.append(offset)
+                yield b''.join(output)
+                offset, consumed = offset + consumed, 0
+                data, decompressor, output = decompressor.unused_data, zlib.decompressobj(31), []
+            else:
+                consumed, data = consumed + len(data), b''
+        if consumed:
+            raise TruncatedReportError('The last gzip member of the file ends after {} bytes'.format(consumed))
+
+
+def _decompressed_blocks(file_path: Path) -> Iterator[bytes]:
+    """The uncompressed content of a file that is not gzip compressed, in blocks of _READ_SIZE bytes"""
+    with open_decompressed(file_path) as f:
+        yield from iter(lambda: f.read(_READ_SIZE), b'')
+
+
+def _rows(blocks) -> Iterator[tuple]:
+    """
+    Splits uncompressed blocks into CSV rows, which may span blocks. A line ends a row when the number of
+    quotes since the start of the row is even.
+    Returns:
+        A generator of tuples of the form (number of the block in which the row starts, its position there, values)
+    """
+    pending, quotes, start = [], 0, None
+    for block_number, data in enumerate(blocks):
+        if block_number == 0 and data.startswith(b'\xef\xbb\xbf'):  # byte order mark of Bing
+            data, skipped = data[3:], 3
+        else:
+            skipped = 0
+        position = 0
+        while position < len(data):
+            end = data.find(b'\n', position)
+            line = data[position:] if end < 0 else data[position:end + 1]
+            if not pending:
+                start = (block_number, position + skipped)
+            pending.append(line)
+            quotes += line.count(b'"')
+            position += len(line)
+            if end >= 0 and quotes % 2 == 0:
+                yield start + (next(csv.reader([b''.join(pending).decode('utf-8')]), []),)
+                pending, quotes = [], 0
+    if pending and b''.join(pending).strip():
+        yield start + (next(csv.reader([b''.join(pending).decode('utf-8')]), []),)
+
+
+def overlaps(values: [str], wanted: {str}) -> bool:
+    """Whether any of the values of an index is wanted, always True when nothing is filtered"""
+    return not wanted or not wanted.isdisjoint(values)
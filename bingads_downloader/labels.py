@@ -0,0 +1,128 @@
+"""
+Parsing of the label strings of Bing, e.g. '["{channel=display}","{brand=acme}"]', and their expansion into
+typed columns of the performance and account structure files.
+
+Label strings repeat across millions of rows, so parsed labels are cached by the raw string.
+"""
+
+import functools
+import json
+import re
+from typing import Callable, NamedTuple
+
+from bingads_downloader import config
+
+# The number of distinct label strings (and label combinations per expander) that are kept parsed
+CACHE_SIZE = 65536
+
+_LABEL_PATTERN = re.compile('{([^=]+)=([^=]+)}')
+
+_LABEL_TYPES = ('string', 'int64', 'float64')
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _parse_labels(labels: str) -> tuple:
+    return tuple((key.strip().lower().title(), value.strip()) for key, value in _LABEL_PATTERN.findall(labels))
+
+
+def parse_labels(labels: str) -> {str: str}:
+    """Extracts labels from a string
+    Args:
+        labels: Labels as an json encoded array of strings '["{key_1=value_1}","{key_2=value_2}]", ..]'
+    Returns:
+            A dictionary of labels with {Key_1 : value_1, ...} format
+    """
+    return dict(_parse_labels(labels))
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def labels_json(labels: str) -> str:
+    """The labels of a label string as a JSON object, as stored in the account structure snapshot"""
+    return json.dumps(parse_labels(labels))
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def merged_attributes(campaign_attributes: str, ad_attributes: str) -> ({str: str}, str):
+    """
+    Merges the JSON encoded labels of a campaign and an ad, the labels of the ad win
+    Returns:
+        The merged labels as a dictionary, which must not be modified, and as JSON
+    """
+    attributes = {**json.loads(campaign_attributes or '{}'), **json.loads(ad_attributes or '{}')}
+    return attributes, json.dumps(attributes)
+
+
+class LabelColumn(NamedTuple):
+    """A label that is written as a column of its own"""
+    name: str  # the column and the label key as returned by parse_labels, e.g. 'Channel'
+    type: str = 'string'  # 'string', 'int64' or 'float64'
+
+
+def label_columns() -> [LabelColumn]:
+    """Returns the label columns of config.label_columns(), e.g. 'channel,brand,priority:int64'"""
+    columns = []
+    for definition in config.label_columns().split(','):
+        if not definition.strip():
+            continue
+        key, _, type = definition.partition(':')
+        type = type.strip() or 'string'
+        if type not in _LABEL_TYPES:
+            raise ValueError('Unknown type "{}" of label column "{}"'.format(type, key.strip()))
+        columns.append(LabelColumn(key.strip().lower().title(), type))
+    return columns
+
+
+def label_values(attributes: {str: str}, columns: [LabelColumn]) -> [str]:
+    """The values of the label columns, empty for missing labels and for values that do not match the type"""
+    values = []
+    for column in columns:
+        value = attributes.get(column.name, '')
+        if value and column.type != 'string':
+            try:
+                float(value) if column.type == 'float64' else int(value)
+            except ValueError:
+                value = ''
+        values.append(value)
+    return values
+
+
+class LabelExpansion:
+    """
+    Appends the configured label columns to the rows of a report. The labels of a row are those of its campaign
+    in the account structure snapshot, overridden by those in the label column of the row, e.g. AdLabels
+    """
+
+    def __init__(self, columns: [LabelColumn], label_column: str = None,
+                 campaign_labels: {str: {str: str}} = None):
+        """
+        Args:
+            columns: the label columns to append
+            label_column: the column of the report with the label string of each row, if any
+            campaign_labels: a dictionary of the form {campaign_id: {key: value}}
+        """
+        self.columns = columns
+        self.label_column = label_column
+        self.campaign_labels = campaign_labels or {}
+
+    @property
+    def names(self) -> [str]:
+        return [column.name for column in self.columns]
+
+    def expander(self, header: [str]) -> Callable[[list], list]:
+        """Creates a function that returns the values of the label columns of a row with the given header"""
+        for name in self.names:
+            if name in header:
+                raise ValueError('The label column "{}" is already a column of the report'.format(name))
+        labels_position = header.index(self.label_column) if self.label_column in header else None
+        campaign_position = header.index('CampaignId') if 'CampaignId' in header else None
+
+        @functools.lru_cache(maxsize=CACHE_SIZE)
+        def values(labels: str, campaign_id: str) -> tuple:
+            attributes = {**self.campaign_labels.get(campaign_id, {}), **dict(_parse_labels(labels))}
+            return tuple(label_values(attributes, self.columns))
+
+        def expand(row: list) -> list:
+            return list(values(row[labels_position] if labels_position is not None else '',
+                               row[campaign_position] if campaign_position is not None else None))
+
+        return expand
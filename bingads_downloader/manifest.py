@@ -0,0 +1,269 @@
+"""
+Keeps track of downloaded performance files and the account structure in a SQLite database in the data directory
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from bingads_downloader import config
+from bingads_downloader.labels import labels_json
+from bingads_downloader.report_file import ContentHash, ReportReader, open_report_file
+
+
+class Manifest:
+    """
+    Records the status, row count, size and checksum of every (day, report, output file version).
+
+    A file is `started` before its download begins and `complete` once it has been written entirely,
+    so files of interrupted runs are never mistaken as done. The hash of the data rows and the number of
+    consecutive downloads in which they did not change tell which days of the overwrite window are stable.
+
+    Additionally holds a snapshot of all ads and campaign labels, from which the account structure file is written.
+    """
+
+    def __init__(self, path: Path):
+        """
+        Args:
+            path: the location of the SQLite database, created if it does not exist
+        """
+        self._lock = threading.Lock()
+        # waits for other processes, e.g. workers that share the data directory, to finish writing
+        self._connection = sqlite3.connect(str(path), timeout=60, check_same_thread=False, isolation_level=None)
+        self._connection.execute('''
+CREATE TABLE IF NOT EXISTS download (
+    day           TEXT NOT NULL,
+    report        TEXT NOT NULL,
+    version       TEXT NOT NULL,
+    status        TEXT NOT NULL,
+    row_count     INTEGER,
+    byte_size     INTEGER,
+    checksum      TEXT,
+    downloaded_at TEXT,
+    content_hash  TEXT,
+    stable_runs   INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, report, version)
+)''')
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(download)')]
+        if 'content_hash' not in columns:  # manifest of a previous version
+            self._connection.execute('ALTER TABLE download ADD COLUMN content_hash TEXT')
+            self._connection.execute('ALTER TABLE download ADD COLUMN stable_runs INTEGER NOT NULL DEFAULT 0')
+        self._connection.execute('''
+CREATE TABLE IF NOT EXISTS state (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+)''')
+        self._connection.execute('''
+CREATE TABLE IF NOT EXISTS structure_ad (
+    ad_id         INTEGER PRIMARY KEY,
+    ad_title      TEXT,
+    ad_group_id   TEXT,
+    ad_group_name TEXT,
+    campaign_id   TEXT,
+    campaign_name TEXT,
+    account_id    TEXT,
+    account_name  TEXT,
+    attributes    TEXT
+)''')
+        self._connection.execute('''
+CREATE TABLE IF NOT EXISTS structure_campaign (
+    campaign_id TEXT PRIMARY KEY,
+    attributes  TEXT,
+    labels      TEXT
+)''')
+        if 'labels' not in [row[1] for row in self._connection.execute('PRAGMA table_info(structure_campaign)')]:
+            self._connection.execute('ALTER TABLE structure_campaign ADD COLUMN labels TEXT')
+
+    def states(self) -> {(datetime.date, str): str}:
+        """
+        Returns the status of all files of the current output file version
+        Returns:
+            A dictionary of the form {(day, report): status}
+        """
+        with self._lock:
+            rows = self._connection.execute('SELECT day, report, status FROM download WHERE version = ?',
+                                            (config.output_file_version(),)).fetchall()
+        return {(datetime.datetime.strptime(day, '%Y-%m-%d').date(), report): status
+                for day, report, status in rows}
+
+    def stable_runs(self) -> {(datetime.date, str): int}:
+        """
+        Returns for all complete files of the current output file version the number of consecutive downloads
+        in which their content did not change
+        Returns:
+            A dictionary of the form {(day, report): number of unchanged downloads}
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT day, report, stable_runs FROM download WHERE version = ? AND status = 'complete'",
+                (config.output_file_version(),)).fetchall()
+        return {(datetime.datetime.strptime(day, '%Y-%m-%d').date(), report): stable_runs
+                for day, report, stable_runs in rows}
+
+    def content_hash(self, day: datetime.date, report: str) -> str:
+        """Returns the hash of the data rows of a file when it was last written, or None"""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT content_hash FROM download WHERE day = ? AND report = ? AND version = ?',
+                ('{:%Y-%m-%d}'.format(day), report, config.output_file_version())).fetchone()
+        return row[0] if row else None
+
+    def start(self, day: datetime.date, report: str):
+        """Marks a file as being downloaded, its statistics are kept for detecting changes"""
+        self._update(day, report, status='started')
+
+    def complete(self, day: datetime.date, report: str, file_path: Path, content_hash: ContentHash = None):
+        """
+        Marks a file as completely written and records its statistics. A missing file means no data.
+        Args:
+            day: the day of the file
+            report: the report type
+            file_path: the written file
+            content_hash: the hash of the rows that were written, which are read from the file when not set
+        """
+        row_count, byte_size, checksum, file_content_hash = 0, 0, None, None
+        if file_path.exists():
+            row_count, byte_size, checksum, file_content_hash = file_statistics(file_path, content_hash)
+        self._update(day, report, status='complete', row_count=row_count, byte_size=byte_size, checksum=checksum,
+                     content_hash=file_content_hash, stable_runs=0)
+
+    def unchanged(self, day: datetime.date, report: str):
+        """Marks a file as complete whose download had the same content as the file, which was kept"""
+        with self._lock:
+            self._connection.execute(
+                "UPDATE download SET status = 'complete', stable_runs = stable_runs + 1, downloaded_at = ? "
+                "WHERE day = ? AND report = ? AND version = ?",
+                (datetime.datetime.now().isoformat(timespec='seconds'), '{:%Y-%m-%d}'.format(day), report,
+                 config.output_file_version()))
+
+    def adopt(self, day: datetime.date, report: str, file_path: Path):
+        """Marks a file that was written by a run without manifest as complete, without reading it"""
+        self._update(day, report, status='complete', row_count=None, byte_size=file_path.stat().st_size,
+                     checksum=None, content_hash=None, stable_runs=0)
+
+    def get_state(self, key: str) -> str:
+        """Returns a value that was stored by a previous run, or None"""
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key: str, value: str):
+        """Stores a value for subsequent runs"""
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (key, value))
+
+    def update_structure(self, ads: Iterable[dict], campaign_labels: {str: str}, replace: bool):
+        """
+        Merges ads and campaign labels into the account structure snapshot
+        Args:
+            ads: dictionaries as returned by downloader.get_ad_data, with the ad labels as JSON, which must be read
+                 from a downloaded report, as the snapshot is locked for writing while they are read
+            campaign_labels: the label strings of the campaigns, of the form {campaign_id: labels}
+            replace: whether to remove all previously stored ads and campaigns
+        """
+        with self._lock:
+            with self._connection:
+                self._connection.execute('BEGIN')
+                if replace:
+                    self._connection.execute('DELETE FROM structure_ad')
+                    self._connection.execute('DELETE FROM structure_campaign')
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO structure_campaign VALUES (?, ?, ?)',
+                    ((campaign_id, labels_json(labels), labels) for campaign_id, labels in campaign_labels.items()))
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO structure_ad VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    ((int(ad['AdId']), ad['AdTitle'], ad['AdGroupId'], ad['AdGroupName'], ad['CampaignId'],
+                      ad['CampaignName'], ad['AccountId'], ad['AccountName'], ad['attributes'])
+                     for ad in ads))
+
+    def structure(self) -> Iterator[tuple]:
+        """
+        Reads the account structure snapshot ad by ad
+        Returns:
+            A generator of tuples of the form ([ad id, ad title, .., account name], campaign labels, ad labels)
+            with the labels as JSON
+        """
+        with self._lock:
+            cursor = self._connection.execute('''
+SELECT ad_id, ad_title, ad_group_id, ad_group_name, structure_ad.campaign_id, campaign_name,
+       account_id, account_name, structure_ad.attributes, structure_campaign.attributes
+FROM structure_ad
+LEFT JOIN structure_campaign ON structure_campaign.campaign_id = structure_ad.campaign_id
+ORDER BY ad_id''')
+            for row in cursor:
+                yield [str(row[0])] + list(row[1:8]), row[9] or '{}', row[8]
+
+    def campaign_labels(self) -> {str: {str: str}}:
+        """Returns the labels of all campaigns in the account structure snapshot as {campaign_id: {key: value}}"""
+        with self._lock:
+            rows = self._connection.execute('SELECT campaign_id, attributes FROM structure_campaign').fetchall()
+        return {campaign_id: json.loads(attributes) for campaign_id, attributes in rows}
+
+    def campaign_label_strings(self) -> {str: str}:
+        """Returns the labels of all campaigns as sent by Bing, of the form {campaign_id: labels}"""
+        with self._lock:
+            rows = self._connection.execute('SELECT campaign_id, labels FROM structure_campaign').fetchall()
+        return {campaign_id: labels or '' for campaign_id, labels in rows}
+
+    def campaign_ids(self, account_id: str) -> [str]:
+        """Returns the ids of all campaigns of an account in the account structure snapshot"""
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT DISTINCT campaign_id FROM structure_ad WHERE account_id = ? ORDER BY campaign_id',
+                (str(account_id),)).fetchall()
+        return [campaign_id for campaign_id, in rows]
+
+    def _update(self, day: datetime.date, report: str, **values):
+        """Sets columns of the row of a file, which is created if it does not exist"""
+        key = ('{:%Y-%m-%d}'.format(day), report, config.output_file_version())
+        values['downloaded_at'] = datetime.datetime.now().isoformat(timespec='seconds')
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR IGNORE INTO download (day, report, version, status) VALUES (?, ?, ?, ?)',
+                key + (values['status'],))
+            self._connection.execute(
+                'UPDATE download SET {} WHERE day = ? AND report = ? AND version = ?'
+                .format(', '.join('{} = ?'.format(column) for column in values)),
+                tuple(values.values()) + key)
+
+
+def file_statistics(file_path: Path, content_hash: ContentHash = None) -> (int, int, str, str):
+    """
+    Computes the statistics of a report file
+    Args:
+        file_path: the report file
+        content_hash: the hash of the rows of the file when it was written, the file is validated and its rows
+                      are hashed when not set
+    Returns:
+        A tuple of the form (number of data rows, size in bytes, sha256 checksum, hash of the data rows)
+    """
+    sha256 = hashlib.sha256()
+    with open(str(file_path), 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    if content_hash is None:
+        with open_report_file(file_path) as f:
+            reader = ReportReader(f, allow_normalized=True)
+            for _ in reader:
+                pass
+            content_hash = reader.content_hash
+    return content_hash.row_count, os.path.getsize(str(file_path)), sha256.hexdigest(), content_hash.hexdigest()
+
+
+_manifest = None
+_manifest_lock = threading.Lock()
+
+
+def download_manifest() -> Manifest:
+    """Returns the manifest of the data directory"""
+    global _manifest
+    with _manifest_lock:
+        if _manifest is None:
+            Path(config.data_dir()).mkdir(parents=True, exist_ok=True)
+            _manifest = Manifest(Path(config.data_dir(), 'bing-download-manifest.sqlite3'))
+        return _manifest
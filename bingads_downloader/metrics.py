@@ -0,0 +1,152 @@
+"""
+Timings of the phases of every report download, written as JSON lines while the run progresses and aggregated
+into histograms and counters per report type and account, which are exported as a Prometheus textfile
+"""
+
+import bisect
+import collections
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from bingads_downloader import config
+
+# The upper bounds in seconds of the histogram buckets of all phases
+BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+@contextlib.contextmanager
+def timed(timings: dict, phase: str):
+    """
+    Adds the duration of the enclosed block to timings[phase]. The phases of a report are 'submit', 'generation',
+    'download', 'transform' (merging, compressing or splitting) and 'write' (columnar outputs and the manifest)
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start_time
+
+
+class Metrics:
+    """
+    Collects the phase timings and outcomes of all reports of a run.
+    All methods can be called from any thread.
+    """
+
+    def __init__(self, events_path: Path = None):
+        """
+        Args:
+            events_path: the JSON lines file to which every recorded event is appended, no file when not set
+        """
+        self.events_path = events_path
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._histograms = {}  # {(phase, report, account): [count per bucket, .., count of +Inf, sum]}
+        self._counters = collections.Counter()  # {(name, ((label, value), ..)): value}
+        self._gauges = {}  # {(name, ((label, value), ..)): value}
+
+    def observe(self, report: str, account: str, timings: dict):
+        """
+        Adds the phase durations of a report to the histograms
+        Args:
+            report: the report type, e.g. 'ad'
+            account: the account ids of the report, 'all' for reports of all accounts
+            timings: a dictionary of the form {phase: seconds}
+        """
+        with self._lock:
+            for phase, seconds in timings.items():
+                histogram = self._histograms.setdefault((phase, report, account), [0] * (len(BUCKETS) + 2))
+                histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+                histogram[-1] += seconds
+
+    def increment(self, name: str, value: float = 1, **labels):
+        """Increases a counter, e.g. increment('reports', report='ad', status='success')"""
+        with self._lock:
+            self._counters[name, tuple(sorted(labels.items()))] += value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        """Sets a gauge, e.g. the seconds a run took"""
+        with self._lock:
+            self._gauges[name, tuple(sorted(labels.items()))] = value
+
+    def record(self, event: str, **values):
+        """Appends an event with the current time to the JSON lines file"""
+        if not self.events_path:
+            return
+        line = json.dumps({'time': datetime.datetime.now().isoformat(timespec='milliseconds'), 'event': event,
+                           **{key: round(value, 3) if isinstance(value, float) else value
+                              for key, value in values.items()}})
+        with self._lock:
+            self.events_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(str(self.events_path), 'a') as f:
+                f.write(line + '\n')
+
+    def prometheus_text(self) -> str:
+        """Returns all histograms, counters and gauges in the Prometheus text exposition format"""
+        lines = ['# HELP bingads_report_phase_seconds The duration of the phases of the reports of the last run',
+                 '# TYPE bingads_report_phase_seconds histogram']
+        with self._lock:
+            for (phase, report, account), histogram in sorted(self._histograms.items()):
+                labels = {'phase': phase, 'report': report, 'account': account}
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), histogram):
+                    cumulative += count
+                    lines.append('bingads_report_phase_seconds_bucket{} {}'
+                                 .format(_labels(labels, le=bound), cumulative))
+                lines.append('bingads_report_phase_seconds_sum{} {:.3f}'.format(_labels(labels), histogram[-1]))
+                lines.append('bingads_report_phase_seconds_count{} {}'.format(_labels(labels), cumulative))
+
+            for kind, values in (('counter', self._counters), ('gauge', self._gauges)):
+                for name in sorted({name for name, _ in values}):
+                    metric = 'bingads_{}{}'.format(name, '_total' if kind == 'counter' else '')
+                    lines.append('# TYPE {} {}'.format(metric, kind))
+                    for (_, labels), value in sorted(item for item in values.items() if item[0][0] == name):
+                        lines.append('{}{} {}'.format(metric, _labels(dict(labels)), value))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus_textfile(self, path: Path):
+        """Replaces the textfile atomically, so that the node exporter never reads a partial file"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(str(tmp_path), 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(str(tmp_path), str(path))
+
+
+def _labels(labels: dict, **extra) -> str:
+    labels = dict(labels, **{key: str(value) for key, value in extra.items()})
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                           .replace('\n', '\\n'))
+                          for key, value in labels.items()) + '}'
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def metrics() -> Metrics:
+    """Returns the metrics of the run, which are appended to config.metrics_file() in the data directory"""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics(Path(config.data_dir(), config.metrics_file()).expanduser()
+                               if config.metrics_file() else None)
+        return _metrics
+
+
+def write_run_metrics(success: bool):
+    """Writes the metrics of the run to config.prometheus_textfile(), if set"""
+    if not config.prometheus_textfile():
+        return
+    run_metrics = metrics()
+    run_metrics.set_gauge('last_run_timestamp_seconds', round(time.time()))
+    run_metrics.set_gauge('last_run_duration_seconds', round(time.time() - run_metrics.started_at, 3))
+    run_metrics.set_gauge('last_run_success', 1 if success else 0)
+    run_metrics.write_prometheus_textfile(Path(config.prometheus_textfile()).expanduser())
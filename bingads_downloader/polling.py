@@ -0,0 +1,124 @@
+"""
+Watches many pending report generations at once with adaptive polling intervals
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from bingads.exceptions import TimeoutException
+from bingads.v13.reporting.exceptions import ReportingException
+
+from bingads_downloader import config
+from bingads_downloader.rate_limit import rate_limiter
+
+
+class ReportPoller:
+    """
+    Schedules the status polls of all submitted reports from a single background thread.
+
+    Every report starts with a short polling interval which grows by `backoff_factor` after each
+    unsuccessful poll up to `max_interval`, so small reports are picked up quickly while large ones
+    do not cause unnecessary status requests. The polls themselves are made by `poll_threads` threads,
+    and polls that the rate limiter would hold back are postponed, so that neither a slow status request
+    nor throttling stalls the schedule of the other reports.
+    """
+
+    def __init__(self, min_interval: float, max_interval: float, backoff_factor: float = 1.5, poll_threads: int = 4):
+        """
+        Args:
+            min_interval: seconds between the submission and the first status request
+            max_interval: the maximum number of seconds between two status requests of a report
+            backoff_factor: the factor by which the polling interval grows after each pending status
+            poll_threads: the maximum number of status requests at the same time
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self._queue = []  # heap of (next poll time, sequence number, _PendingReport)
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._executor = ThreadPoolExecutor(max_workers=poll_threads, thread_name_prefix='report-poll')
+
+    def wait_until_ready(self, reporting_download_operation, timeout_in_seconds: float,
+                         submitted_at: float = None) -> float:
+        """
+        Blocks until the report of a ReportingDownloadOperation is generated
+        Args:
+            reporting_download_operation: a submitted ReportingDownloadOperation
+            timeout_in_seconds: the maximum time to wait for the report, counted from the submission
+            submitted_at: the time.time() of the submission of the report, now when not set
+        Returns:
+            The number of seconds it took for the report to become ready
+        """
+        pending = _PendingReport(reporting_download_operation, self.min_interval, timeout_in_seconds,
+                                 time.time() if submitted_at is None else submitted_at)
+        with self._condition:
+            self._schedule(pending, pending.submitted_at + pending.interval)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='report-poller', daemon=True)
+                self._thread.start()
+        return pending.future.result()
+
+    def _schedule(self, pending: '_PendingReport', poll_at: float):
+        heapq.heappush(self._queue, (poll_at, next(self._sequence), pending))
+        self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue or self._queue[0][0] > time.time():
+                    self._condition.wait(timeout=self._queue[0][0] - time.time() if self._queue else None)
+                _, _, pending = heapq.heappop(self._queue)
+                delay = rate_limiter().delay()
+                if delay > 0:  # throttled or out of calls, the poll waits in the queue instead of in a thread
+                    self._schedule(pending, time.time() + delay)
+                    continue
+            self._executor.submit(self._poll, pending)
+
+    def _poll(self, pending: '_PendingReport'):
+        try:
+            status = pending.operation.get_status()
+        except Exception as e:
+            pending.future.set_exception(e)
+            return
+
+        if status.status == 'Success':
+            pending.future.set_result(time.time() - pending.submitted_at)
+        elif status.status != 'Pending':
+            pending.future.set_exception(
+                ReportingException('Exceptions while reporting download.', status.status))
+        elif time.time() - pending.submitted_at > pending.timeout:
+            pending.future.set_exception(TimeoutException('Timeout at polling.'))
+        else:
+            pending.interval = min(pending.interval * self.backoff_factor, self.max_interval)
+            with self._condition:
+                self._schedule(pending, time.time() + pending.interval)
+
+
+class _PendingReport:
+    """A report that is being generated by Bing"""
+
+    def __init__(self, operation, interval: float, timeout: float, submitted_at: float):
+        self.operation = operation
+        self.interval = interval
+        self.timeout = timeout
+        self.submitted_at = submitted_at
+        self.future = Future()
+
+
+_poller = None
+_poller_lock = threading.Lock()
+
+
+def report_poller() -> ReportPoller:
+    """Returns the poller that is shared by all downloads of this process"""
+    global _poller
+    with _poller_lock:
+        if _poller is None:
+            _poller = ReportPoller(min_interval=int(config.min_poll_interval()) / 1000.0,
+                                   max_interval=int(config.max_poll_interval()) / 1000.0)
+        return _poller
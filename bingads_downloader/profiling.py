@@ -0,0 +1,45 @@
+"""
+Measures where the time before the first report request goes: imports, service client construction, authentication.
+Only uses the standard library, so that it can be imported before anything else.
+"""
+
+import contextlib
+import time
+
+
+class StartupProfile:
+    """Records the duration of named startup phases in the order in which they finished"""
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = []
+        self.notes = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Measures the duration of the enclosed block"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start_time))
+
+    def note(self, name: str, value: str):
+        """Adds a detail to the report of a phase, e.g. whether a cache was used"""
+        self.notes[name] = value
+
+    def report(self) -> str:
+        """Returns a table of all phases and their total"""
+        lines = ['{:<40} {:>8.3f} s{}'.format(name, seconds, '  ({})'.format(self.notes[name])
+                                              if name in self.notes else '')
+                 for name, seconds in self.phases]
+        lines.append('{:<40} {:>8.3f} s'.format('total', sum(seconds for _, seconds in self.phases)))
+        return '\n'.join(lines)
+
+
+_startup_profile = StartupProfile()
+
+
+def startup_profile() -> StartupProfile:
+    """Returns the startup profile of the process"""
+    return _startup_profile
@@ -0,0 +1,103 @@
+"""
+Reads typed rows of the downloaded performance files of a date range, e.g. the spend of an account in a month.
+
+    from bingads_downloader.query import query
+    spend = sum(row['Spend'] for row in query(datetime.date(2020, 3, 1), datetime.date(2020, 3, 31), 'campaign',
+                                              account_ids=['123456']))
+
+Files and gzip members whose sidecar index (see file_index) shows no matching account or campaign are skipped,
+files without a valid index are read entirely. Days that were compacted into monthly or yearly files (see
+compaction) are read from there.
+"""
+
+import csv
+import datetime
+import gzip
+import io
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from bingads_downloader.columnar import CONVERTERS, report_schema
+from bingads_downloader.compaction import compacted_day, daily_file_path, read_compacted_day
+from bingads_downloader.file_index import load_file_index, overlaps
+from bingads_downloader.report_file import NULL_VALUES, ReportReader, open_report_file
+
+
+def query(first_date: datetime.date, last_date: datetime.date, report: str,
+          account_ids: Iterable[str] = None, campaign_ids: Iterable[str] = None) -> Iterator[dict]:
+    """
+    Reads the rows of the performance files of a report for a range of days
+    Args:
+        first_date: the first day to read
+        last_date: the last day to read
+        report: the report type, e.g. 'ad'
+        account_ids: only rows of these accounts when set
+        campaign_ids: only rows of these campaigns when set
+    Returns:
+        A generator of dictionaries of the form {column: value}, with values typed as in the Parquet files
+        (see columnar.SCHEMAS) and None for missing values
+    """
+    accounts = {str(account_id) for account_id in account_ids or []}
+    campaigns = {str(campaign_id) for campaign_id in campaign_ids or []}
+    types = report_schema(report)
+
+    for day in (first_date + datetime.timedelta(days=i) for i in range((last_date - first_date).days + 1)):
+        file_path = daily_file_path(day, report)
+        if file_path.exists():
+            index = load_file_index(file_path)
+            rows = _indexed_rows(file_path, index, accounts, campaigns) if index and index['blocks'] \
+                else _all_rows(file_path)
+        else:
+            compacted = compacted_day(day, report)
+            if not compacted:
+                continue
+            file_path, index = compacted
+            rows = read_compacted_day(file_path, index)
+        if index is not None and not (overlaps(index['accounts'], accounts)
+                                      and overlaps(index['campaigns'], campaigns)):
+            continue
+
+        header = next(rows)
+        converters = [CONVERTERS[types.get(column, 'string')] for column in header]
+        account, campaign = (header.index(column) if column in header else None
+                             for column in ('AccountId', 'CampaignId'))
+        for row in rows:
+            if (accounts and row[account] not in accounts) or (campaigns and row[campaign] not in campaigns):
+                continue
+            yield {column: None if value in NULL_VALUES else convert(value)
+                   for column, convert, value in zip(header, converters, row)}
+
+
+def _all_rows(file_path: Path) -> Iterator[list]:
+    """The header and then all data rows of a file"""
+    with open_report_file(file_path) as f:
+        reader = ReportReader(f, allow_normalized=True)
+        yield reader.header
+        yield from reader
+
+
+def _indexed_rows(file_path: Path, index: dict, accounts: {str}, campaigns: {str}) -> Iterator[list]:
+    """
+    The header and then the data rows of the gzip members that contain rows of the accounts and campaigns.
+    Consecutive matching members are decompressed in one go, starting at the first row of the first one.
+    """
+    yield index['header']
+    blocks = index['blocks']
+    with open(str(file_path), 'rb') as f:
+        i = 0
+        while i < len(blocks):
+            if not (overlaps(blocks[i]['accounts'], accounts) and overlaps(blocks[i]['campaigns'], campaigns)):
+                i += 1
+                continue
+            run = [blocks[i]]
+            while i + len(run) < len(blocks) and overlaps(blocks[i + len(run)]['accounts'], accounts) \
+                    and overlaps(blocks[i + len(run)]['campaigns'], campaigns):
+                run.append(blocks[i + len(run)])
+            i += len(run)
+
+            f.seek(run[0]['offset'])
+            member = gzip.GzipFile(fileobj=f, mode='rb')
+            member.read(run[0]['row_offset'])
+            reader = csv.reader(io.TextIOWrapper(member, encoding='utf-8', newline=''))
+            for _ in range(sum(block['rows'] for block in run)):
+                yield next(reader)
@@ -0,0 +1,184 @@
+"""
+A rate limiter that is shared by all report submissions, status polls and downloads of a run
+"""
+
+import collections
+import contextlib
+import sys
+import threading
+import time
+from typing import Callable
+
+import requests
+from suds import WebFault
+
+from bingads_downloader import config
+
+# Bing error codes that mean that too many calls were made, e.g. 117 = CallRateExceeded
+THROTTLING_ERROR_CODES = {117}
+
+# HTTP status codes of throttled downloads
+THROTTLING_STATUS_CODES = {429, 503}
+
+
+class RateLimiter:
+    """
+    A token bucket of `requests_per_minute` tokens that refills continuously, plus a limit on the number of
+    reports that are submitted but not yet downloaded.
+
+    When Bing signals throttling, all callers pause until the throttling has passed.
+    The time that callers spent waiting is recorded per kind of call.
+    """
+
+    def __init__(self, requests_per_minute: int, max_pending_reports: int, throttling_pause: float):
+        """
+        Args:
+            requests_per_minute: the maximum number of calls per minute, bursts of up to this many are allowed
+            max_pending_reports: the maximum number of reports that are generated or downloaded at the same time
+            throttling_pause: the seconds all calls are paused after a throttling error
+        """
+        self._rate = requests_per_minute / 60.0
+        self._capacity = float(requests_per_minute)
+        self._tokens = self._capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._throttling_pause = throttling_pause
+        self._condition = threading.Condition()
+        self._report_slots = threading.BoundedSemaphore(max_pending_reports) if max_pending_reports > 0 else None
+        self.wait_times = collections.Counter()
+        self.calls = collections.Counter()
+        self.throttled_calls = 0
+
+    def acquire(self, kind: str):
+        """
+        Blocks until a call may be made
+        Args:
+            kind: the kind of call for the wait time statistics, e.g. 'submit', 'poll' or 'download'
+        """
+        start_time = time.monotonic()
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+                self._updated_at = now
+                if now < self._paused_until:
+                    self._condition.wait(self._paused_until - now)
+                elif self._tokens < 1:
+                    self._condition.wait((1 - self._tokens) / self._rate)
+                else:
+                    self._tokens -= 1
+                    break
+            self.calls[kind] += 1
+            self.wait_times[kind] += time.monotonic() - start_time
+
+    def delay(self) -> float:
+        """Returns the seconds until a call may be made, 0 when a call may be made right away"""
+        with self._condition:
+            now = time.monotonic()
+            tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+            return max(0.0, self._paused_until - now, (1 - tokens) / self._rate)
+
+    def throttled(self, pause: float = None):
+        """Pauses all calls after a throttling error for `pause` seconds, config.throttling_pause() when not set"""
+        with self._condition:
+            self.throttled_calls += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + (pause or self._throttling_pause))
+            self._tokens = 0
+            self._condition.notify_all()
+
+    def call(self, kind: str, function: Callable):
+        """
+        Calls `function` once the rate limit allows it and repeats the call after throttling errors,
+        at most config.total_attempts_for_single_day() times
+        Args:
+            kind: the kind of call for the wait time statistics
+            function: a function without arguments that calls Bing
+        Returns:
+            The result of the function
+        """
+        remaining_attempts = int(config.total_attempts_for_single_day())
+        while True:
+            self.acquire(kind)
+            try:
+                return function()
+            except (WebFault, requests.HTTPError) as error:
+                pause = throttling_pause(error)
+                if pause is None or remaining_attempts == 0:
+                    raise
+                print('Bing throttled a {} call, pausing all calls for {:.0f} seconds'
+                      .format(kind, pause or self._throttling_pause), file=sys.stderr)
+                self.throttled(pause)
+                remaining_attempts -= 1
+
+    @contextlib.contextmanager
+    def report_slot(self):
+        """Holds one of the config.max_pending_reports() slots while a report is generated and downloaded"""
+        if self._report_slots is None:
+            yield
+            return
+        start_time = time.monotonic()
+        with self._report_slots:
+            with self._condition:
+                self.wait_times['report slot'] += time.monotonic() - start_time
+            yield
+
+    def statistics(self) -> str:
+        """Returns a summary of the calls and of the time spent waiting for the rate limit"""
+        with self._condition:
+            return ', '.join(['{} {} calls (waited {:.1f} seconds)'
+                              .format(self.calls[kind], kind, self.wait_times[kind]) for kind in sorted(self.calls)]
+                             + ['waited {:.1f} seconds for report slots'.format(self.wait_times['report slot']),
+                                '{} throttled calls'.format(self.throttled_calls)])
+
+
+def throttling_pause(error: BaseException) -> float:
+    """
+    Checks whether an error means that Bing throttles calls
+    Returns:
+        The seconds to pause as requested by Bing (0 for the configured pause), or None for other errors
+    """
+    if isinstance(error, requests.HTTPError):
+        if error.response is None or error.response.status_code not in THROTTLING_STATUS_CODES:
+            return None
+        retry_after = error.response.headers.get('Retry-After', '')
+        return float(retry_after) if retry_after.isdigit() else 0
+    if isinstance(error, WebFault):
+        return 0 if fault_error_codes(error) & THROTTLING_ERROR_CODES else None
+    return None
+
+
+def fault_error_codes(fault: WebFault) -> {int}:
+    """Returns the Bing error codes in the detail of a SOAP fault"""
+    detail = getattr(fault.fault, 'detail', None)
+    errors = []
+    for fault_detail in ('AdApiFaultDetail', 'ApiFaultDetail'):
+        fault_detail = getattr(detail, fault_detail, None)
+        errors += _as_list(getattr(getattr(fault_detail, 'Errors', None), 'AdApiError', None))
+        errors += _as_list(getattr(getattr(fault_detail, 'OperationErrors', None), 'OperationError', None))
+    codes = set()
+    for error in errors:
+        try:
+            codes.add(int(getattr(error, 'Code', None)))
+        except (TypeError, ValueError):
+            pass
+    return codes
+
+
+def _as_list(value) -> list:
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def rate_limiter() -> RateLimiter:
+    """Returns the rate limiter of the run"""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter(int(config.requests_per_minute()), int(config.max_pending_reports()),
+                                        float(config.throttling_pause()))
+        return _rate_limiter
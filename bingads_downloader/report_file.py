@@ -0,0 +1,387 @@
+"""
+Reading, splitting and writing of Bing CSV report files without loading them into memory.
+Reports are validated while they are read, so incomplete downloads are detected without a separate pass.
+Output files either keep the layout of Bing or are normalized to a plain CSV file with only a header.
+"""
+
+import collections
+import contextlib
+import csv
+import datetime
+import hashlib
+import io
+import shutil
+import tempfile
+import zipfile
+import zlib
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Iterable, TextIO
+
+from bingads_downloader.compression import open_compressed, open_decompressed
+
+if TYPE_CHECKING:
+    from bingads_downloader.file_index import FileIndexBuilder
+    from bingads_downloader.labels import LabelExpansion
+
+# Bing reports start with 10 lines of report metadata followed by the column header ..
+PREAMBLE_LINES = 10
+# .. and end with an empty line and a copyright notice
+FOOTER_LINES = 2
+
+# Values that Bing sends for missing numbers
+NULL_VALUES = {'', '--'}
+
+
+class ReportValidationError(ValueError):
+    """A report is incomplete or not the one that was requested"""
+
+
+class PreambleError(ReportValidationError):
+    """The report does not start with the report metadata of Bing"""
+
+
+class ColumnMismatchError(ReportValidationError):
+    """The column header of the report differs from the requested columns"""
+
+
+class TruncatedReportError(ReportValidationError):
+    """The report ends before its footer or has less or more rows than its preamble announces"""
+
+
+class ContentHash:
+    """
+    Hashes the header and the data rows of a report, but not the preamble and footer, which change with every
+    generation. Rows are hashed individually and summed up, so the order in which Bing returns them does not matter.
+    """
+
+    def __init__(self, header: [str]):
+        self.row_count = 0
+        self._header_hash = _row_hash(header)
+        self._total = self._header_hash
+
+    def update(self, row: [str]):
+        self.row_count += 1
+        self._total += _row_hash(row)
+
+    def add(self, other: 'ContentHash'):
+        """Adds the rows of the hash of another report with the same header"""
+        self.row_count += other.row_count
+        self._total += other._total - other._header_hash
+
+    def hexdigest(self) -> str:
+        """Returns a string of the form '<number of rows>:<hash>'"""
+        return '{}:{:032x}'.format(self.row_count, self._total % 2 ** 128)
+
+
+def _row_hash(row: [str]) -> int:
+    return int.from_bytes(hashlib.sha256('\x1f'.join(row).encode()).digest()[:16], 'big')
+
+
+class ReportReader:
+    """
+    Iterates over the data rows of a Bing CSV report while the preamble, header and footer are kept aside.
+
+    The preamble and the header are read and checked on construction. The footer, the number of rows and the
+    content hash are available once all rows have been read, at which point a missing footer or a row count that
+    differs from the one in the preamble raise a TruncatedReportError.
+
+    Normalized files have neither preamble nor footer and are not validated.
+    """
+
+    def __init__(self, file: TextIO, columns: [str] = None, allow_normalized: bool = False):
+        """
+        Args:
+            file: the report, opened with open_report_file
+            columns: the requested columns, which the header has to match when set
+            allow_normalized: whether the file may be a normalized output file that starts with the header
+        """
+        self._reader = csv.reader(file)
+        try:
+            first_line = next(self._reader)
+            if allow_normalized and not (first_line and first_line[0].startswith('Report Name:')):
+                self.preamble, self.header = [], first_line
+            else:
+                self.preamble = [first_line] + [next(self._reader) for _ in range(PREAMBLE_LINES - 1)]
+                self.header = next(self._reader)
+        except StopIteration:
+            raise TruncatedReportError('The report ends before its column header')
+        except csv.Error as error:
+            raise PreambleError('The report is not a CSV file: {}'.format(error))
+        self.normalized = not self.preamble
+        if not self.normalized and not (self.preamble[0] and self.preamble[0][0].startswith('Report Name:')):
+            raise PreambleError('The report starts with {} instead of its name'.format(self.preamble[0]))
+        self.expected_row_count = None if self.normalized else preamble_row_count(self.preamble)
+        if columns is not None and self.header != list(columns):
+            raise ColumnMismatchError('The report has the columns {} instead of {}'
+                                      .format(', '.join(self.header), ', '.join(columns)))
+        self.footer = []
+        self.content_hash = ContentHash(self.header)
+
+    def __iter__(self):
+        if self.normalized:
+            for row in self._reader:
+                self.content_hash.update(row)
+                yield row
+            return
+
+        lookahead = collections.deque()
+        for row in self._reader:
+            lookahead.append(row)
+            if len(lookahead) > FOOTER_LINES:
+                row = lookahead.popleft()
+                self.content_hash.update(row)
+                yield row
+        self.footer = list(lookahead)
+
+        if len(self.footer) < FOOTER_LINES or not (self.footer[-1] and 'Microsoft' in self.footer[-1][0]):
+            raise TruncatedReportError('The report ends after {} rows without its footer'
+                                       .format(self.content_hash.row_count + len(self.footer)))
+        if self.content_hash.row_count != self.expected_row_count:
+            raise TruncatedReportError('The report has {} rows instead of {}'
+                                       .format(self.content_hash.row_count, self.expected_row_count))
+
+    @property
+    def row_count(self) -> int:
+        """The number of data rows that were read"""
+        return self.content_hash.row_count
+
+
+def preamble_row_count(preamble: [[str]]) -> int:
+    """Returns the number of rows that the 'Rows: ' line of a report preamble announces"""
+    for line in preamble:
+        if line and line[0].startswith('Rows:'):
+            try:
+                return int(line[0][len('Rows:'):].strip().replace(',', ''))
+            except ValueError:
+                raise PreambleError('Invalid row count "{}" in the report preamble'.format(line[0]))
+    raise PreambleError('The report preamble has no row count')
+
+
+@contextlib.contextmanager
+def open_report_file(file_path: Path) -> TextIO:
+    """
+    Opens a report for reading, no matter whether it is the zip file sent by Bing,
+    a compressed or a plain CSV file
+    """
+    with open(str(file_path), 'rb') as f:
+        magic = f.read(2)
+    if magic == b'PK':
+        try:
+            with zipfile.ZipFile(str(file_path)) as archive, archive.open(archive.namelist()[0]) as member:
+                yield io.TextIOWrapper(member, encoding='utf-8-sig', newline='')
+        except (zipfile.BadZipFile, EOFError, zlib.error) as error:
+            raise TruncatedReportError('The report archive {} is incomplete: {}'.format(file_path, error))
+    else:
+        with open_decompressed(file_path) as f:
+            yield io.TextIOWrapper(f, encoding='utf-8-sig', newline='')
+
+
+def write_report(file: TextIO, preamble: [[str]], header: [str], rows: Iterable[list], footer: [[str]]):
+    """Writes a report in the format in which Bing returns it"""
+    writer = csv.writer(file, quoting=csv.QUOTE_ALL)
+    writer.writerows(preamble)
+    writer.writerow(header)
+    writer.writerows(rows)
+    writer.writerows(footer)
+
+
+def parse_report_date(value: str) -> datetime.date:
+    """Parses a TimePeriod value, which Bing either sends as M/D/YYYY or as YYYY-MM-DD"""
+    if '/' in value:
+        return datetime.datetime.strptime(value, '%m/%d/%Y').date()
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def row_normalizer(header: [str], schema: {str: str}) -> Callable[[list], list]:
+    """
+    Creates a function that converts a row to the normalized layout: dates in ISO format, rates without '%' and
+    numbers without thousands separators, missing numbers as empty values
+    Args:
+        header: the columns of the rows
+        schema: the types of the columns, of the form {column: type}, see columnar.SCHEMAS
+    """
+    converters = [_NORMALIZERS.get(schema.get(column, 'string')) for column in header]
+
+    def normalize(row: list) -> list:
+        return [value if convert is None else '' if value in NULL_VALUES else convert(value)
+                for value, convert in zip(row, converters)]
+
+    return normalize
+
+
+_NORMALIZERS = {'date': lambda value: parse_report_date(value).isoformat(),
+                'int64': lambda value: value.replace(',', ''),
+                'float64': lambda value: value.replace(',', ''),
+                'percent': lambda value: value.rstrip('%').replace(',', '')}
+
+
+def _with_row_count(preamble: [[str]], row_count: int) -> [[str]]:
+    return [['Rows: {}'.format(row_count)] if line and line[0].startswith('Rows:') else line for line in preamble]
+
+
+def split_report_by_day(report_file_paths: [Path], target_files: {datetime.date: Path},
+                        columns: [str] = None, schema: {str: str} = None, labels: 'LabelExpansion' = None,
+                        file_indexes: {datetime.date: 'FileIndexBuilder'} = None) -> {datetime.date: ContentHash}:
+    """
+    Splits reports with daily aggregation over several days, e.g. of different accounts, into one compressed
+    report file per day. The reports are validated while they are read.
+    Each file gets the preamble (with an adjusted row count) and footer of the first report, so the rows are
+    collected in temporary files first. Normalized files are compressed directly.
+    Days without data get a report without rows.
+    Args:
+        report_file_paths: the multi day reports, e.g. the zip archives sent by Bing
+        target_files: a dictionary of the form {day: path of the per-day output file}
+        columns: the requested columns, all reports must have the columns of the first report when not set
+        schema: the column types for writing normalized files without preamble and footer, see row_normalizer
+        labels: the label columns to append to the rows, see labels.LabelExpansion
+        file_indexes: the indexes to collect while the per-day files are written, of the form {day: index}
+    Returns:
+        A dictionary of the form {day: content hash of the rows of the per-day file}
+    """
+    file_indexes = file_indexes or {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        day_files, day_writers, content_hashes = {}, {}, {}
+        preamble, header, output_header, footer, normalize, expand = None, None, None, [], None, None
+        try:
+            for report_file_path in report_file_paths:
+                with open_report_file(Path(report_file_path)) as f:
+                    reader = ReportReader(f, columns or header)
+                    if header is None:
+                        preamble, header = reader.preamble, reader.header
+                        time_period = header.index('TimePeriod')
+                        output_header = header
+                        if labels:
+                            expand = labels.expander(header)
+                            output_header = header + labels.names
+                        normalize = row_normalizer(output_header, schema) if schema is not None else None
+                        for day, target_file in target_files.items():
+                            if normalize:
+                                file_index = file_indexes.get(day)
+                                day_files[day] = open_compressed(
+                                    _tmp_day_file(tmp_dir, day, target_file), 'wt',
+                                    member_offsets=file_index.member_offsets if file_index else None)
+                                day_writers[day] = csv.writer(file_index.track(day_files[day]) if file_index
+                                                              else day_files[day])
+                                day_writers[day].writerow(output_header)
+                                if file_index:
+                                    file_index.start(output_header)
+                            else:
+                                day_files[day] = open(Path(tmp_dir, '{:%Y-%m-%d}.csv'.format(day)), 'w',
+                                                      encoding='utf-8', newline='')
+                                day_writers[day] = csv.writer(day_files[day], quoting=csv.QUOTE_ALL)
+                            content_hashes[day] = ContentHash(output_header)
+                    for row in reader:
+                        day = parse_report_date(row[time_period])
+                        if day not in day_writers:
+                            raise ValueError('Unexpected TimePeriod "{}" in {}'
+                                             .format(row[time_period], report_file_path))
+                        if expand:
+                            row = row + expand(row)
+                        if normalize:
+                            row = normalize(row)
+                            if day in file_indexes:
+                                file_indexes[day].add(row)
+                        day_writers[day].writerow(row)
+                        content_hashes[day].update(row)
+                    footer = footer or reader.footer
+        finally:
+            for day_file in day_files.values():
+                day_file.close()
+
+        for day, target_file in target_files.items():
+            tmp_target_file = _tmp_day_file(tmp_dir, day, target_file)
+            if not normalize:
+                file_index = file_indexes.get(day)
+                with open_compressed(tmp_target_file, 'wt',
+                                     member_offsets=file_index.member_offsets if file_index else None) as output, \
+                        open(day_files[day].name, 'r', encoding='utf-8', newline='') as rows:
+                    output = file_index.track(output) if file_index else output
+                    write_report(output, _with_row_count(preamble, content_hashes[day].row_count), output_header,
+                                 [], [])
+                    if file_index:  # the rows are copied one by one to record where they start
+                        file_index.start(output_header)
+                        writer = csv.writer(output, quoting=csv.QUOTE_ALL)
+                        for row in csv.reader(rows):
+                            file_index.add(row)
+                            writer.writerow(row)
+                    else:
+                        shutil.copyfileobj(rows, output)
+                    csv.writer(output, quoting=csv.QUOTE_ALL).writerows(footer)
+            shutil.move(str(tmp_target_file), str(target_file))
+    return content_hashes
+
+
+def _tmp_day_file(tmp_dir: str, day: datetime.date, target_file: Path) -> Path:
+    return Path(tmp_dir, '{:%Y-%m-%d}_{}'.format(day, target_file.name))
+
+
+def merge_reports(report_file_paths: [Path], target_file_path: Path, columns: [str] = None,
+                  compress: bool = False, schema: {str: str} = None, labels: 'LabelExpansion' = None,
+                  file_index: 'FileIndexBuilder' = None) -> ContentHash:
+    """
+    Concatenates the rows of reports with the same columns, e.g. of different accounts, into one report
+    and validates them while they are copied.
+    The preamble (with the total row count announced by all reports) and the footer are taken from the first report.
+    Args:
+        report_file_paths: the reports to merge, e.g. the zip archives sent by Bing
+        target_file_path: the merged report
+        columns: the requested columns, all reports must have the columns of the first report when not set
+        compress: whether to compress the merged report with the configured codec instead of writing plain CSV
+        schema: the column types for writing a normalized file without preamble and footer, see row_normalizer
+        labels: the label columns to append to the rows, see labels.LabelExpansion
+        file_index: the index to collect while the compressed report is written
+    Returns:
+        The content hash of the rows of the merged report
+    """
+    row_count = 0
+    for report_file_path in report_file_paths:
+        with open_report_file(report_file_path) as f:
+            row_count += ReportReader(f, columns).expected_row_count
+
+    file_index = file_index if compress else None
+    with (open_compressed(target_file_path, 'wt', member_offsets=file_index.member_offsets if file_index else None)
+          if compress else open(str(target_file_path), 'w', encoding='utf-8', newline='')) as output:
+        output = file_index.track(output) if file_index else output
+        writer = csv.writer(output, quoting=csv.QUOTE_ALL if schema is None else csv.QUOTE_MINIMAL)
+        footer, content_hash, normalize, expand = [], None, None, None
+        for i, report_file_path in enumerate(report_file_paths):
+            with open_report_file(report_file_path) as f:
+                reader = ReportReader(f, columns)
+                if i == 0:
+                    header = output_header = reader.header
+                    if labels:
+                        expand = labels.expander(header)
+                        output_header = header + labels.names
+                    content_hash = ContentHash(output_header)
+                    if file_index:
+                        file_index.start(output_header)
+                    if schema is not None:
+                        normalize = row_normalizer(output_header, schema)
+                        writer.writerow(output_header)
+                    else:
+                        write_report(output, _with_row_count(reader.preamble, row_count), output_header, [], [])
+                elif reader.header != header:
+                    raise ColumnMismatchError('The columns of {} differ from those of {}'
+                                              .format(report_file_path, report_file_paths[0]))
+                if normalize or expand:
+                    for row in reader:
+                        if expand:
+                            row = row + expand(row)
+                        if normalize:
+                            row = normalize(row)
+                        if file_index:
+                            file_index.add(row)
+                        writer.writerow(row)
+                        content_hash.update(row)
+                elif file_index:
+                    for row in reader:
+                        file_index.add(row)
+                        writer.writerow(row)
+                    content_hash.add(reader.content_hash)
+                else:
+                    writer.writerows(reader)
+                    content_hash.add(reader.content_hash)
+                footer = footer or reader.footer
+        if schema is None:
+            writer.writerows(footer)
+    return content_hash
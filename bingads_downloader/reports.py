@@ -0,0 +1,179 @@
+"""
+The report types that are requested from the Bing reporting API, and request templates that are built once
+per run and copied for every day and shard
+"""
+
+import datetime
+import threading
+from typing import NamedTuple
+
+from bingads_downloader import config
+
+
+class ReportDefinition(NamedTuple):
+    """A report type of the Bing reporting API and the file it is stored in"""
+    report_type: str  # e.g. 'AdPerformanceReport', the request is an 'AdPerformanceReportRequest'
+    report_name: str
+    file_name: str  # the output file name without version and extension
+    columns: tuple
+    sort: tuple = None  # a tuple of the form (column, order)
+    daily: bool = True  # whether it is downloaded for every day, otherwise over all days with yearly aggregation
+    labels: str = None  # the column with the labels of each row, e.g. 'AdLabels'
+
+
+REPORTS = {
+    'ad': ReportDefinition(
+        'AdPerformanceReport', 'My Ad Performance Report', 'ad_performance',
+        ('TimePeriod', 'DeviceType',
+         'AccountId', 'AccountName', 'AccountNumber', 'AccountStatus',
+         'CampaignId', 'CampaignName', 'CampaignStatus',
+         'AdGroupId', 'AdGroupName', 'AdGroupStatus',
+         'AdId', 'AdTitle', 'AdDescription', 'AdType', 'AdLabels',
+         'Impressions', 'Clicks', 'Ctr', 'Spend', 'AveragePosition', 'Conversions', 'ConversionRate',
+         'CostPerConversion'),
+        labels='AdLabels'),
+    'keyword': ReportDefinition(
+        'KeywordPerformanceReport', 'My Keyword Performance Report', 'keyword_performance',
+        ('TimePeriod', 'Network', 'DeviceType', 'BidMatchType',
+         'AccountId', 'AccountName', 'CampaignId', 'CampaignName', 'AdGroupId', 'AdGroupName', 'AdId',
+         'KeywordId', 'Keyword',
+         'Clicks', 'Impressions', 'Ctr', 'AverageCpc', 'Spend', 'QualityScore', 'Conversions', 'Revenue'),
+        sort=('Clicks', 'Ascending')),
+    'campaign': ReportDefinition(
+        'CampaignPerformanceReport', 'My Campaign Performance Report', 'campaign_performance',
+        ('TimePeriod',
+         'AccountId', 'AccountName', 'CampaignId', 'CampaignName', 'CampaignLabels',
+         'Spend'),
+        labels='CampaignLabels'),
+    'ad_account_structure': ReportDefinition(
+        'AdPerformanceReport', 'My Ad Performance Report', 'ad_account_structure',
+        ('TimePeriod', 'DeviceType',
+         'AccountId', 'AccountName', 'AccountNumber', 'AccountStatus',
+         'CampaignId', 'CampaignName', 'CampaignStatus',
+         'AdGroupId', 'AdGroupName', 'AdGroupStatus',
+         'AdId', 'AdTitle', 'AdDescription', 'AdType', 'AdLabels',
+         'Impressions'),  # need to include impressions, otherwise API call fails??
+        daily=False, labels='AdLabels'),
+    'campaign_labels': ReportDefinition(
+        'CampaignPerformanceReport', 'My Campaign Performance Report', 'campaign_labels',
+        ('TimePeriod',
+         'AccountId', 'AccountName', 'CampaignId', 'CampaignName', 'CampaignLabels',
+         'Spend'),  # fails without adding spend
+        daily=False, labels='CampaignLabels')
+}
+
+
+def daily_reports() -> [str]:
+    """The reports that are downloaded for every day"""
+    return [report for report, definition in REPORTS.items() if definition.daily]
+
+
+class RequestTemplates:
+    """
+    Builds the request of every report type and the scope and date objects once with the suds factory
+    and creates requests for single days, date ranges and shards by copying them
+    """
+
+    def __init__(self, factory):
+        """
+        Args:
+            factory: the suds factory of the reporting service client
+        """
+        self._factory = factory
+        self._requests = {}
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def build(self, report: str, last_date: datetime = None, first_date: datetime = None, shard=None):
+        """
+        Creates a report request
+        Args:
+            report: a key of REPORTS
+            last_date: the last day of the report, today when not set
+            first_date: the first day of the report, `last_date` for daily reports and config.first_date()
+                        for all other reports when not set
+            shard: the accounts or campaigns to request (a downloader.ReportShard), all accounts when not set
+        Returns:
+            A report request object
+        """
+        with self._lock:
+            if report not in self._requests:
+                self._requests[report] = self._create_request(REPORTS[report])
+        report_request = _copy(self._requests[report])
+        report_request.Scope = self._scope(shard)
+        report_request.Time = self._time(REPORTS[report], last_date, first_date)
+        return report_request
+
+    def _create_request(self, definition: ReportDefinition):
+        report_request = self._factory.create(definition.report_type + 'Request')
+        report_request.Format = 'Csv'
+        report_request.ReportName = definition.report_name
+        report_request.ReturnOnlyCompleteData = False
+        report_request.Aggregation = 'Daily' if definition.daily else 'Yearly'
+
+        report_columns = self._factory.create('ArrayOf{}Column'.format(definition.report_type))
+        getattr(report_columns, definition.report_type + 'Column').append(list(definition.columns))
+        report_request.Columns = report_columns
+
+        if definition.sort:
+            report_sorts = self._factory.create('ArrayOf{}Sort'.format(definition.report_type))
+            report_sort = self._factory.create(definition.report_type + 'Sort')
+            report_sort.SortColumn, report_sort.SortOrder = definition.sort
+            getattr(report_sorts, definition.report_type + 'Sort').append(report_sort)
+            report_request.Sort = report_sorts
+        return report_request
+
+    def _new(self, type_name: str):
+        """Returns a copy of an empty object of a suds type that is created only once"""
+        with self._lock:
+            if type_name not in self._objects:
+                self._objects[type_name] = self._factory.create(type_name)
+        return _copy(self._objects[type_name])
+
+    def _scope(self, shard=None):
+        """Creates an AccountThroughCampaignReportScope of all accounts or of the accounts or campaigns of a shard"""
+        scope = self._new('AccountThroughCampaignReportScope')
+        if shard is None:
+            scope.AccountIds = {'long': config.oauth2_account_array()}
+            scope.Campaigns = None
+        elif shard.campaign_ids:
+            scope.AccountIds = None
+            scope.Campaigns = self._new('ArrayOfCampaignReportScope')
+            scope.Campaigns.CampaignReportScope = []
+            for campaign_id in shard.campaign_ids:
+                campaign_scope = self._new('CampaignReportScope')
+                campaign_scope.AccountId = shard.account_ids[0]
+                campaign_scope.CampaignId = campaign_id
+                scope.Campaigns.CampaignReportScope.append(campaign_scope)
+        else:
+            scope.AccountIds = {'long': list(shard.account_ids)}
+            scope.Campaigns = None
+        return scope
+
+    def _time(self, definition: ReportDefinition, last_date: datetime = None, first_date: datetime = None):
+        """Creates the ReportTime of a custom date range"""
+        if last_date is None:
+            last_date = datetime.datetime.now()  # for example for downloading current campaign structure
+        if first_date is None:
+            first_date = last_date if definition.daily \
+                else datetime.datetime.strptime(config.first_date(), '%Y-%m-%d')
+        report_time = self._new('ReportTime')
+        report_time.CustomDateRangeStart = self._date(first_date)
+        report_time.CustomDateRangeEnd = self._date(last_date)
+        report_time.PredefinedTime = None
+        report_time.ReportTimeZone = None
+        return report_time
+
+    def _date(self, date: datetime):
+        result = self._new('Date')
+        result.Day, result.Month, result.Year = date.day, date.month, date.year
+        return result
+
+
+def _copy(suds_object):
+    """A shallow copy of a suds object, its nested objects are shared with the original"""
+    copy = type(suds_object)()
+    for name in suds_object.__keylist__:
+        setattr(copy, name, getattr(suds_object, name))
+    copy.__metadata__ = suds_object.__metadata__
+    return copy
@@ -0,0 +1,195 @@
+"""
+Retries of report jobs: errors are classified as transient, throttled, auth or permanent, transient and throttled
+errors are retried with exponential backoff and jitter, and a circuit breaker that is shared by all jobs pauses
+all work when Bing fails across the board.
+"""
+
+import random
+import socket
+import sys
+import threading
+import time
+import urllib.error
+
+import requests
+from bingads.exceptions import OAuthTokenRequestException, TimeoutException
+from bingads.v13.reporting.exceptions import ReportingException
+from suds import WebFault
+
+from bingads_downloader import config
+from bingads_downloader.metrics import metrics
+from bingads_downloader.rate_limit import fault_error_codes, throttling_pause
+from bingads_downloader.report_file import ReportValidationError
+
+TRANSIENT = 'transient'  # network errors, server errors, failed report generations, timeouts, incomplete reports
+THROTTLED = 'throttled'  # too many calls, after the rate limiter already paused and repeated the call
+AUTH = 'auth'  # rejected credentials, retried once with a new access token
+PERMANENT = 'permanent'  # invalid requests and errors of the downloader itself, never retried
+
+# Bing error codes of rejected credentials: InvalidCredentials, UserIsNotAuthorized, AuthenticationTokenExpired
+# (which a new access token resolves)
+AUTH_ERROR_CODES = {105, 106, 109}
+
+# Bing error codes of temporary failures: InternalError
+TRANSIENT_ERROR_CODES = {0}
+
+# HTTP status codes of rejected credentials
+AUTH_STATUS_CODES = {401, 403}
+
+
+class BingUnavailableError(RuntimeError):
+    """Raised when the circuit breaker gives up because Bing kept failing across the board"""
+
+
+def classify_error(error: BaseException) -> str:
+    """
+    Classifies an error of a report job
+    Returns:
+        TRANSIENT, THROTTLED, AUTH or PERMANENT
+    """
+    if throttling_pause(error) is not None:
+        return THROTTLED
+    if isinstance(error, OAuthTokenRequestException):
+        return AUTH
+    if isinstance(error, WebFault):
+        codes = fault_error_codes(error)
+        if codes & AUTH_ERROR_CODES:
+            return AUTH
+        return TRANSIENT if not codes or codes & TRANSIENT_ERROR_CODES else PERMANENT
+    status_code = error.response.status_code if isinstance(error, requests.HTTPError) and error.response is not None \
+        else error.code if isinstance(error, urllib.error.HTTPError) else None
+    if status_code is not None:
+        if status_code in AUTH_STATUS_CODES:
+            return AUTH
+        return TRANSIENT if status_code >= 500 else PERMANENT
+    if isinstance(error, (urllib.error.URLError, requests.RequestException, ReportValidationError,
+                          TimeoutException, ReportingException, ConnectionError, socket.timeout)):
+        return TRANSIENT
+    return PERMANENT
+
+
+def backoff_seconds(retry: int, error_class: str) -> float:
+    """
+    The seconds to wait before a retry: config.retry_timeout_interval(), doubled for every further retry up to
+    config.max_retry_interval() and at least config.throttling_pause() after throttling, of which a random
+    share of up to half is left out so that failed jobs do not retry in lockstep
+    Args:
+        retry: the number of the retry, starting with 1
+        error_class: the class of the error, see classify_error()
+    """
+    seconds = min(float(config.max_retry_interval()), float(config.retry_timeout_interval()) * 2 ** (retry - 1))
+    if error_class == THROTTLED:
+        seconds = max(seconds, float(config.throttling_pause()))
+    return random.uniform(seconds / 2, seconds)
+
+
+class CircuitBreaker:
+    """
+    Pauses all report jobs when Bing fails across the board.
+
+    After `failure_threshold` failed attempts of any jobs in a row, the circuit opens and no job starts another
+    attempt for `pause` seconds. Then a single attempt probes Bing: when it succeeds, the circuit closes, when it
+    fails, the circuit opens again for twice as long. Failures while the circuit is open do not count against the
+    attempts of the jobs. After `max_opens` openings without a successful attempt in between, all jobs give up.
+    """
+
+    def __init__(self, failure_threshold: int, pause: float, max_opens: int):
+        """
+        Args:
+            failure_threshold: the failed attempts in a row that open the circuit, 0 to never open it
+            pause: the seconds of the first pause, doubled for every further opening
+            max_opens: the openings in a row after which all jobs give up
+        """
+        self._failure_threshold = failure_threshold
+        self._pause = pause
+        self._max_opens = max_opens
+        self._condition = threading.Condition()
+        self._failures = 0
+        self._opens = 0
+        self._open_until = None  # time.monotonic() until which the circuit is open, None while it is closed
+        self._probe = None  # the thread that probes Bing after a pause
+        self.paused_seconds = 0.0
+
+    def wait(self):
+        """Blocks while the circuit is open or another job probes Bing, raises BingUnavailableError after giving up"""
+        start_time, paused = time.monotonic(), False
+        with self._condition:
+            while True:
+                if self.exhausted:
+                    raise BingUnavailableError('Bing failed across the board {} times in a row, giving up'
+                                               .format(self._opens))
+                now = time.monotonic()
+                if self._open_until is None:
+                    break
+                paused = True
+                if now < self._open_until:
+                    self._condition.wait(self._open_until - now)
+                elif self._probe in (None, threading.get_ident()):
+                    self._probe = threading.get_ident()
+                    break
+                else:
+                    self._condition.wait()
+            if paused:
+                self.paused_seconds += time.monotonic() - start_time
+
+    def succeeded(self):
+        """Records a successful attempt, which closes the circuit"""
+        with self._condition:
+            self._failures, self._opens, self._open_until, self._probe = 0, 0, None, None
+            self._condition.notify_all()
+
+    def released(self):
+        """Records an attempt that ended with an error that says nothing about Bing, which lets another job probe"""
+        with self._condition:
+            if self._probe == threading.get_ident():
+                self._probe = None
+                self._condition.notify_all()
+
+    def failed(self) -> bool:
+        """
+        Records a failed attempt with a transient or throttling error
+        Returns:
+            Whether the failure counts against the attempts of the job, i.e. the circuit was closed and stays closed
+        """
+        with self._condition:
+            if self._open_until is not None:
+                if self._probe == threading.get_ident():
+                    self._open()
+                return False
+            self._failures += 1
+            if self._failure_threshold <= 0 or self._failures < self._failure_threshold:
+                return True
+            self._open()
+            return False
+
+    @property
+    def exhausted(self) -> bool:
+        """Whether all jobs give up"""
+        return self._opens >= self._max_opens
+
+    def _open(self):
+        self._opens += 1
+        pause = self._pause * 2 ** (self._opens - 1)
+        self._open_until, self._probe = time.monotonic() + pause, None
+        metrics().increment('circuit_opens')
+        if self.exhausted:
+            print('Bing failed across the board {} times in a row, giving up'.format(self._opens), file=sys.stderr)
+        else:
+            print('Bing failed {} times in a row, pausing all jobs for {:.0f} seconds'
+                  .format(self._failures, pause), file=sys.stderr)
+        self._condition.notify_all()
+
+
+_circuit_breaker = None
+_circuit_breaker_lock = threading.Lock()
+
+
+def circuit_breaker() -> CircuitBreaker:
+    """Returns the circuit breaker of the run"""
+    global _circuit_breaker
+    with _circuit_breaker_lock:
+        if _circuit_breaker is None:
+            _circuit_breaker = CircuitBreaker(int(config.circuit_breaker_failures()),
+                                              float(config.circuit_breaker_pause()),
+                                              int(config.total_attempts_for_single_day()))
+        return _circuit_breaker
@@ -0,0 +1,44 @@
+"""
+Runs report jobs concurrently while keeping a bounded number of them in flight
+"""
+
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterable
+
+
+def run_jobs(function: Callable, jobs: Iterable, max_concurrent: int):
+    """
+    Calls `function` for every job, with at most `max_concurrent` calls running at the same time.
+    Jobs are consumed lazily, so `jobs` can be a generator over a long date range.
+    When a job fails, no further jobs are started, the jobs in flight are awaited and the error is re-raised.
+    Args:
+        function: a function that gets a single job as argument
+        jobs: the jobs to process, in the order in which they should be started
+        max_concurrent: the maximum number of jobs that are processed at the same time
+    """
+    max_concurrent = max(1, int(max_concurrent))
+    error = None
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        pending = set()
+        for job in jobs:
+            pending.add(executor.submit(function, job))
+            if len(pending) >= max_concurrent:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                error = _first_error(done)
+                if error:
+                    print('A job failed, waiting for {} running jobs to finish'.format(len(pending)),
+                          file=sys.stderr)
+                    break
+        done, _ = wait(pending)
+        error = error or _first_error(done)
+    if error:
+        raise error
+
+
+def _first_error(futures) -> BaseException:
+    """Returns the first exception raised by one of the finished futures, if any"""
+    for future in futures:
+        if future.exception() is not None:
+            return future.exception()
+    return None
@@ -0,0 +1,169 @@
+"""
+Caches the OAuth access token in a file that only the owner can read, so that runs and concurrent workers
+reuse a valid token instead of requesting a new one, and renews it in the background before it expires
+"""
+
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+from bingads import OAuthDesktopMobileAuthCodeGrant, OAuthTokenRequestException, OAuthTokens
+
+from bingads_downloader import config
+
+try:
+    import fcntl
+except ImportError:  # no file locks on Windows, where concurrent workers are not supported
+    fcntl = None
+
+
+class TokenCache:
+    """
+    A JSON file with the access token, its expiry and the latest refresh token of a client id and refresh token.
+    Reads and writes are serialized between threads and, with a lock file, between processes.
+    """
+
+    def __init__(self, path: Path):
+        """
+        Args:
+            path: the location of the cache file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Holds the lock of the cache, also against other processes"""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            lock_file = os.open(str(self.path) + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(lock_file)
+
+    def read(self) -> dict:
+        """Returns the cached token, or an empty dictionary when there is none"""
+        try:
+            with open(str(self.path)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write(self, entry: dict):
+        """Replaces the cached token with a file that is only readable by the owner"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with os.fdopen(os.open(str(tmp_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(entry, f)
+        os.chmod(str(tmp_path), 0o600)
+        os.replace(str(tmp_path), str(self.path))
+
+
+def token_cache() -> TokenCache:
+    """Returns the cache of config.oauth2_token_cache(), or None when caching is disabled"""
+    if not config.oauth2_token_cache():
+        return None
+    return TokenCache(Path(config.data_dir(), config.oauth2_token_cache()).expanduser())
+
+
+def cached_authentication(refresh_token: str, cache: TokenCache = None,
+                          min_validity: float = None) -> (OAuthDesktopMobileAuthCodeGrant, float):
+    """
+    Returns an authentication with an access token that is valid for at least `min_validity` seconds,
+    either from the cache or requested with the refresh token
+    Args:
+        refresh_token: the refresh token of config.oauth2_refresh_token()
+        cache: the token cache, when not set the token is always requested
+        min_validity: the seconds the token has to remain valid, config.oauth2_token_refresh_margin() when not set
+    Returns:
+        A tuple of the form (authentication, time.time() at which the access token expires)
+    """
+    if min_validity is None:
+        min_validity = int(config.oauth2_token_refresh_margin())
+    key = hashlib.sha256('{}:{}'.format(config.oauth2_client_id(), refresh_token).encode()).hexdigest()
+
+    with cache.locked() if cache else contextlib.suppress():
+        entry = cache.read() if cache else {}
+        if entry.get('key') == key and entry.get('expires_at', 0) - time.time() > min_validity:
+            tokens = OAuthTokens(entry['access_token'], int(entry['expires_at'] - time.time()), entry['refresh_token'])
+            return OAuthDesktopMobileAuthCodeGrant(client_id=config.oauth2_client_id(), oauth_tokens=tokens), \
+                   entry['expires_at']
+
+        authentication = OAuthDesktopMobileAuthCodeGrant(client_id=config.oauth2_client_id())
+        latest_refresh_token = entry.get('refresh_token') if entry.get('key') == key else None
+        try:
+            # Microsoft may hand out a new refresh token on every refresh
+            authentication.request_oauth_tokens_by_refresh_token(latest_refresh_token or refresh_token)
+        except OAuthTokenRequestException:
+            if not latest_refresh_token or latest_refresh_token == refresh_token:
+                raise
+            authentication.request_oauth_tokens_by_refresh_token(refresh_token)
+        tokens = authentication.oauth_tokens
+        expires_at = time.time() + int(tokens.access_token_expires_in_seconds or 3600)
+        if cache:
+            cache.write({'key': key, 'access_token': tokens.access_token, 'expires_at': expires_at,
+                         'refresh_token': tokens.refresh_token or latest_refresh_token or refresh_token,
+                         'refreshed_at': datetime.datetime.now().isoformat(timespec='seconds')})
+        return authentication, expires_at
+
+
+class TokenRefresher:
+    """
+    Renews the access token of an api client in a daemon thread config.oauth2_token_refresh_margin() seconds
+    before it expires. Report jobs keep using the old token until the new one is set.
+    """
+
+    def __init__(self, api_client, refresh_token: str, expires_at: float, cache: TokenCache = None):
+        """
+        Args:
+            api_client: the service client whose authorization data is updated
+            refresh_token: the refresh token of config.oauth2_refresh_token()
+            expires_at: time.time() at which the current access token expires
+            cache: the token cache shared with other runs
+        """
+        self._api_client = api_client
+        self._refresh_token = refresh_token
+        self._cache = cache
+        self.expires_at = expires_at
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='token-refresher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops renewing the access token, at the end of a run"""
+        self._stopped.set()
+        self._thread.join(timeout=10)
+
+    def renew(self):
+        """Requests a new access token right away, e.g. after Bing rejected the current one"""
+        authentication, self.expires_at = cached_authentication(self._refresh_token, self._cache,
+                                                                min_validity=float('inf'))
+        self._api_client.authorization_data.authentication = authentication
+        print('Renewed the OAuth access token, valid until {:%H:%M:%S}'
+              .format(datetime.datetime.fromtimestamp(self.expires_at)))
+
+    def _run(self):
+        margin = int(config.oauth2_token_refresh_margin())
+        while not self._stopped.wait(max(0, self.expires_at - margin - time.time())):
+            try:
+                authentication, self.expires_at = cached_authentication(
+                    self._refresh_token, self._cache, min_validity=margin + 60)
+                self._api_client.authorization_data.authentication = authentication
+                print('Renewed the OAuth access token, valid until {:%H:%M:%S}'
+                      .format(datetime.datetime.fromtimestamp(self.expires_at)))
+            except Exception as error:  # the client still refreshes an expired token itself
+                print('Could not renew the OAuth access token, retrying in a minute: {}'.format(error),
+                      file=sys.stderr)
+                if self._stopped.wait(60):
+                    return
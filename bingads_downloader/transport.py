@@ -0,0 +1,129 @@
+"""
+A keep-alive HTTP session that is shared by all SOAP calls and report downloads of a run,
+and a cache of parsed WSDL documents
+"""
+
+import io
+import pickle
+import threading
+import urllib.request
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+from suds.cache import FileCache, ObjectCache
+from suds.transport import Reply, Transport, TransportError
+
+from bingads_downloader import config
+
+
+def create_session(max_connections: int) -> requests.Session:
+    """
+    Creates a session that keeps up to `max_connections` connections per host open for reuse
+    Args:
+        max_connections: the maximum number of connections per host
+    Returns:
+        A requests session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_connections)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def connection_statistics(session: requests.Session) -> (int, int):
+    """
+    Counts the connections of a session
+    Returns:
+        A tuple of the form (number of opened connections, number of requests that reused a connection)
+    """
+    opened, requests_sent = 0, 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            opened += pools[key].num_connections
+            requests_sent += pools[key].num_requests
+    return opened, requests_sent - opened
+
+
+class RequestsTransport(Transport):
+    """A suds transport that sends SOAP requests through a requests session instead of urllib"""
+
+    def __init__(self, session: requests.Session, timeout: float = None):
+        """
+        Args:
+            session: the session to send requests with
+            timeout: the timeout of a single request in seconds
+        """
+        super().__init__()
+        self.session = session
+        self.timeout = timeout
+
+    def open(self, request):
+        if request.url.startswith('file:'):
+            return urllib.request.urlopen(request.url)
+        response = self.session.get(request.url, headers=request.headers, timeout=self.timeout)
+        response.raise_for_status()
+        return io.BytesIO(response.content)
+
+    def send(self, request):
+        response = self.session.post(request.url, data=request.message, headers=request.headers,
+                                     timeout=self.timeout)
+        if response.status_code in (202, 204):
+            return None
+        if response.status_code >= 400:
+            # suds parses SOAP faults from the body of the error
+            raise TransportError(response.reason, response.status_code, io.BytesIO(response.content))
+        return Reply(response.status_code, response.headers, response.content)
+
+
+class MemoryObjectCache(ObjectCache):
+    """
+    A suds cache of parsed WSDL and XSD documents on disk that additionally keeps the pickled documents
+    in memory, so that service clients of the same process are constructed without reading files.
+    Every client gets a copy of its own, as suds modifies the documents.
+    """
+
+    def __init__(self, location: str, days: int):
+        super().__init__(location, days=days)
+        self._pickles = {}
+        self._lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+
+    def get(self, id):
+        with self._lock:
+            if id not in self._pickles:
+                self._pickles[id] = FileCache.get(self, id)
+            data = self._pickles[id]
+            if data is not None:
+                try:
+                    document = pickle.loads(data)
+                    self.hits += 1
+                    return document
+                except Exception:  # written by another version of suds
+                    del self._pickles[id]
+                    self.purge(id)
+            self.misses += 1
+            return None
+
+    def put(self, id, object):
+        data = pickle.dumps(object, self.protocol)
+        with self._lock:
+            self._pickles[id] = data
+            FileCache.put(self, id, data)
+        return object
+
+
+_wsdl_cache = None
+_wsdl_cache_lock = threading.Lock()
+
+
+def wsdl_cache() -> MemoryObjectCache:
+    """Returns the cache of parsed service definitions in config.wsdl_cache_dir()"""
+    global _wsdl_cache
+    with _wsdl_cache_lock:
+        if _wsdl_cache is None:
+            _wsdl_cache = MemoryObjectCache(str(Path(config.wsdl_cache_dir()).expanduser()),
+                                            days=int(config.wsdl_cache_days()))
+        return _wsdl_cache
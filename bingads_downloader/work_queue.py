@@ -0,0 +1,239 @@
+"""
+A queue of report jobs in a SQLite database in the data directory, from which several worker processes
+(also on different hosts that share the data directory) take jobs.
+
+Workers lease jobs for config.lease_timeout() seconds and renew the leases of their running jobs
+from a heartbeat thread. Jobs of workers that died are taken by other workers once their lease expired.
+Before the jobs of a plan are leased, one worker prepares it (updates the account structure) while the
+others wait, with a lease that is renewed in the same way.
+"""
+
+import datetime
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+from bingads_downloader import config
+
+
+class WorkQueue:
+    """
+    Holds one plan of jobs per last day and output file version, which is prepared once by one worker.
+    A job is `pending`, `leased` by a worker, `done` or `failed` after too many attempts.
+    """
+
+    def __init__(self, path: Path, worker: str = None):
+        """
+        Args:
+            path: the location of the SQLite database, created if it does not exist
+            worker: the name of this worker, host name and process id when not set
+        """
+        self.worker = worker or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(path), timeout=60, check_same_thread=False, isolation_level=None)
+        self._connection.execute('''
+CREATE TABLE IF NOT EXISTS job (
+    id          INTEGER PRIMARY KEY,
+    plan        TEXT NOT NULL,
+    first_date  TEXT NOT NULL,
+    last_date   TEXT NOT NULL,
+    report      TEXT NOT NULL,
+    status      TEXT NOT NULL,
+    worker      TEXT,
+    lease_until REAL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    error       TEXT
+)''')
+        self._connection.execute('''
+CREATE TABLE IF NOT EXISTS plan (
+    plan        TEXT PRIMARY KEY,
+    worker      TEXT,
+    created_at  TEXT,
+    prepared    INTEGER NOT NULL DEFAULT 0,
+    lease_until REAL
+)''')
+        if 'prepared' not in [row[1] for row in self._connection.execute('PRAGMA table_info(plan)')]:
+            # plans of a previous version were prepared by the worker that created them
+            self._connection.execute('ALTER TABLE plan ADD COLUMN prepared INTEGER NOT NULL DEFAULT 1')
+            self._connection.execute('ALTER TABLE plan ADD COLUMN lease_until REAL')
+
+    def plan(self, plan: str, create_jobs: Callable[[], Iterable]) -> bool:
+        """
+        Fills the queue with the jobs of a plan unless another worker did so before
+        Args:
+            plan: the name of the plan, e.g. the last day and the output file version
+            create_jobs: a function that returns the jobs of the plan (objects with first_date, last_date & report)
+        Returns:
+            True when this worker created the plan
+        """
+        with self._lock:
+            if self._connection.execute('SELECT 1 FROM plan WHERE plan = ?', (plan,)).fetchone():
+                return False
+        # the jobs are created without holding the write lock, which other workers need to claim jobs and renew leases
+        jobs = [('{:%Y-%m-%d}'.format(job.first_date), '{:%Y-%m-%d}'.format(job.last_date), job.report)
+                for job in create_jobs()]
+        with self._lock, self._connection:
+            self._connection.execute('BEGIN IMMEDIATE')
+            if self._connection.execute('SELECT 1 FROM plan WHERE plan = ?', (plan,)).fetchone():
+                return False
+            self._connection.execute(
+                'INSERT INTO plan (plan, worker, created_at, prepared, lease_until) VALUES (?, ?, ?, 0, ?)',
+                (plan, self.worker, datetime.datetime.now().isoformat(timespec='seconds'),
+                 time.time() + int(config.lease_timeout())))
+            self._connection.executemany(
+                "INSERT INTO job (plan, first_date, last_date, report, status) VALUES (?, ?, ?, ?, 'pending')",
+                ((plan,) + job for job in jobs))
+            return True
+
+    def prepare(self, plan: str, prepare_plan: Callable[[], None]):
+        """
+        Calls `prepare_plan` in the worker that created the plan, or in another worker when that one stopped
+        renewing its lease before the preparation was done. Blocks until the plan is prepared.
+        Args:
+            plan: the name of the plan
+            prepare_plan: a function that prepares the plan, e.g. updates the account structure
+        """
+        waiting = False
+        while True:
+            now = time.time()
+            with self._lock, self._connection:
+                self._connection.execute('BEGIN IMMEDIATE')
+                prepared, worker, lease_until = self._connection.execute(
+                    'SELECT prepared, worker, lease_until FROM plan WHERE plan = ?', (plan,)).fetchone()
+                if prepared:
+                    return
+                preparing = worker == self.worker or (lease_until or 0) < now
+                if preparing:
+                    self._connection.execute('UPDATE plan SET worker = ?, lease_until = ? WHERE plan = ?',
+                                             (self.worker, now + int(config.lease_timeout()), plan))
+            if preparing:
+                break
+            if not waiting:
+                print('Worker {} waits for worker {} to prepare the plan'.format(self.worker, worker))
+                waiting = True
+            time.sleep(min(5, heartbeat_interval()))
+
+        try:
+            prepare_plan()
+        except BaseException:
+            with self._lock:  # let another worker take over right away
+                self._connection.execute('UPDATE plan SET lease_until = NULL WHERE plan = ?', (plan,))
+            raise
+        with self._lock:
+            self._connection.execute('UPDATE plan SET prepared = 1, lease_until = NULL WHERE plan = ?', (plan,))
+
+    def claim(self, plan: str) -> (int, str, str, str):
+        """
+        Leases the next pending job of a plan, or a job whose lease expired
+        Returns:
+            A tuple of the form (job id, first date, last date, report), or None when no job can be leased
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute('BEGIN IMMEDIATE')
+            row = self._connection.execute('''
+SELECT id, first_date, last_date, report
+FROM job
+WHERE plan = ? AND (status = 'pending' OR (status = 'leased' AND lease_until < ?))
+ORDER BY id
+LIMIT 1''', (plan, now)).fetchone()
+            if row:
+                self._connection.execute(
+                    "UPDATE job SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                    "WHERE id = ?", (self.worker, now + int(config.lease_timeout()), row[0]))
+            return row
+
+    def next_lease_expiry(self, plan: str) -> float:
+        """Returns when the first lease of another worker expires, or None when no job is left to do"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT MIN(lease_until), COUNT(*) FROM job WHERE plan = ? AND status IN ('pending', 'leased')",
+                (plan,)).fetchone()
+        return (row[0] or time.time()) if row[1] else None
+
+    def renew(self):
+        """Extends the leases of all jobs that this worker is running and of the plan that it prepares"""
+        lease_until = time.time() + int(config.lease_timeout())
+        with self._lock:
+            self._connection.execute("UPDATE job SET lease_until = ? WHERE worker = ? AND status = 'leased'",
+                                     (lease_until, self.worker))
+            self._connection.execute('UPDATE plan SET lease_until = ? WHERE worker = ? AND prepared = 0',
+                                     (lease_until, self.worker))
+
+    def finish(self, job_id: int, error: BaseException = None):
+        """
+        Marks a job as done, or hands it back to the queue after an error.
+        Jobs are failed after config.total_attempts_for_single_day() attempts.
+        """
+        with self._lock:
+            if error is None:
+                self._connection.execute("UPDATE job SET status = 'done', lease_until = NULL WHERE id = ?",
+                                         (job_id,))
+            else:
+                self._connection.execute(
+                    "UPDATE job SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                    "lease_until = NULL, error = ? WHERE id = ?",
+                    (int(config.total_attempts_for_single_day()), repr(error), job_id))
+
+    def counts(self, plan: str) -> {str: int}:
+        """Returns the number of jobs of a plan per status"""
+        with self._lock:
+            return dict(self._connection.execute('SELECT status, COUNT(*) FROM job WHERE plan = ? GROUP BY status',
+                                                 (plan,)).fetchall())
+
+
+def leased_jobs(queue: WorkQueue, plan: str) -> Iterator[tuple]:
+    """
+    Leases jobs of a plan one by one as long as jobs are left, waiting for the leases of other workers to expire
+    Returns:
+        A generator of tuples of the form (job id, first date, last date, report)
+    """
+    while True:
+        job = queue.claim(plan)
+        if job:
+            yield job
+            continue
+        expiry = queue.next_lease_expiry(plan)
+        if expiry is None:
+            return
+        time.sleep(min(max(expiry - time.time(), 1), heartbeat_interval()))
+
+
+def heartbeat_interval() -> float:
+    """The seconds between two renewals of the leases of a worker"""
+    return max(1, int(config.lease_timeout()) / 3)
+
+
+class Heartbeat:
+    """A context manager that renews the leases of a worker in a background thread"""
+
+    def __init__(self, queue: WorkQueue):
+        self._queue = queue
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='heartbeat', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(heartbeat_interval()):
+            try:
+                self._queue.renew()
+            except Exception as error:  # e.g. a locked database, the leases are renewed again at the next beat
+                print('Worker {} failed to renew its leases: {!r}'.format(self._queue.worker, error), file=sys.stderr)
+
+
+def work_queue() -> WorkQueue:
+    """Returns the work queue of the data directory"""
+    Path(config.data_dir()).mkdir(parents=True, exist_ok=True)
+    return WorkQueue(Path(config.data_dir(), 'bing-work-queue.sqlite3'))
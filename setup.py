@@ -9,10 +9,18 @@ setup(
 
     install_requires=[
         'bingads==13.0.1',
-        'click>=6.0'
+        'click>=6.0',
+        'requests'
     ],
 
-    packages=find_packages(),
+    extras_require={
+        'parquet': ['pyarrow'],
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+        'test': ['pytest']
+    },
+
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*', 'tests', 'tests.*']),
 
     author='Mara contributors',
     license='MIT',
@@ -20,8 +28,10 @@ setup(
     entry_points={
         'console_scripts': [
             'download-bingsads-performance-data=bingads_downloader.cli:download_data',
-            'refresh-bingsads-api-oauth2-token=bingads_downloader.cli:refresh_oauth2_token'
+            'refresh-bingsads-api-oauth2-token=bingads_downloader.cli:refresh_oauth2_token',
+            'query-bingsads-performance-data=bingads_downloader.cli:query_data',
+            'compact-bingsads-performance-data=bingads_downloader.cli:compact_data'
         ]
     },
-    python_requires='>=3.6'
+    python_requires='>=3.7'
 )
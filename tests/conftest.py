@@ -0,0 +1,11 @@
+import pytest
+
+from bingads_downloader import config, manifest
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """Points the data directory to a temporary directory, with a download manifest of its own"""
+    monkeypatch.setattr(config, 'data_dir', lambda: str(tmp_path))
+    monkeypatch.setattr(manifest, '_manifest', None)
+    return tmp_path
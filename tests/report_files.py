@@ -0,0 +1,60 @@
+"""
+Synthetic reports in the layout in which Bing sends them
+"""
+
+import datetime
+import io
+from pathlib import Path
+
+from bingads_downloader.compression import open_compressed
+from bingads_downloader.report_file import merge_reports, write_report
+from bingads_downloader.reports import REPORTS
+
+CAMPAIGN_COLUMNS = list(REPORTS['campaign'].columns)
+
+FOOTER = [[], ['©2020 Microsoft Corporation. All rights reserved. ']]
+
+
+def preamble(row_count: int, report_name: str = 'My Campaign Performance Report') -> [[str]]:
+    """The 10 lines of report metadata before the column header"""
+    return [['Report Name: {}'.format(report_name)], ['Report Time: 1/1/2020'], ['Time Zone: (GMT+01:00) Berlin'],
+            ['Last Completed Available Day: 1/1/2020'], ['Last Completed Available Hour: 1/1/2020'],
+            ['Report Aggregation: Daily'], ['Report Filter: '], ['Potential Incomplete Data: false'],
+            ['Rows: {}'.format(row_count)], ['']]
+
+
+def campaign_rows(day: datetime.date, account_ids: [str] = ('1001', '1002'), campaigns: int = 3) -> [[str]]:
+    """Rows of the campaign report of a day, with `campaigns` campaigns per account"""
+    return [['{d.month}/{d.day}/{d.year}'.format(d=day), account_id, 'Account {}'.format(account_id),
+             '{}{:02d}'.format(account_id, i), 'Campaign {}'.format(i), '', '{}.{:02d}'.format(i, day.day)]
+            for account_id in account_ids for i in range(campaigns)]
+
+
+def bing_report(rows: [[str]], header: [str] = None, row_count: int = None, footer: [[str]] = None) -> str:
+    """A report as CSV text, announcing `row_count` rows (the number of rows when not set)"""
+    text = io.StringIO(newline='')
+    write_report(text, preamble(len(rows) if row_count is None else row_count), header or CAMPAIGN_COLUMNS, rows,
+                 FOOTER if footer is None else footer)
+    return text.getvalue()
+
+
+def write_compressed_report(file_path: Path, rows: [[str]]):
+    """Writes a campaign report with the configured codec"""
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    with open_compressed(file_path, 'wt') as f:
+        f.write(bing_report(rows))
+
+
+def write_source_report(file_path: Path, rows: [[str]]) -> Path:
+    """Writes a campaign report as it is downloaded from Bing, but without the zip archive"""
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    file_path.write_text('\ufeff' + bing_report(rows), encoding='utf-8')
+    return file_path
+
+
+def write_performance_file(file_path: Path, rows: [[str]], schema: {str: str} = None):
+    """Writes a per-day file of the campaign report like the downloader, normalized when a schema is set"""
+    source = write_source_report(file_path.with_name(file_path.name + '.source.csv'), rows)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    merge_reports([source], file_path, CAMPAIGN_COLUMNS, compress=True, schema=schema)
+    source.unlink()
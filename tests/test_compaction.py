@@ -0,0 +1,65 @@
+import datetime
+
+import pytest
+
+from bingads_downloader import compaction, config
+from bingads_downloader.columnar import report_schema
+from bingads_downloader.compaction import compact_performance_files, compacted_day, daily_file_path
+from bingads_downloader.query import query
+from bingads_downloader.report_file import ReportReader, open_report_file
+from tests.report_files import campaign_rows, write_performance_file
+
+DAYS = [datetime.date(2020, 1, 30) + datetime.timedelta(days=i) for i in range(5)]  # January and February
+
+
+@pytest.fixture(params=['bing', 'normalized'])
+def daily_files(request, data_dir, monkeypatch):
+    """Per-day files of the campaign report, in the layout of Bing or normalized"""
+    monkeypatch.setattr(config, 'csv_layout', lambda: request.param)
+    monkeypatch.setattr(compaction, '_indexes', {})
+    schema = report_schema('campaign') if request.param == 'normalized' else None
+    for day in DAYS:
+        write_performance_file(daily_file_path(day, 'campaign'), campaign_rows(day, ['1001', '1002', '1003']),
+                               schema)
+    return data_dir
+
+
+def query_all(**filters) -> [dict]:
+    return list(query(DAYS[0], DAYS[-1], 'campaign', **filters))
+
+
+def test_queries_return_the_same_rows_before_and_after_compaction(daily_files):
+    before = query_all()
+    before_account = query_all(account_ids=['1002'])
+    before_campaign = query_all(campaign_ids=['100301'])
+    assert len(before) == len(DAYS) * 9
+    assert len(before_account) == len(DAYS) * 3
+    assert len(before_campaign) == len(DAYS)
+
+    compact_performance_files('month')
+    assert not any(daily_file_path(day, 'campaign').exists() for day in DAYS)
+    assert all(compacted_day(day, 'campaign') for day in DAYS)
+    assert query_all() == before
+    assert query_all(account_ids=['1002']) == before_account
+    assert query_all(campaign_ids=['100301']) == before_campaign
+
+    compact_performance_files('year')
+    assert query_all() == before
+    assert query_all(account_ids=['1002']) == before_account
+
+
+def test_compacted_files_are_valid_reports(daily_files):
+    compact_performance_files('month')
+    for file_path, days in ((daily_files / '2020/01/bing' / daily_file_path(DAYS[0], 'campaign').name, 2),
+                            (daily_files / '2020/02/bing' / daily_file_path(DAYS[0], 'campaign').name, 3)):
+        with open_report_file(file_path) as f:
+            reader = ReportReader(f, allow_normalized=True)
+            assert sum(1 for _ in reader) == days * 9
+            assert reader.normalized or reader.expected_row_count == days * 9
+
+
+def test_days_of_the_overwrite_window_are_not_compacted(daily_files, monkeypatch):
+    # January is final, February is still downloaded again
+    monkeypatch.setattr(compaction, 'OVERWRITE_WINDOW_DAYS', (datetime.date.today() - datetime.date(2020, 2, 1)).days)
+    compact_performance_files('month')
+    assert [daily_file_path(day, 'campaign').exists() for day in DAYS] == [False, False, True, True, True]
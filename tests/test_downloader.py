@@ -0,0 +1,62 @@
+import datetime
+from pathlib import Path
+
+import pytest
+
+from bingads_downloader import config
+from bingads_downloader.downloader import ReportJob, performance_file_path, performance_jobs
+from bingads_downloader.manifest import download_manifest
+from bingads_downloader.report_file import ContentHash
+
+LAST_DATE = datetime.datetime(2020, 3, 31)
+FIRST_DATE = LAST_DATE - datetime.timedelta(days=9)
+REPORTS = ('ad', 'keyword', 'campaign')
+
+
+@pytest.fixture
+def stable_files(data_dir, monkeypatch):
+    """Complete files of all days and reports that did not change in 3 downloads"""
+    monkeypatch.setattr(config, 'min_overwrite_days', lambda: 7)
+    manifest = download_manifest()
+    for day in (FIRST_DATE + datetime.timedelta(days=i) for i in range(10)):
+        for report in REPORTS:
+            file_path = Path(data_dir, performance_file_path(day, report))
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            file_path.touch()
+            manifest.adopt(day, report, file_path)
+            for _ in range(3):
+                manifest.unchanged(day, report)
+    return data_dir
+
+
+def planned_days(report: str) -> [datetime.date]:
+    return sorted(job.first_date.date() for job in performance_jobs(FIRST_DATE, LAST_DATE) if job.report == report)
+
+
+def test_downloads_all_days_of_the_overwrite_window_by_default(stable_files):
+    jobs = list(performance_jobs(FIRST_DATE, LAST_DATE))
+    assert len(jobs) == 10 * len(REPORTS)
+    assert ReportJob(FIRST_DATE, FIRST_DATE, 'ad') in jobs
+
+
+def test_skips_stable_days_when_enabled(stable_files, monkeypatch):
+    monkeypatch.setattr(config, 'stable_runs', lambda: 3)
+    recent_days = [(LAST_DATE - datetime.timedelta(days=i)).date() for i in range(6, -1, -1)]
+    assert planned_days('ad') == recent_days
+
+    monkeypatch.setattr(config, 'stable_runs', lambda: 4)
+    assert len(planned_days('ad')) == 10
+
+
+def test_downloads_stable_days_whose_file_is_missing(stable_files, monkeypatch):
+    monkeypatch.setattr(config, 'stable_runs', lambda: 3)
+    Path(stable_files, performance_file_path(FIRST_DATE, 'keyword')).unlink()
+    assert planned_days('keyword')[0] == FIRST_DATE.date()
+    assert planned_days('ad')[0] != FIRST_DATE.date()
+
+
+def test_downloads_stable_days_again_once_they_changed(stable_files, monkeypatch):
+    monkeypatch.setattr(config, 'stable_runs', lambda: 3)
+    file_path = Path(stable_files, performance_file_path(FIRST_DATE, 'campaign'))
+    download_manifest().complete(FIRST_DATE, 'campaign', file_path, ContentHash(['TimePeriod']))
+    assert planned_days('campaign')[0] == FIRST_DATE.date()
@@ -0,0 +1,91 @@
+import datetime
+
+import pytest
+
+from bingads_downloader import compression, config, file_index
+from bingads_downloader.columnar import report_schema
+from bingads_downloader.compaction import daily_file_path
+from bingads_downloader.file_index import FileIndexBuilder, build_file_index, load_file_index, write_file_index
+from bingads_downloader.query import query
+from bingads_downloader.report_file import merge_reports, split_report_by_day
+from tests.report_files import CAMPAIGN_COLUMNS, campaign_rows, write_source_report
+
+DAYS = [datetime.date(2020, 3, 1) + datetime.timedelta(days=i) for i in range(3)]
+ACCOUNTS = ['1001', '1002', '1003', '1004']
+
+
+@pytest.fixture(params=['bing', 'normalized'])
+def schema(request, data_dir, monkeypatch):
+    """Small gzip members, so that every file has several, and the schema of the CSV layout"""
+    monkeypatch.setattr(compression, 'BLOCK_SIZE', 2048)
+    monkeypatch.setattr(file_index, 'BLOCK_SIZE', 2048)
+    monkeypatch.setattr(config, 'csv_layout', lambda: request.param)
+    return report_schema('campaign') if request.param == 'normalized' else None
+
+
+def test_the_index_of_a_merged_report_is_collected_while_writing(schema, data_dir):
+    sources = [write_source_report(data_dir / 'source_{}.csv'.format(account_id),
+                                   campaign_rows(DAYS[0], [account_id], campaigns=20))
+               for account_id in ACCOUNTS]
+    target = daily_file_path(DAYS[0], 'campaign')
+    target.parent.mkdir(parents=True)
+    index = FileIndexBuilder()
+    merge_reports(sources, target, CAMPAIGN_COLUMNS, compress=True, schema=schema, file_index=index)
+    write_file_index(target, index)
+
+    written = load_file_index(target)
+    assert written == build_file_index(target)
+    assert len(written['blocks']) > 2
+    assert written['rows'] == 80
+    assert written['accounts'] == ACCOUNTS
+    assert written['first_date'] == written['last_date'] == '2020-03-01'
+
+
+def test_the_indexes_of_split_reports_are_collected_while_writing(schema, data_dir):
+    source = write_source_report(data_dir / 'source.csv',
+                                 [row for day in DAYS for row in campaign_rows(day, ACCOUNTS, campaigns=10)])
+    target_files = {day: daily_file_path(day, 'campaign') for day in DAYS}
+    for target in target_files.values():
+        target.parent.mkdir(parents=True)
+    indexes = {day: FileIndexBuilder() for day in DAYS}
+    split_report_by_day([source], target_files, CAMPAIGN_COLUMNS, schema, file_indexes=indexes)
+
+    for day, target in target_files.items():
+        write_file_index(target, indexes[day])
+        written = load_file_index(target)
+        assert written == build_file_index(target)
+        assert len(written['blocks']) > 1
+        assert written['first_date'] == written['last_date'] == day.isoformat()
+
+
+def test_indexed_queries_return_the_rows_of_a_full_read(schema, data_dir):
+    source = write_source_report(data_dir / 'source.csv',
+                                 [row for day in DAYS for row in campaign_rows(day, ACCOUNTS, campaigns=10)])
+    target_files = {day: daily_file_path(day, 'campaign') for day in DAYS}
+    for target in target_files.values():
+        target.parent.mkdir(parents=True)
+    split_report_by_day([source], target_files, CAMPAIGN_COLUMNS, schema)
+    all_rows = list(query(DAYS[0], DAYS[-1], 'campaign'))  # without indexes
+
+    for target in target_files.values():
+        write_file_index(target)
+    assert list(query(DAYS[0], DAYS[-1], 'campaign')) == all_rows
+    for account_id in ACCOUNTS:
+        assert list(query(DAYS[0], DAYS[-1], 'campaign', account_ids=[account_id])) \
+               == [row for row in all_rows if str(row['AccountId']) == account_id]
+    assert list(query(DAYS[0], DAYS[-1], 'campaign', campaign_ids=['100203'])) \
+           == [row for row in all_rows if str(row['CampaignId']) == '100203']
+    assert list(query(DAYS[0], DAYS[-1], 'campaign', account_ids=['9999'])) == []
+
+
+def test_the_index_of_a_changed_file_is_ignored(schema, data_dir):
+    source = write_source_report(data_dir / 'source.csv', campaign_rows(DAYS[0], ACCOUNTS))
+    target = daily_file_path(DAYS[0], 'campaign')
+    target.parent.mkdir(parents=True)
+    merge_reports([source], target, CAMPAIGN_COLUMNS, compress=True, schema=schema)
+    write_file_index(target)
+    assert load_file_index(target)
+
+    with open(str(target), 'ab') as f:  # an empty gzip member
+        f.write(compression.block_compressor('gzip', 6)(b''))
+    assert load_file_index(target) is None
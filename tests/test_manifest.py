@@ -0,0 +1,70 @@
+import datetime
+import sqlite3
+
+from bingads_downloader.manifest import Manifest
+from tests.report_files import campaign_rows, write_compressed_report
+
+DAY = datetime.date(2020, 1, 15)
+
+
+def columns(path, table: str) -> [str]:
+    with sqlite3.connect(str(path)) as connection:
+        return [row[1] for row in connection.execute('PRAGMA table_info({})'.format(table))]
+
+
+def test_migrates_a_manifest_of_a_previous_version(tmp_path):
+    path = tmp_path / 'manifest.sqlite3'
+    with sqlite3.connect(str(path)) as connection:
+        connection.execute('''
+CREATE TABLE download (
+    day TEXT NOT NULL, report TEXT NOT NULL, version TEXT NOT NULL, status TEXT NOT NULL, row_count INTEGER,
+    byte_size INTEGER, checksum TEXT, downloaded_at TEXT, PRIMARY KEY (day, report, version)
+)''')
+        connection.execute('CREATE TABLE structure_campaign (campaign_id TEXT PRIMARY KEY, attributes TEXT)')
+        connection.execute("INSERT INTO download VALUES ('2020-01-15', 'ad', 'v3', 'complete', 10, 100, 'x', NULL)")
+        connection.execute("INSERT INTO structure_campaign VALUES ('1', '{\"channel\": \"search\"}')")
+
+    manifest = Manifest(path)
+    assert {'content_hash', 'stable_runs'} <= set(columns(path, 'download'))
+    assert 'labels' in columns(path, 'structure_campaign')
+    assert manifest.states() == {(DAY, 'ad'): 'complete'}
+    assert manifest.stable_runs() == {(DAY, 'ad'): 0}
+    assert manifest.content_hash(DAY, 'ad') is None
+    assert manifest.campaign_labels() == {'1': {'channel': 'search'}}
+    assert manifest.campaign_label_strings() == {'1': ''}
+
+    Manifest(path)  # opening a migrated manifest again changes nothing
+    assert manifest.states() == {(DAY, 'ad'): 'complete'}
+
+
+def test_counts_the_downloads_in_which_a_file_did_not_change(tmp_path):
+    file_path = tmp_path / 'campaign_performance_v3.csv.gz'
+    write_compressed_report(file_path, campaign_rows(DAY))
+    manifest = Manifest(tmp_path / 'manifest.sqlite3')
+
+    manifest.start(DAY, 'campaign')
+    assert manifest.states() == {(DAY, 'campaign'): 'started'}
+    assert manifest.stable_runs() == {}
+
+    manifest.complete(DAY, 'campaign', file_path)
+    content_hash = manifest.content_hash(DAY, 'campaign')
+    assert content_hash.startswith('6:')
+    assert manifest.stable_runs() == {(DAY, 'campaign'): 0}
+
+    for stable_runs in (1, 2):
+        manifest.start(DAY, 'campaign')
+        manifest.unchanged(DAY, 'campaign')
+        assert manifest.stable_runs() == {(DAY, 'campaign'): stable_runs}
+    assert manifest.content_hash(DAY, 'campaign') == content_hash
+
+    write_compressed_report(file_path, campaign_rows(DAY, ['1001']))
+    manifest.complete(DAY, 'campaign', file_path)
+    assert manifest.stable_runs() == {(DAY, 'campaign'): 0}
+    assert manifest.content_hash(DAY, 'campaign') != content_hash
+
+
+def test_a_missing_file_is_complete_without_rows(tmp_path):
+    manifest = Manifest(tmp_path / 'manifest.sqlite3')
+    manifest.complete(DAY, 'campaign', tmp_path / 'missing.csv.gz')
+    assert manifest.states() == {(DAY, 'campaign'): 'complete'}
+    assert manifest.content_hash(DAY, 'campaign') is None
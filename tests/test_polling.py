@@ -0,0 +1,73 @@
+import threading
+import time
+
+import pytest
+from bingads.exceptions import TimeoutException
+from bingads.v13.reporting.reporting_operation_status import ReportingOperationStatus
+
+from bingads_downloader import config, rate_limit
+from bingads_downloader.polling import ReportPoller
+
+
+class Operation:
+    """A report that is ready `seconds` after its submission, of which every status request takes `latency`"""
+
+    def __init__(self, seconds: float, latency: float = 0.0, submitted_at: float = None):
+        self.submitted_at = time.time() if submitted_at is None else submitted_at
+        self.seconds = seconds
+        self.latency = latency
+        self.polls = 0
+
+    def get_status(self) -> ReportingOperationStatus:
+        self.polls += 1
+        time.sleep(self.latency)
+        ready = time.time() - self.submitted_at >= self.seconds
+        return ReportingOperationStatus(status='Success' if ready else 'Pending', report_download_url=None)
+
+
+@pytest.fixture(autouse=True)
+def rate_limiter(monkeypatch):
+    monkeypatch.setattr(config, 'requests_per_minute', lambda: 6000)
+    monkeypatch.setattr(rate_limit, '_rate_limiter', None)
+
+
+def wait_concurrently(poller: ReportPoller, operations: {str: Operation}) -> {str: float}:
+    """Waits for all reports at the same time and returns the seconds after which each was ready"""
+    results = {}
+
+    def wait(name: str, operation: Operation):
+        results[name] = poller.wait_until_ready(operation, 10, operation.submitted_at)
+
+    threads = [threading.Thread(target=wait, args=item) for item in operations.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_a_slow_status_request_does_not_delay_other_reports():
+    results = wait_concurrently(ReportPoller(0.05, 0.1), {'slow': Operation(0, latency=2),
+                                                         'fast': Operation(0.2)})
+    assert results['slow'] >= 2
+    assert results['fast'] < 1
+
+
+def test_reports_are_timed_from_their_submission():
+    operation = Operation(0.1, submitted_at=time.time() - 3)
+    assert ReportPoller(0.05, 0.1).wait_until_ready(operation, 10, operation.submitted_at) >= 3
+    assert operation.polls == 1
+
+
+def test_throttling_postpones_the_polls():
+    poller = ReportPoller(0.05, 0.1)
+    rate_limit.rate_limiter().throttled(1)
+    operation = Operation(0)
+    assert poller.wait_until_ready(operation, 10, operation.submitted_at) >= 1
+    assert operation.polls == 1
+
+
+def test_reports_time_out():
+    operation = Operation(60)
+    with pytest.raises(TimeoutException):
+        ReportPoller(0.05, 0.1).wait_until_ready(operation, 0.3, operation.submitted_at)
@@ -0,0 +1,102 @@
+import datetime
+import io
+import random
+
+import pytest
+
+from bingads_downloader.report_file import (ColumnMismatchError, ContentHash, PreambleError, ReportReader,
+                                            TruncatedReportError)
+from tests.report_files import CAMPAIGN_COLUMNS, bing_report, campaign_rows
+
+DAY = datetime.date(2020, 1, 15)
+
+
+def read(text: str, columns: [str] = None, allow_normalized: bool = False) -> ReportReader:
+    reader = ReportReader(io.StringIO(text, newline=''), columns, allow_normalized)
+    reader.rows = list(reader)
+    return reader
+
+
+def test_reads_the_rows_between_preamble_and_footer():
+    rows = campaign_rows(DAY)
+    reader = read(bing_report(rows), CAMPAIGN_COLUMNS)
+    assert reader.header == CAMPAIGN_COLUMNS
+    assert reader.rows == rows
+    assert reader.row_count == reader.expected_row_count == len(rows)
+    assert reader.footer[-1][0].startswith('©2020 Microsoft')
+    assert not reader.normalized
+
+
+def test_reads_normalized_files_without_validation():
+    rows = campaign_rows(DAY)
+    reader = read(''.join(','.join(row) + '\r\n' for row in [CAMPAIGN_COLUMNS] + rows), allow_normalized=True)
+    assert reader.normalized
+    assert reader.rows == rows
+
+
+def test_rejects_a_report_without_preamble():
+    with pytest.raises(PreambleError, match='instead of its name'):
+        read(''.join(','.join(row) + '\r\n' for row in [CAMPAIGN_COLUMNS] + campaign_rows(DAY, campaigns=10)))
+
+
+def test_rejects_a_report_without_row_count():
+    text = bing_report(campaign_rows(DAY)).replace('Rows: 6', 'Something else')
+    with pytest.raises(PreambleError, match='no row count'):
+        read(text)
+
+
+def test_rejects_a_report_that_ends_before_the_header():
+    with pytest.raises(TruncatedReportError):
+        read('"Report Name: My Campaign Performance Report"\r\n')
+
+
+def test_rejects_other_columns():
+    with pytest.raises(ColumnMismatchError):
+        read(bing_report(campaign_rows(DAY)), CAMPAIGN_COLUMNS[:-1])
+
+
+def test_rejects_a_report_without_footer():
+    with pytest.raises(TruncatedReportError, match='without its footer'):
+        read(bing_report(campaign_rows(DAY), footer=[]))
+
+
+@pytest.mark.parametrize('row_count', [5, 7])
+def test_rejects_a_report_with_a_different_row_count(row_count):
+    with pytest.raises(TruncatedReportError, match='instead of {}'.format(row_count)):
+        read(bing_report(campaign_rows(DAY), row_count=row_count))
+
+
+def content_hash(rows: [[str]], header: [str] = CAMPAIGN_COLUMNS) -> ContentHash:
+    result = ContentHash(header)
+    for row in rows:
+        result.update(row)
+    return result
+
+
+def test_content_hash_does_not_depend_on_the_order_of_the_rows():
+    rows = campaign_rows(DAY, campaigns=10)
+    shuffled = list(rows)
+    random.Random(1).shuffle(shuffled)
+    assert content_hash(rows).hexdigest() == content_hash(shuffled).hexdigest()
+
+
+def test_content_hash_changes_with_the_rows_and_the_header():
+    rows = campaign_rows(DAY)
+    changed = [list(row) for row in rows]
+    changed[2][-1] = '9.99'
+    assert content_hash(rows).hexdigest() != content_hash(changed).hexdigest()
+    assert content_hash(rows).hexdigest() != content_hash(rows[:-1]).hexdigest()
+    assert content_hash(rows).hexdigest() != content_hash(rows, CAMPAIGN_COLUMNS[::-1]).hexdigest()
+
+
+def test_content_hashes_of_several_reports_add_up():
+    first, second = campaign_rows(DAY, ['1001']), campaign_rows(DAY, ['1002'])
+    merged = content_hash(first)
+    merged.add(content_hash(second))
+    assert merged.hexdigest() == content_hash(second + first).hexdigest()
+    assert merged.row_count == len(first) + len(second)
+
+
+def test_content_hash_of_the_reader_covers_the_data_rows_only():
+    rows = campaign_rows(DAY)
+    assert read(bing_report(rows)).content_hash.hexdigest() == content_hash(rows).hexdigest()
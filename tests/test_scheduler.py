@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+
+from bingads_downloader.scheduler import run_jobs
+
+
+def test_runs_every_job_with_bounded_concurrency():
+    lock, running, peak, done = threading.Lock(), [0], [0], []
+
+    def job(number):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+            done.append(number)
+
+    run_jobs(job, range(20), 3)
+    assert sorted(done) == list(range(20))
+    assert peak[0] <= 3
+
+
+def test_consumes_jobs_lazily():
+    created, created_before_start = [], {}
+
+    def jobs():
+        for number in range(10):
+            created.append(number)
+            yield number
+
+    def job(number):
+        created_before_start[number] = len(created)
+        time.sleep(0.01)
+
+    run_jobs(job, jobs(), 2)
+    assert created == list(range(10))
+    assert all(count <= number + 2 for number, count in created_before_start.items())
+
+
+def test_reraises_the_error_of_a_failed_job_and_starts_no_further_jobs():
+    started, finished = [], []
+
+    def job(number):
+        started.append(number)
+        if number == 1:
+            raise ValueError('job 1 failed')
+        time.sleep(0.05)
+        finished.append(number)
+
+    with pytest.raises(ValueError, match='job 1 failed'):
+        run_jobs(job, range(100), 2)
+    assert len(started) < 100
+    # the jobs in flight when the error was noticed are awaited
+    assert sorted(finished) == sorted(number for number in started if number != 1)
+
+
+def test_reraises_the_error_of_the_last_jobs():
+    def job(number):
+        if number == 4:
+            raise KeyError(number)
+
+    with pytest.raises(KeyError):
+        run_jobs(job, range(5), 10)
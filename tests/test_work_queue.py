@@ -0,0 +1,138 @@
+import datetime
+import time
+from typing import NamedTuple
+
+import pytest
+
+from bingads_downloader import config
+from bingads_downloader.work_queue import Heartbeat, WorkQueue, leased_jobs
+
+PLAN = '2020-03-31_v3'
+
+
+class Job(NamedTuple):
+    first_date: datetime.date
+    last_date: datetime.date
+    report: str
+
+
+JOBS = [Job(datetime.date(2020, 3, day), datetime.date(2020, 3, day), report)
+        for day in (31, 30) for report in ('ad', 'campaign')]
+
+
+class Clock:
+    """Replaces time.time() in the work queue"""
+
+    def __init__(self, monkeypatch):
+        self.now = 1000000.0
+        monkeypatch.setattr(time, 'time', lambda: self.now)
+
+
+@pytest.fixture
+def queues(tmp_path, monkeypatch):
+    """Two workers that share a work queue with a lease timeout of 60 seconds"""
+    monkeypatch.setattr(config, 'lease_timeout', lambda: 60)
+    monkeypatch.setattr(config, 'total_attempts_for_single_day', lambda: 2)
+    return WorkQueue(tmp_path / 'queue.sqlite3', 'a'), WorkQueue(tmp_path / 'queue.sqlite3', 'b')
+
+
+def test_a_plan_is_created_by_one_worker(queues):
+    a, b = queues
+    assert a.plan(PLAN, lambda: JOBS)
+    assert not b.plan(PLAN, lambda: pytest.fail('the jobs of an existing plan are created again'))
+    assert a.counts(PLAN) == {'pending': len(JOBS)}
+
+
+def test_workers_lease_different_jobs_in_order(queues):
+    a, b = queues
+    a.plan(PLAN, lambda: JOBS)
+    assert a.claim(PLAN) == (1, '2020-03-31', '2020-03-31', 'ad')
+    assert b.claim(PLAN) == (2, '2020-03-31', '2020-03-31', 'campaign')
+    assert a.counts(PLAN) == {'leased': 2, 'pending': 2}
+
+
+def test_expired_leases_are_taken_by_other_workers(queues, monkeypatch):
+    clock = Clock(monkeypatch)
+    a, b = queues
+    a.plan(PLAN, lambda: JOBS[:2])
+    job_id = a.claim(PLAN)[0]
+    b.claim(PLAN)
+    assert b.claim(PLAN) is None
+    assert a.next_lease_expiry(PLAN) == clock.now + 60
+
+    clock.now += 40
+    b.renew()  # renews only the lease of b
+    clock.now += 30
+    assert b.claim(PLAN)[0] == job_id
+    assert b.claim(PLAN) is None
+
+
+def test_failed_jobs_are_retried_until_their_attempts_are_used_up(queues):
+    a, b = queues
+    a.plan(PLAN, lambda: JOBS[:1])
+    job_id = a.claim(PLAN)[0]
+    a.finish(job_id, ValueError('first attempt'))
+    assert a.counts(PLAN) == {'pending': 1}
+    assert b.claim(PLAN)[0] == job_id
+    b.finish(job_id, ValueError('second attempt'))
+    assert a.counts(PLAN) == {'failed': 1}
+    assert a.claim(PLAN) is None
+    assert a.next_lease_expiry(PLAN) is None
+
+
+def test_leased_jobs_returns_all_jobs(queues):
+    a, _ = queues
+    a.plan(PLAN, lambda: JOBS)
+    for job_id, *_ in leased_jobs(a, PLAN):
+        a.finish(job_id)
+    assert a.counts(PLAN) == {'done': len(JOBS)}
+
+
+def test_a_plan_is_prepared_once(queues):
+    a, b = queues
+    a.plan(PLAN, lambda: JOBS)
+    prepared = []
+    a.prepare(PLAN, lambda: prepared.append('a'))
+    b.prepare(PLAN, lambda: prepared.append('b'))
+    assert prepared == ['a']
+
+
+def test_another_worker_prepares_the_plan_when_the_lease_expired(queues, monkeypatch):
+    clock = Clock(monkeypatch)
+    a, b = queues
+    a.plan(PLAN, lambda: JOBS)
+    clock.now += 61  # a stopped before preparing the plan
+    prepared = []
+    b.prepare(PLAN, lambda: prepared.append('b'))
+    a.prepare(PLAN, lambda: prepared.append('a'))
+    assert prepared == ['b']
+
+
+def test_a_failed_preparation_is_taken_over_right_away(queues):
+    a, b = queues
+    a.plan(PLAN, lambda: JOBS)
+
+    def fail():
+        raise RuntimeError('account structure')
+
+    with pytest.raises(RuntimeError):
+        a.prepare(PLAN, fail)
+    prepared = []
+    b.prepare(PLAN, lambda: prepared.append('b'))
+    assert prepared == ['b']
+
+
+def test_the_heartbeat_survives_failed_renewals(queues, monkeypatch):
+    a, _ = queues
+    monkeypatch.setattr(config, 'lease_timeout', lambda: 3)  # a heartbeat every second
+    renewals = []
+
+    def renew():
+        renewals.append(time.time())
+        if len(renewals) == 1:
+            raise RuntimeError('database is locked')
+
+    monkeypatch.setattr(a, 'renew', renew)
+    with Heartbeat(a):
+        time.sleep(2.5)
+    assert len(renewals) == 2